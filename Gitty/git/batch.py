@@ -0,0 +1,155 @@
+import subprocess
+import threading
+
+from Gitty.tracing import tracer
+
+
+class CatFileBatch(object):
+    """A long-lived ``git cat-file --batch`` process for one repository.
+
+    Objects are requested by writing their names to the process and
+    reading the responses back off its pipes, so looking up an object
+    doesn't cost a fork/exec. If the process dies, it's restarted on the
+    next request. Requests can be made from any thread. Each request is
+    traced.
+
+    If pool is given, each request takes one of its slots for the
+    repository while it runs.
+    """
+    # The amount of an object to copy at a time when streaming it.
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, path, check=False, pool=None):
+        self.path = path
+        self.check = check
+        self.pool = pool
+        self.process = None
+        self.lock = threading.RLock()
+
+    def start(self):
+        if self.check:
+            mode = "--batch-check"
+        else:
+            mode = "--batch"
+
+        self.process = subprocess.Popen(["git", "cat-file", mode],
+                                        cwd=self.path,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        close_fds=True)
+
+    def close(self):
+        self.lock.acquire()
+        process = self.process
+        self.process = None
+        self.lock.release()
+
+        if process and process.poll() is None:
+            try:
+                process.stdin.close()
+                process.wait()
+            except (IOError, OSError):
+                pass
+
+    def request(self, name, fp=None, slot=None):
+        """Requests an object from the process.
+
+        Returns a tuple of (sha1, type, size, contents), or None if the
+        object doesn't exist. The contents are None for --batch-check.
+
+        If fp is given, the contents are streamed into it a chunk at a
+        time instead of being returned, and are None in the result.
+
+        If slot is given, the request runs under it, instead of waiting
+        for one of the pool's.
+        """
+        own_slot = None
+
+        if self.pool and slot is None:
+            own_slot = self.pool.acquire_slot(self.path)
+
+        try:
+            return self.__locked_request(name, fp)
+        finally:
+            if own_slot:
+                self.pool.release_slot(own_slot)
+
+    def __locked_request(self, name, fp):
+        if self.check:
+            span = tracer.span("git", "cat-file --batch-check", object=name)
+        else:
+            span = tracer.span("git", "cat-file --batch", object=name)
+
+        self.lock.acquire()
+
+        try:
+            try:
+                result = self.__request(name, fp)
+            except (IOError, OSError, ValueError):
+                # The process went away or got out of sync. Start a fresh
+                # one and try once more.
+                self.close()
+
+                if fp:
+                    fp.seek(0)
+                    fp.truncate()
+
+                result = self.__request(name, fp)
+
+            if result and not self.check:
+                span.bytes = result[2]
+
+            return result
+        finally:
+            self.lock.release()
+            span.finish()
+
+    def __request(self, name, fp):
+        if not self.process or self.process.poll() is not None:
+            self.start()
+
+        stdin = self.process.stdin
+        stdout = self.process.stdout
+
+        stdin.write(name + "\n")
+        stdin.flush()
+
+        line = stdout.readline()
+
+        if not line:
+            raise IOError("git cat-file exited unexpectedly")
+
+        parts = line.split()
+
+        if len(parts) == 2 and parts[1] == "missing":
+            return None
+
+        sha1, obj_type, size = parts
+        size = int(size)
+
+        if self.check:
+            return (sha1, obj_type, size, None)
+
+        if fp:
+            contents = None
+            remaining = size
+
+            while remaining > 0:
+                chunk = stdout.read(min(remaining, self.STREAM_CHUNK_SIZE))
+
+                if not chunk:
+                    raise IOError("Short read from git cat-file")
+
+                fp.write(chunk)
+                remaining -= len(chunk)
+        else:
+            contents = stdout.read(size)
+
+            if len(contents) != size:
+                raise IOError("Short read from git cat-file")
+
+        # Each object is followed by a newline.
+        if stdout.read(1) != "\n":
+            raise IOError("Short read from git cat-file")
+
+        return (sha1, obj_type, size, contents)
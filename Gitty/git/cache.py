@@ -0,0 +1,607 @@
+import fcntl
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_right
+from itertools import izip
+
+
+class GraphCache(object):
+    """An on-disk cache of a laid out commit graph.
+
+    The cache stores the parsed commits, their layout and the layout
+    checkpoints, along with the ref tips the history was loaded from.
+    Each field is stored as an array with one entry per commit, so it's
+    written and read a column at a time. Loading only reads the columns.
+    Each commit object is created when it's first looked up, so the top
+    of a large history can be shown without creating the rest.
+
+    The file is a header followed by segments. The first segment holds a
+    whole history. Each segment after it holds the commits that were
+    added above the history before it, along with the old commits whose
+    layout they changed, which it takes the place of. That way, saving a
+    refreshed history only writes what changed.
+    """
+    MAGIC = "GITTYGC\0"
+    VERSION = 3
+
+    # The header holds the size of the file that's been written
+    # completely, so a segment that's only partly written is ignored.
+    HEADER_FORMAT = "<8sIIQ"
+
+    (SECTION_TIPS,
+     SECTION_SHA1S,
+     SECTION_PARENT_OFFSETS,
+     SECTION_PARENTS,
+     SECTION_STRINGS,
+     SECTION_AUTHORS,
+     SECTION_AUTHOR_TIMES,
+     SECTION_AUTHOR_TZS,
+     SECTION_COMMITTERS,
+     SECTION_COMMITTER_TIMES,
+     SECTION_COMMITTER_TZS,
+     SECTION_MESSAGES,
+     SECTION_NODE_COLUMNS,
+     SECTION_NODE_COLORS,
+     SECTION_LINE_OFFSETS,
+     SECTION_LINES,
+     SECTION_CHECKPOINT_ORDINALS,
+     SECTION_CHECKPOINT_OFFSETS,
+     SECTION_CHECKPOINT_LANES,
+     SECTION_CHECKPOINT_COLORS) = range(20)
+
+    NUM_SECTIONS = 20
+
+    # Each segment starts with the number of commits it takes the place
+    # of, followed by the length of each section.
+    SEGMENT_FORMAT = "<%dQ" % (NUM_SECTIONS + 1)
+
+    # The number of segments past which the whole history is written out
+    # again, rather than adding another.
+    MAX_SEGMENTS = 16
+
+    NULL_SHA1 = "\0" * 20
+
+    def __init__(self, filename, commit_class):
+        self.filename = filename
+        self.commit_class = commit_class
+
+    def load(self):
+        """Loads the cache.
+
+        Returns a tuple of (tips, commits, checkpoints, ordinals), or None
+        if there's no usable cache. tips is a sorted list of binary SHA-1s,
+        commits is a CachedCommits, checkpoints is a dictionary mapping
+        ordinals to layout states, and ordinals maps each commit's binary
+        SHA-1 to its ordinal.
+        """
+        try:
+            fp = open(self.filename, "rb")
+        except IOError:
+            return None
+
+        try:
+            try:
+                data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                return None
+
+            try:
+                return self.__read(data)
+            except (ValueError, IndexError, struct.error):
+                return None
+            finally:
+                data.close()
+        finally:
+            fp.close()
+
+    def save(self, tips, commits, checkpoints):
+        """Writes out a whole history, replacing what's in the cache."""
+        segment = self.__build_segment(0, tips, commits, checkpoints)
+
+        dirname = os.path.dirname(self.filename)
+
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        # Write to a temporary file and move it into place, so a reader
+        # never sees a partially written cache.
+        tmp_filename = "%s.%d.tmp" % (self.filename, os.getpid())
+        fp = open(tmp_filename, "wb")
+
+        try:
+            header_size = struct.calcsize(self.HEADER_FORMAT)
+            fp.write(self.__pack_header(header_size + len(segment)))
+            fp.write(segment)
+        finally:
+            fp.close()
+
+        os.rename(tmp_filename, self.filename)
+
+    def append(self, base_tips, tips, commits, checkpoints, skip):
+        """Adds commits above the history in the cache.
+
+        commits are the top of the new history, and take the place of the
+        first skip commits of the cached one, which must be the history
+        of base_tips. checkpoints are the layout states within commits.
+
+        Returns False if the cache doesn't hold that history, or has been
+        added to too many times, in which case the whole history should
+        be saved instead.
+        """
+        segment = self.__build_segment(skip, tips, commits, checkpoints)
+
+        try:
+            fp = open(self.filename, "r+b")
+        except IOError:
+            return False
+
+        try:
+            try:
+                # Another instance could be saving the same cache.
+                fcntl.lockf(fp, fcntl.LOCK_EX)
+
+                return self.__append_segment(fp, base_tips, segment)
+            except struct.error:
+                return False
+        finally:
+            fp.close()
+
+    def __append_segment(self, fp, base_tips, segment):
+        header_size = struct.calcsize(self.HEADER_FORMAT)
+        size = self.__unpack_header(fp.read(header_size))
+
+        if size is None:
+            return False
+
+        segment_size = struct.calcsize(self.SEGMENT_FORMAT)
+        offset = header_size
+        count = 0
+
+        while offset < size:
+            fp.seek(offset)
+            lengths = struct.unpack(self.SEGMENT_FORMAT,
+                                    fp.read(segment_size))[1:]
+            last_tips = fp.read(lengths[self.SECTION_TIPS])
+            offset += segment_size + sum(lengths)
+            count += 1
+
+        if count == 0 or count >= self.MAX_SEGMENTS or offset != size:
+            return False
+
+        if last_tips != "".join(base_tips):
+            return False
+
+        # Anything past the end of the last segment is left over from one
+        # that was never finished.
+        fp.seek(size)
+        fp.write(segment)
+        fp.truncate()
+        fp.flush()
+
+        fp.seek(0)
+        fp.write(self.__pack_header(size + len(segment)))
+
+        return True
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+
+    def __pack_header(self, size):
+        return struct.pack(self.HEADER_FORMAT, self.MAGIC, self.VERSION,
+                           array('l').itemsize, size)
+
+    def __unpack_header(self, header):
+        """Returns the size of the cache written so far, or None."""
+        magic, version, long_size, size = \
+            struct.unpack(self.HEADER_FORMAT, header)
+
+        if (magic != self.MAGIC or version != self.VERSION or
+            long_size != array('l').itemsize):
+            return None
+
+        return size
+
+    def __build_segment(self, skip, tips, commits, checkpoints):
+        # The columns are each built with a pass over the commits.
+        commits = list(commits)
+        strings = {}
+        get_string_index = strings.setdefault
+
+        def get_string_indexes(values):
+            return array('I', [get_string_index(s, len(strings))
+                               for s in values])
+
+        parent_offsets = array('I', [0])
+        line_offsets = array('I', [0])
+        parents = 0
+        lines = 0
+
+        for commit in commits:
+            parents += len(commit.parents)
+            parent_offsets.append(parents)
+            lines += len(commit.out_lines)
+            line_offsets.append(lines)
+
+        authors = get_string_indexes([c.author for c in commits])
+        author_tzs = get_string_indexes([c.author_tz for c in commits])
+        committers = get_string_indexes([c.committer for c in commits])
+        committer_tzs = \
+            get_string_indexes([c.committer_tz for c in commits])
+
+        string_table = [None] * len(strings)
+
+        for s, index in strings.iteritems():
+            string_table[index] = s
+
+        checkpoint_ordinals = array('I', sorted(checkpoints.keys()))
+        checkpoint_offsets = array('I', [0])
+        checkpoint_lanes = []
+        checkpoint_colors = array('i')
+
+        for ordinal in checkpoint_ordinals:
+            lanes, colors = checkpoints[ordinal]
+
+            for lane in lanes:
+                checkpoint_lanes.append(lane or self.NULL_SHA1)
+
+            checkpoint_colors.extend(colors)
+            checkpoint_offsets.append(len(checkpoint_lanes))
+
+        sections = [
+            "".join(tips),
+            "".join([c.sha1 for c in commits]),
+            parent_offsets.tostring(),
+            "".join([p for c in commits for p in c.parents]),
+            "\0".join(string_table),
+            authors.tostring(),
+            array('l', [c.author_time for c in commits]).tostring(),
+            author_tzs.tostring(),
+            committers.tostring(),
+            array('l', [c.committer_time for c in commits]).tostring(),
+            committer_tzs.tostring(),
+            "\0".join([c.message for c in commits]),
+            array('i', [c.node[0] for c in commits]).tostring(),
+            array('i', [c.node[1] for c in commits]).tostring(),
+            line_offsets.tostring(),
+            array('i', [value for c in commits
+                         for line in c.out_lines
+                         for value in line]).tostring(),
+            checkpoint_ordinals.tostring(),
+            checkpoint_offsets.tostring(),
+            "".join(checkpoint_lanes),
+            checkpoint_colors.tostring(),
+        ]
+
+        return struct.pack(self.SEGMENT_FORMAT, skip,
+                           *[len(section) for section in sections]) + \
+               "".join(sections)
+
+    def __read(self, data):
+        header_size = struct.calcsize(self.HEADER_FORMAT)
+        size = self.__unpack_header(data[:header_size])
+
+        if size is None or size > len(data):
+            return None
+
+        segment_size = struct.calcsize(self.SEGMENT_FORMAT)
+        offset = header_size
+        segments = []
+
+        while offset < size:
+            values = struct.unpack_from(self.SEGMENT_FORMAT, data, offset)
+            offset += segment_size
+            sections = []
+
+            for length in values[1:]:
+                sections.append(data[offset:offset + length])
+                offset += length
+
+            segments.append((values[0], sections))
+
+        if not segments or offset != size:
+            return None
+
+        # Work out how many commits from the start of each segment are
+        # taken over by the segments after it.
+        drops = []
+        skip = 0
+
+        for segment_skip, sections in reversed(segments):
+            count = len(sections[self.SECTION_SHA1S]) / 20
+            drop = min(skip, count)
+            drops.append(drop)
+            skip += segment_skip - drop
+
+        if skip:
+            return None
+
+        drops.reverse()
+        loaded = []
+        checkpoints = {}
+        base = 0
+
+        for (segment_skip, sections), drop in \
+                reversed(zip(segments, drops)):
+            segment = CacheSegment(sections, drop)
+
+            if not segment.is_valid():
+                return None
+
+            self.__read_checkpoints(sections, drop, base, checkpoints)
+            loaded.append(segment)
+            base += segment.count
+
+        commits = CachedCommits(self.commit_class, loaded)
+        ordinals = {}
+
+        for segment, start in izip(loaded, commits.starts):
+            ordinals.update(izip(segment.sha1s[segment.drop:],
+                                 xrange(start, start + segment.count)))
+
+        tips = get_sha1s(segments[-1][1][self.SECTION_TIPS])
+
+        return (tips, commits, checkpoints, ordinals)
+
+    def __read_checkpoints(self, sections, drop, base, checkpoints):
+        """Adds the checkpoints in a segment whose commits start at base.
+
+        The checkpoints within the first drop commits are left out.
+        """
+        ordinals = get_array('I',
+                             sections[self.SECTION_CHECKPOINT_ORDINALS])
+        offsets = get_array('I', sections[self.SECTION_CHECKPOINT_OFFSETS])
+        lanes = get_sha1s(sections[self.SECTION_CHECKPOINT_LANES])
+        colors = get_array('i', sections[self.SECTION_CHECKPOINT_COLORS])
+
+        for i, ordinal in enumerate(ordinals):
+            if ordinal < drop:
+                continue
+
+            start = offsets[i]
+            end = offsets[i + 1]
+            state_lanes = tuple([lane != self.NULL_SHA1 and lane or None
+                                 for lane in lanes[start:end]])
+            checkpoints[base + ordinal - drop] = \
+                (state_lanes, tuple(colors[start:end]))
+
+
+class CacheSegment(object):
+    """The columns of a segment of a GraphCache, as they were read.
+
+    The first drop commits are taken over by the segments after it, and
+    count is the number of commits left.
+    """
+    def __init__(self, sections, drop):
+        (tips, sha1s, parent_offsets, parents, strings, authors,
+         author_times, author_tzs, committers, committer_times,
+         committer_tzs, messages, node_columns, node_colors, line_offsets,
+         lines) = sections[:GraphCache.SECTION_CHECKPOINT_ORDINALS]
+
+        self.drop = drop
+        self.sha1s = get_sha1s(sha1s)
+        self.parent_offsets = get_array('I', parent_offsets)
+        self.parents = parents
+        self.strings = [intern(string) for string in strings.split("\0")]
+        self.authors = get_array('I', authors)
+        self.author_times = get_array('l', author_times)
+        self.author_tzs = get_array('I', author_tzs)
+        self.committers = get_array('I', committers)
+        self.committer_times = get_array('l', committer_times)
+        self.committer_tzs = get_array('I', committer_tzs)
+        self.messages = messages.split("\0")
+        self.node_columns = get_array('i', node_columns)
+        self.node_colors = get_array('i', node_colors)
+        self.line_offsets = get_array('I', line_offsets)
+        self.lines = get_array('i', lines)
+        self.line_data = lines
+        self.line_size = self.lines.itemsize * 3
+
+        if not self.sha1s:
+            self.messages = []
+
+        self.count = len(self.sha1s) - drop
+
+    def is_valid(self):
+        """Returns whether the columns hold together."""
+        count = len(self.sha1s)
+
+        return (len(self.messages) == count and
+                len(self.parent_offsets) == count + 1 and
+                len(self.line_offsets) == count + 1 and
+                len(self.authors) == count and
+                len(self.author_times) == count and
+                len(self.author_tzs) == count and
+                len(self.committers) == count and
+                len(self.committer_times) == count and
+                len(self.committer_tzs) == count and
+                len(self.node_columns) == count and
+                len(self.node_colors) == count and
+                len(self.parents) == self.parent_offsets[-1] * 20 and
+                len(self.lines) == self.line_offsets[-1] * 3)
+
+    def get_sha1(self, i):
+        return self.sha1s[self.drop + i]
+
+    def get_parents(self, i):
+        i += self.drop
+        start = self.parent_offsets[i] * 20
+        end = self.parent_offsets[i + 1] * 20
+
+        return tuple(get_sha1s(self.parents[start:end]))
+
+    def get_fields(self, i):
+        """Returns a commit's fields, as Commit.get_fields() would."""
+        parents = self.get_parents(i)
+        strings = self.strings
+        i += self.drop
+
+        return (self.sha1s[i], parents, self.messages[i],
+                strings[self.authors[i]], self.author_times[i],
+                strings[self.author_tzs[i]],
+                strings[self.committers[i]], self.committer_times[i],
+                strings[self.committer_tzs[i]])
+
+    def get_node(self, i):
+        i += self.drop
+
+        return (self.node_columns[i], self.node_colors[i])
+
+    def get_out_lines(self, i, lines_cache):
+        """Returns the lines leaving a commit's row.
+
+        Most rows in a history have the same lines running through them,
+        so identical line lists are shared through lines_cache.
+        """
+        i += self.drop
+        start = self.line_offsets[i]
+        end = self.line_offsets[i + 1]
+        key = self.line_data[start * self.line_size:end * self.line_size]
+        out_lines = lines_cache.get(key)
+
+        if out_lines is None:
+            values = self.lines[start * 3:end * 3]
+            out_lines = lines_cache[key] = \
+                zip(values[0::3], values[1::3], values[2::3])
+
+        return out_lines
+
+
+class CachedCommits(object):
+    """The commits of a history read from a GraphCache.
+
+    This acts as a list of commits, which are created from the cache's
+    columns when they're first looked up and kept from then on. Adding a
+    list of commits in front of it, with +, gives another CachedCommits
+    that shares the cached commits with this one.
+    """
+    def __init__(self, commit_class, segments, prefix=(), built=None,
+                 lines_cache=None):
+        self.commit_class = commit_class
+        self.segments = segments
+        self.starts = []
+        count = 0
+
+        for segment in segments:
+            self.starts.append(count)
+            count += segment.count
+
+        # The commits in front of the cached ones, and the cached commits
+        # created so far, with None for the others.
+        self.prefix = list(prefix)
+        self.built = built or [None] * count
+        self.lines_cache = lines_cache or {}
+
+    def __len__(self):
+        return len(self.prefix) + len(self.built)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+
+        if i < 0:
+            i += len(self)
+
+            if i < 0:
+                raise IndexError("commit index out of range")
+
+        if i < len(self.prefix):
+            return self.prefix[i]
+
+        row = i - len(self.prefix)
+        commit = self.built[row]
+
+        if commit is None:
+            commit = self.built[row] = self.__build(row)
+
+        return commit
+
+    def __iter__(self):
+        for commit in self.prefix:
+            yield commit
+
+        built = self.built
+
+        for row in xrange(len(built)):
+            commit = built[row]
+
+            if commit is None:
+                commit = built[row] = self.__build(row)
+
+            yield commit
+
+    def __radd__(self, commits):
+        return CachedCommits(self.commit_class, self.segments,
+                             list(commits) + self.prefix, self.built,
+                             self.lines_cache)
+
+    def copy(self):
+        """Returns a CachedCommits that creates its commits apart from these.
+
+        The copy can be read in another thread, without the two creating
+        different commits for the same place in the history.
+        """
+        return CachedCommits(self.commit_class, self.segments, self.prefix,
+                             list(self.built))
+
+    def get_sha1(self, i):
+        """Returns a commit's binary SHA-1, without creating the commit."""
+        if i < len(self.prefix):
+            return self.prefix[i].sha1
+
+        segment, row = self.__find(i - len(self.prefix))
+
+        return segment.get_sha1(row)
+
+    def get_parents(self, i):
+        """Returns a commit's parents, without creating the commit."""
+        if i < len(self.prefix):
+            return self.prefix[i].parents
+
+        commit = self.built[i - len(self.prefix)]
+
+        if commit is not None:
+            return commit.parents
+
+        segment, row = self.__find(i - len(self.prefix))
+
+        return segment.get_parents(row)
+
+    def __find(self, row):
+        k = bisect_right(self.starts, row) - 1
+
+        return self.segments[k], row - self.starts[k]
+
+    def __build(self, row):
+        segment, segment_row = self.__find(row)
+        commit = self.commit_class.from_fields(
+            segment.get_fields(segment_row))
+        commit.node = segment.get_node(segment_row)
+        commit.out_lines = segment.get_out_lines(segment_row,
+                                                 self.lines_cache)
+
+        # The first cached commit's lines in are laid out again when
+        # commits are added in front of it.
+        if row == 0:
+            commit.in_lines = []
+        elif self.built[row - 1] is not None:
+            commit.in_lines = self.built[row - 1].out_lines
+        else:
+            segment, segment_row = self.__find(row - 1)
+            commit.in_lines = segment.get_out_lines(segment_row,
+                                                    self.lines_cache)
+
+        return commit
+
+
+def get_array(typecode, s):
+    a = array(typecode)
+    a.fromstring(s)
+
+    return a
+
+
+def get_sha1s(s):
+    return [s[i:i + 20] for i in xrange(0, len(s), 20)]
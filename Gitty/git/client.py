@@ -1,30 +1,261 @@
+import mmap
 import os
+import tempfile
+import threading
+
+from Gitty.git.diffs import Diff, to_utf8
+from Gitty.git.objects import ObjectDatabase
+from Gitty.git.pool import ProcessPool
+from Gitty.lru import LRUCache
+
+
+class CancelledError(Exception):
+    pass
+
+
+class Job(object):
+    """Tracks the git process doing work for a request.
+
+    Cancelling the job kills the process, so that a request that's no
+    longer wanted stops using up resources.
+    """
+    def __init__(self):
+        self.cancelled = False
+        self.process = None
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        self.lock.acquire()
+
+        try:
+            self.cancelled = True
+
+            if self.process and self.process.poll() is None:
+                self.process.kill()
+        finally:
+            self.lock.release()
+
+    def set_process(self, process):
+        self.lock.acquire()
+
+        try:
+            self.process = process
+
+            if self.cancelled:
+                process.kill()
+        finally:
+            self.lock.release()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise CancelledError()
+
+
+class Blob(object):
+    """The contents of a blob.
+
+    data is a string for small blobs. Large blobs are streamed into a
+    temporary file, and data is a read-only memory map of it. Either way,
+    it can be sliced and searched like a string.
+    """
+    def __init__(self, sha1, data, fp=None):
+        self.sha1 = sha1
+        self.data = data
+        self.size = len(data)
+        self.fp = fp
+
+    def is_binary(self):
+        return "\0" in self.data[:8000]
 
 
 class Client(object):
-    def __init__(self, path):
+    NULL_SHA1 = "0" * 40
+
+    # Root commits are diffed against the empty tree.
+    EMPTY_TREE_SHA1 = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+
+    # Blobs larger than this are streamed into a temporary file and
+    # memory-mapped, instead of being read into a string.
+    BLOB_MMAP_SIZE = 1024 * 1024
+
+    # The maximum total size of the blobs to keep cached.
+    BLOB_CACHE_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path, pool=None):
         self.path = path
         self.encoding = None
 
+        # The pool is shared with the other open repositories, along with
+        # the batch processes for this one.
+        self.pool = pool or ProcessPool()
+        self.pool.open_repository(path)
+        self.batch = self.pool.get_batch(path)
+        self.batch_check = self.pool.get_batch(path, check=True)
+
+        # Objects are read in-process where possible, falling back on the
+        # batch process for anything the object database can't read.
+        self.odb = None
+        self.odb_lock = threading.Lock()
+
+        # Blobs are cached by SHA-1, so a file that's the same across
+        # many commits is only read once.
+        self.blob_cache = LRUCache(self.BLOB_CACHE_SIZE,
+                                   lambda blob: blob.size)
+        self.blob_cache_lock = threading.Lock()
+
+    def close(self):
+        self.pool.close_repository(self.path)
+
+        if self.odb:
+            self.odb.close()
+
     def get_encoding(self):
         if not self.encoding:
-            fp = os.popen("git config --get i18n.commitencoding")
-            self.encoding = fp.readline().strip() or "utf-8"
-            fp.close()
+            output = self.pool.run(self.path,
+                                   ["config", "--get", "i18n.commitencoding"])
+            self.encoding = (output or "").strip() or "utf-8"
 
         return self.encoding
 
-    def diff_tree(self, parent_sha1, commit_sha1):
-        fp = os.popen("git diff-tree -p %s %s" % (parent_sha1, commit_sha1))
-        contents = unicode(fp.read(), self.get_encoding()).encode("utf-8")
-        fp.close()
+    def diff_tree(self, parent_sha1, commit_sha1, job=None):
+        """Returns the Diff between two commits.
+
+        If parent_sha1 is empty, the commit is diffed against nothing.
+        """
+        contents = self.pool.run(self.path,
+                                 ["diff-tree", "-p",
+                                  str(parent_sha1 or self.EMPTY_TREE_SHA1),
+                                  str(commit_sha1)],
+                                 job)
+
+        if job:
+            job.check_cancelled()
+
+        return Diff(contents, self.get_encoding())
+
+    def get_changed_files(self, parent_sha1, commit_sha1, job=None):
+        """Returns the files changed between two commits.
+
+        Each file is a tuple of (path, old_sha1, new_sha1, status). If
+        parent_sha1 is empty, the files are compared against nothing.
+        """
+        if parent_sha1:
+            args = ["diff-tree", "-r", "-z", str(parent_sha1),
+                    str(commit_sha1)]
+        else:
+            args = ["diff-tree", "-r", "-z", "--root", str(commit_sha1)]
+
+        output = self.pool.run(self.path, args, job)
 
-        return contents
+        if job:
+            job.check_cancelled()
+
+        # Each entry is ":old_mode new_mode old_sha1 new_sha1 status",
+        # followed by the path.
+        parts = output.split("\0")
+        files = []
+        i = 0
+
+        while i + 1 < len(parts):
+            info = parts[i].split()
+
+            if len(info) == 5 and info[0].startswith(":"):
+                files.append((parts[i + 1], info[2], info[3], info[4]))
+                i += 2
+            else:
+                i += 1
+
+        return files
+
+    def get_blob(self, sha1):
+        """Returns the Blob with the given SHA-1, or None."""
+        self.blob_cache_lock.acquire()
+
+        try:
+            blob = self.blob_cache.get(sha1)
+        finally:
+            self.blob_cache_lock.release()
+
+        if blob:
+            return blob
+
+        info = self.get_object_info(sha1)
+
+        if not info or info[0] != "blob":
+            return None
+
+        if info[1] > self.BLOB_MMAP_SIZE:
+            fp = tempfile.TemporaryFile()
+
+            if not self.batch.request(sha1, fp):
+                fp.close()
+                return None
+
+            fp.flush()
+            blob = Blob(sha1, mmap.mmap(fp.fileno(), 0,
+                                        access=mmap.ACCESS_READ), fp)
+        else:
+            obj = self.get_object(sha1)
+
+            if not obj:
+                return None
+
+            blob = Blob(sha1, obj[1])
+
+        self.blob_cache_lock.acquire()
+
+        try:
+            self.blob_cache.set(sha1, blob)
+        finally:
+            self.blob_cache_lock.release()
+
+        return blob
+
+    def get_object_database(self):
+        self.odb_lock.acquire()
+
+        try:
+            if self.odb is None:
+                git_dir = self.pool.run(self.path,
+                                        ["rev-parse", "--git-dir"]).strip()
+                self.odb = ObjectDatabase(os.path.join(self.path, git_dir))
+
+            return self.odb
+        finally:
+            self.odb_lock.release()
+
+    def get_object(self, sha1):
+        """Returns a (type, contents) tuple, or None if it doesn't exist."""
+        result = self.get_object_database().read(sha1)
+
+        if result:
+            return result
+
+        result = self.batch.request(sha1)
+
+        if result:
+            return (result[1], result[3])
+
+        return None
+
+    def get_object_info(self, sha1):
+        """Returns a (type, size) tuple, or None if it doesn't exist."""
+        result = self.batch_check.request(sha1)
+
+        if result:
+            return (result[1], result[2])
+
+        return None
 
     def get_commit_header(self, sha1):
-        fp = os.popen("git cat-file commit %s" % sha1)
-        contents = unicode(fp.read(), self.get_encoding()).encode("utf-8")
-        fp.close()
+        obj = self.get_object(sha1)
+
+        if obj and obj[0] == "commit":
+            contents = obj[1]
+        else:
+            contents = ""
+
+        contents = to_utf8(contents, self.get_encoding())
 
         in_headers = True
 
@@ -0,0 +1,603 @@
+import heapq
+import mmap
+import os
+import struct
+import subprocess
+import sys
+import threading
+from array import array
+from binascii import hexlify, unhexlify
+from bisect import bisect_right
+from collections import deque
+
+from Gitty.git.batch import CatFileBatch
+from Gitty.git.objects import ObjectDatabase
+
+
+class CommitGraphLayer(object):
+    """One commit-graph file.
+
+    A repository's commit-graph is either a single file or a chain of
+    them, where each file adds to the ones before it. Commits are
+    numbered across the whole chain, so base_count is the number of
+    commits in the files before this one.
+    """
+    MAGIC = "CGPH"
+
+    CHUNK_OID_FANOUT = "OIDF"
+    CHUNK_OID_LOOKUP = "OIDL"
+    CHUNK_COMMIT_DATA = "CDAT"
+    CHUNK_EXTRA_EDGES = "EDGE"
+    CHUNK_GENERATION_DATA = "GDA2"
+    CHUNK_GENERATION_OVERFLOW = "GDO2"
+
+    # The size of each commit's entry in the commit data chunk.
+    COMMIT_DATA_SIZE = 36
+
+    def __init__(self, path, base_count):
+        self.base_count = base_count
+
+        fp = open(path, "rb")
+
+        try:
+            self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+
+        data = self.data
+        magic, version, hash_version, num_chunks = \
+            struct.unpack(">4sBBB", data[:7])
+
+        if magic != self.MAGIC or version != 1 or hash_version != 1:
+            raise ValueError("Unsupported commit-graph file")
+
+        # The chunk table has an extra entry giving where the last chunk
+        # ends.
+        chunks = {}
+        table = []
+
+        for i in xrange(num_chunks + 1):
+            pos = 8 + i * 12
+            table.append(struct.unpack(">4sQ", data[pos:pos + 12]))
+
+        for i in xrange(num_chunks):
+            chunks[table[i][0]] = (table[i][1], table[i + 1][1])
+
+        for chunk_id in (self.CHUNK_OID_FANOUT, self.CHUNK_OID_LOOKUP,
+                         self.CHUNK_COMMIT_DATA):
+            if chunk_id not in chunks:
+                raise ValueError("commit-graph file is missing %s" %
+                                 chunk_id)
+
+        start = chunks[self.CHUNK_OID_FANOUT][0]
+        self.fanout = struct.unpack(">256L", data[start:start + 1024])
+        self.count = self.fanout[255]
+        self.oids_start = chunks[self.CHUNK_OID_LOOKUP][0]
+        self.commit_data_start = chunks[self.CHUNK_COMMIT_DATA][0]
+        self.edges_start = chunks.get(self.CHUNK_EXTRA_EDGES, (None,))[0]
+        self.generations_start = \
+            chunks.get(self.CHUNK_GENERATION_DATA, (None,))[0]
+        self.generation_overflow_start = \
+            chunks.get(self.CHUNK_GENERATION_OVERFLOW, (None,))[0]
+
+    def close(self):
+        self.data.close()
+
+    def has_generation_data(self):
+        return self.generations_start is not None
+
+    def find(self, sha1):
+        """Returns the index of a binary SHA-1 in this file, or None."""
+        data = self.data
+        first = ord(sha1[0])
+
+        if first:
+            lo = self.fanout[first - 1]
+        else:
+            lo = 0
+
+        hi = self.fanout[first]
+        start = self.oids_start
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = start + mid * 20
+            entry = data[pos:pos + 20]
+
+            if entry < sha1:
+                lo = mid + 1
+            elif entry > sha1:
+                hi = mid
+            else:
+                return mid
+
+        return None
+
+    def get_sha1(self, i):
+        pos = self.oids_start + i * 20
+
+        return self.data[pos:pos + 20]
+
+    def get_commit_data(self, i):
+        """Returns the parents, topological level and commit time.
+
+        The parents are positions in the whole chain.
+        """
+        data = self.data
+        pos = self.commit_data_start + i * self.COMMIT_DATA_SIZE + 20
+        parent1, parent2, high, low = \
+            struct.unpack(">LLLL", data[pos:pos + 16])
+
+        parents = []
+
+        if parent1 != CommitGraphFile.NO_PARENT:
+            parents.append(parent1)
+
+        if parent2 & 0x80000000:
+            # The rest of the parents are in the extra edges list, with
+            # the last one marked.
+            pos = self.edges_start + (parent2 & 0x7fffffff) * 4
+
+            while True:
+                edge = struct.unpack(">L", data[pos:pos + 4])[0]
+                parents.append(edge & 0x7fffffff)
+                pos += 4
+
+                if edge & 0x80000000:
+                    break
+        elif parent2 != CommitGraphFile.NO_PARENT:
+            parents.append(parent2)
+
+        level = high >> 2
+        commit_time = ((high & 3) << 32) | low
+
+        return (parents, level, commit_time)
+
+    def get_corrected_date(self, i, commit_time):
+        """Returns the corrected commit date, used as generation number v2."""
+        data = self.data
+        pos = self.generations_start + i * 4
+        offset = struct.unpack(">L", data[pos:pos + 4])[0]
+
+        if offset & 0x80000000:
+            pos = self.generation_overflow_start + \
+                  (offset & 0x7fffffff) * 8
+            offset = struct.unpack(">Q", data[pos:pos + 8])[0]
+
+        return commit_time + offset
+
+
+class CommitGraphFile(object):
+    """A repository's commit-graph, memory-mapped.
+
+    The commit-graph stores the parents, commit time and generation
+    number of each commit in fixed-width tables, so a commit's place in
+    the history can be found without reading it.
+
+    A commit's generation number is always greater than its parents', so
+    walking the history in order of decreasing generation gives a
+    topological order. Since the order of each commit only depends on
+    the commits seen so far, the walk can hand out commits as it goes,
+    unlike rev-list --topo-order, which reads the whole history first.
+    """
+    NO_PARENT = 0x70000000
+
+    def __init__(self, layers):
+        self.layers = layers
+        self.layer_starts = [layer.base_count for layer in layers]
+        self.count = sum([layer.count for layer in layers])
+
+        # Corrected commit dates sort more naturally than topological
+        # levels, but can only be used if every file has them.
+        self.use_corrected_dates = bool(layers) and \
+            not [layer for layer in layers
+                 if not layer.has_generation_data()]
+
+    @classmethod
+    def open(cls, objects_dir):
+        """Opens the commit-graph in an objects directory.
+
+        Returns None if there isn't one, or it can't be read.
+        """
+        info_dir = os.path.join(objects_dir, "info")
+        paths = []
+        chain_path = os.path.join(info_dir, "commit-graphs",
+                                  "commit-graph-chain")
+
+        if os.path.exists(chain_path):
+            try:
+                fp = open(chain_path, "r")
+
+                try:
+                    paths = [os.path.join(info_dir, "commit-graphs",
+                                          "graph-%s.graph" % line.strip())
+                             for line in fp if line.strip()]
+                finally:
+                    fp.close()
+            except IOError:
+                return None
+        elif os.path.exists(os.path.join(info_dir, "commit-graph")):
+            paths = [os.path.join(info_dir, "commit-graph")]
+        else:
+            return None
+
+        layers = []
+        base_count = 0
+
+        try:
+            for path in paths:
+                layer = CommitGraphLayer(path, base_count)
+                layers.append(layer)
+                base_count += layer.count
+        except (IOError, OSError, ValueError, struct.error,
+                mmap.error):
+            for layer in layers:
+                layer.close()
+
+            return None
+
+        return cls(layers)
+
+    def close(self):
+        for layer in self.layers:
+            layer.close()
+
+        self.layers = []
+
+    def find(self, sha1):
+        """Returns the position of a binary SHA-1, or None."""
+        for layer in self.layers:
+            i = layer.find(sha1)
+
+            if i is not None:
+                return layer.base_count + i
+
+        return None
+
+    def get_sha1(self, pos):
+        layer = self.__get_layer(pos)
+
+        return layer.get_sha1(pos - layer.base_count)
+
+    def get_commit(self, pos):
+        """Returns (parents, generation, commit_time) for a position."""
+        layer = self.__get_layer(pos)
+        i = pos - layer.base_count
+        parents, level, commit_time = layer.get_commit_data(i)
+
+        if self.use_corrected_dates:
+            generation = layer.get_corrected_date(i, commit_time)
+        else:
+            generation = level
+
+        return (parents, generation, commit_time)
+
+    def walk(self, positions):
+        """Walks the history from some commits, in topological order.
+
+        Yields the position and parent positions of each commit reachable
+        from the given positions. Commits with the same generation number
+        come out newest first.
+        """
+        seen = array('b', [0]) * self.count
+        heap = []
+
+        for pos in positions:
+            if not seen[pos]:
+                seen[pos] = 1
+                parents, generation, commit_time = self.get_commit(pos)
+                heap.append((-generation, -commit_time, pos, parents))
+
+        heapq.heapify(heap)
+
+        while heap:
+            pos, parents = heapq.heappop(heap)[2:]
+
+            yield pos, parents
+
+            for parent in parents:
+                if not seen[parent]:
+                    seen[parent] = 1
+                    grandparents, generation, commit_time = \
+                        self.get_commit(parent)
+                    heapq.heappush(heap, (-generation, -commit_time,
+                                          parent, grandparents))
+
+    def __get_layer(self, pos):
+        return self.layers[bisect_right(self.layer_starts, pos) - 1]
+
+
+class GraphHistoryWriter(object):
+    """Writes a repository's history the way git rev-list --header would.
+
+    The order comes from the commit-graph, and the commits are read
+    straight from the object store. Commits newer than the commit-graph
+    file are found by walking back from the tips until commits in the
+    file are reached. They're written first, since nothing in the file
+    can descend from them.
+
+    Once the walk has written enough commits to fill the first screen,
+    git rev-list writes the rest of the history, starting from the
+    commits the walk reached but didn't write. It's faster than the walk
+    once it's going, but can't start writing until it has sorted what
+    it's been given.
+
+    This runs in a worker process (see main()), so that none of the
+    reading is done in gitty's own process. The commits in the file are
+    read through git cat-file, which inflates them faster than Python
+    can.
+    """
+    # The amount of output to collect before writing it out.
+    WRITE_SIZE = 64 * 1024
+
+    # The number of commits to write from the commit-graph walk before
+    # handing over to rev-list.
+    WALK_LIMIT = 500
+
+    # The number of commits to ask git cat-file for at a time.
+    REQUEST_BATCH_SIZE = 256
+
+    def __init__(self, path, odb, graph, fp):
+        self.path = path
+        self.odb = odb
+        self.graph = graph
+        self.fp = fp
+        self.batch = None
+        self.buffer = []
+        self.buffer_size = 0
+
+    def close(self):
+        if self.batch:
+            self.batch.close()
+            self.batch = None
+
+    def write(self, tips):
+        """Writes the history reachable from some binary SHA-1s."""
+        positions = []
+
+        for sha1, parents, contents in self.__walk_new(tips, positions):
+            self.__write_record(" ".join([hexlify(sha1)] +
+                                         [hexlify(parent)
+                                          for parent in parents]),
+                                contents)
+
+        rest = self.__write_graph(positions)
+        self.__flush()
+
+        if rest:
+            self.__write_rest(rest)
+
+    def __write_graph(self, positions):
+        """Writes the first commits in the commit-graph file, in order.
+
+        A thread walks the file and asks git cat-file for each commit,
+        while the commits are read back here. That way, git inflates
+        commits while the ones before them are being written out.
+
+        Returns the binary SHA-1s of the commits that the rest of the
+        history is reachable from, if the walk stopped before the end.
+        """
+        process = subprocess.Popen(["git", "cat-file", "--batch"],
+                                   cwd=self.path, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, close_fds=True,
+                                   bufsize=self.WRITE_SIZE)
+
+        # The rev-list header of each commit asked for, in order, and the
+        # commits left unwalked.
+        headers = deque()
+        rest = []
+
+        thread = threading.Thread(target=self.__request_graph,
+                                  args=(positions, process.stdin, headers,
+                                        rest))
+        thread.setDaemon(True)
+        thread.start()
+
+        readline = process.stdout.readline
+        read = process.stdout.read
+
+        while True:
+            line = readline()
+
+            if not line:
+                break
+
+            # Each object is "sha1 type size", followed by its contents
+            # and a newline, or "sha1 missing".
+            info = line.split()
+
+            if len(info) == 3:
+                contents = read(int(info[2]))
+                read(1)
+            else:
+                contents = None
+
+            self.__write_record(headers.popleft(), contents)
+
+        thread.join()
+        process.stdout.close()
+        process.wait()
+
+        return rest
+
+    def __request_graph(self, positions, fp, headers, rest):
+        get_sha1 = self.graph.get_sha1
+
+        # The commits reached but not walked yet. Parents always come
+        # after their children, so none of these have been written, and
+        # none of the commits reachable from them have.
+        pending = set(positions)
+
+        try:
+            for i, (pos, parents) in enumerate(self.graph.walk(positions)):
+                if i == self.WALK_LIMIT:
+                    rest.extend([get_sha1(pending_pos)
+                                 for pending_pos in pending])
+                    break
+
+                pending.discard(pos)
+                pending.update(parents)
+                sha1 = hexlify(get_sha1(pos))
+                headers.append(" ".join([sha1] +
+                                        [hexlify(get_sha1(parent))
+                                         for parent in parents]))
+                fp.write(sha1 + "\n")
+
+                if i % self.REQUEST_BATCH_SIZE == 0:
+                    fp.flush()
+        finally:
+            fp.close()
+
+    def __write_rest(self, sha1s):
+        """Has git rev-list write the history reachable from some commits."""
+        process = subprocess.Popen(["git", "rev-list", "--parents",
+                                    "--header", "--topo-order", "--stdin"],
+                                   cwd=self.path, stdin=subprocess.PIPE,
+                                   stdout=self.fp, close_fds=True)
+        process.communicate("".join([hexlify(sha1) + "\n"
+                                     for sha1 in sha1s]))
+
+        if process.returncode != 0:
+            raise IOError("git rev-list exited with status %d" %
+                          process.returncode)
+
+    def __walk_new(self, tips, positions):
+        """Finds the commits that aren't in the commit-graph file.
+
+        Returns them in topological order, and adds the positions of the
+        commits they lead to in the file to positions.
+        """
+        commits = {}
+        stack = list(tips)
+
+        while stack:
+            sha1 = stack.pop()
+
+            if sha1 in commits:
+                continue
+
+            pos = self.graph.find(sha1)
+
+            if pos is not None:
+                positions.append(pos)
+                continue
+
+            obj = self.__read(sha1)
+
+            if obj is None:
+                commits[sha1] = ([], 0, None)
+            elif obj[0] == "commit":
+                parents, commit_time = self.__parse_header(obj[1])
+                commits[sha1] = (parents, commit_time, obj[1])
+                stack.extend(parents)
+
+        # Children come before their parents, and otherwise newer commits
+        # come first.
+        child_counts = dict.fromkeys(commits, 0)
+
+        for parents, commit_time, contents in commits.itervalues():
+            for parent in parents:
+                if parent in child_counts:
+                    child_counts[parent] += 1
+
+        heap = [(-commits[sha1][1], sha1)
+                for sha1, count in child_counts.iteritems() if not count]
+        heapq.heapify(heap)
+        result = []
+
+        while heap:
+            sha1 = heapq.heappop(heap)[1]
+            parents, commit_time, contents = commits[sha1]
+            result.append((sha1, parents, contents))
+
+            for parent in parents:
+                if parent in child_counts:
+                    child_counts[parent] -= 1
+
+                    if not child_counts[parent]:
+                        heapq.heappush(heap, (-commits[parent][1], parent))
+
+        return result
+
+    def __parse_header(self, contents):
+        """Returns the parents and commit time of a commit."""
+        parents = []
+        commit_time = 0
+
+        for line in contents.split("\n"):
+            if not line:
+                break
+            elif line.startswith("parent "):
+                parents.append(unhexlify(line[7:47]))
+            elif line.startswith("committer "):
+                parts = line.rsplit(" ", 2)
+
+                if len(parts) == 3 and parts[1].isdigit():
+                    commit_time = int(parts[1])
+
+        return parents, commit_time
+
+    def __read(self, sha1):
+        """Returns the (type, contents) of an object, or None."""
+        sha1 = hexlify(sha1)
+        obj = self.odb.read(sha1)
+
+        if obj is None:
+            if self.batch is None:
+                self.batch = CatFileBatch(self.path)
+
+            info = self.batch.request(sha1)
+            obj = info and (info[1], info[3])
+
+        return obj
+
+    def __write_record(self, header, contents):
+        if contents is None:
+            record = header + "\0"
+        else:
+            record = header + "\n" + contents + "\0"
+
+        self.buffer.append(record)
+        self.buffer_size += len(record)
+
+        if self.buffer_size >= self.WRITE_SIZE:
+            self.__flush()
+
+    def __flush(self):
+        self.fp.write("".join(self.buffer))
+        self.fp.flush()
+        self.buffer = []
+        self.buffer_size = 0
+
+
+def main():
+    """Writes a repository's history to stdout from its commit-graph.
+
+    The arguments are the path of the repository and its git directory.
+    The hex SHA-1s of the tips are read from stdin, one per line. If the
+    commit-graph can't be read, git rev-list is run instead.
+    """
+    path, git_dir = sys.argv[1:3]
+    tips = [line.strip() for line in sys.stdin if line.strip()]
+    odb = ObjectDatabase(git_dir)
+    graph = CommitGraphFile.open(odb.objects_dir)
+
+    if graph is None:
+        p = subprocess.Popen(["git", "rev-list", "--parents", "--header",
+                              "--topo-order", "--stdin"],
+                             cwd=path, stdin=subprocess.PIPE)
+        p.communicate("".join([sha1 + "\n" for sha1 in tips]))
+        sys.exit(p.returncode)
+
+    writer = GraphHistoryWriter(path, odb, graph, sys.stdout)
+
+    try:
+        writer.write([unhexlify(sha1) for sha1 in tips])
+    finally:
+        writer.close()
+        graph.close()
+        odb.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,86 +1,122 @@
 import os
-import re
+import subprocess
+import threading
 import time
+from array import array
+from binascii import hexlify, unhexlify
 
-
-re_ident = re.compile(
-    '(author|committer) (?P<ident>.*) (?P<epoch>\d+) (?P<tz>[+-]\d{4})')
+from Gitty.git.cache import CachedCommits, GraphCache
+from Gitty.git.layout import LaneLayout
+from Gitty.git.objects import ObjectDatabase
+from Gitty.git.pipeline import HistoryPipeline, start_worker
+from Gitty.git.pool import ProcessPool
+from Gitty.git.refs import RefReader
 
 
 class Reference(object):
-    def __init__(self, name, commit):
+    def __init__(self, name, commit, sha1=None):
         self.name = name
         self.commit = commit
 
+        # The binary SHA-1 of the commit, which is known even when the
+        # commit hasn't been loaded.
+        self.sha1 = sha1 or commit.sha1
 
-class Commit(object):
-    children_sha1 = {}
-
-    def __init__(self, commit_lines):
-        self.message     = ""
-        self.author      = ""
-        self.date        = ""
-        self.commiter    = ""
-        self.commit_date = ""
-        self.commit_sha1 = ""
-        self.parent_sha1 = []
 
-        self.parse_commit(commit_lines)
+class Commit(object):
+    """A commit in the history.
+
+    There can be hundreds of thousands of these loaded at once, so they're
+    kept small. SHA-1s are stored in binary form, identities are interned,
+    and dates are only formatted when they're asked for.
+    """
+    __slots__ = (
+        'sha1', 'parents', 'message',
+        'author', 'author_time', 'author_tz',
+        'committer', 'committer_time', 'committer_tz',
+        'node', 'in_lines', 'out_lines', 'references', 'ref_boxes',
+    )
+
+    def __init__(self, commit_lines=None):
+        self.message = ""
+        self.author = ""
+        self.author_time = 0
+        self.author_tz = "+0000"
+        self.committer = ""
+        self.committer_time = 0
+        self.committer_tz = "+0000"
+        self.references = ()
+        self.ref_boxes = ()
+
+        if commit_lines is not None:
+            self.parse_commit(commit_lines)
+
+    @classmethod
+    def from_fields(cls, fields):
+        """Creates a commit from the fields returned by get_fields()."""
+        commit = cls.__new__(cls)
+        (commit.sha1, commit.parents, commit.message,
+         commit.author, commit.author_time, commit.author_tz,
+         commit.committer, commit.committer_time, commit.committer_tz) = \
+            fields
+        commit.references = ()
+        commit.ref_boxes = ()
+
+        return commit
+
+    @property
+    def commit_sha1(self):
+        return hexlify(self.sha1)
+
+    @property
+    def parent_sha1(self):
+        return [hexlify(sha1) for sha1 in self.parents] or [0]
+
+    @property
+    def date(self):
+        return self.format_date(self.author_time, self.author_tz)
+
+    @property
+    def commit_date(self):
+        return self.format_date(self.committer_time, self.committer_tz)
 
     def parse_commit(self, commit_lines):
-        line = commit_lines[0].strip()
-        sha1 = line.split(" ")
-        self.commit_sha1 = sha1[0]
-        self.parent_sha1 = sha1[1:] or [0]
-
-        # Build the child list
-        for parent_id in self.parent_sha1:
-            if parent_id not in Commit.children_sha1:
-                Commit.children_sha1[parent_id] = []
+        sha1 = commit_lines[0].split()
+        self.sha1 = unhexlify(sha1[0])
+        self.parents = tuple([unhexlify(parent) for parent in sha1[1:]])
 
-            Commit.children_sha1[parent_id].append(self.commit_sha1)
+        in_headers = True
 
         for line in commit_lines[1:]:
-            if line.startswith(" "):
-                if self.message == "":
-                    self.message = line.strip()
-
-                continue
-
-            if line.startswith("tree") or line.startswith("parent"):
-                continue
-
-            m = re_ident.match(line)
-
-            if m:
-                date = self.format_date(m.group('epoch'), m.group('tz'))
-
-                if m.group(1) == "author":
-                    self.author = m.group('ident')
-                    self.date = date
-                elif m.group(1) == "committer":
-                    self.committer = m.group('ident')
-                    self.commit_date = date
-
-                continue
+            if in_headers:
+                if not line:
+                    in_headers = False
+                elif line.startswith("author "):
+                    self.author, self.author_time, self.author_tz = \
+                        self.parse_ident(line[7:])
+                elif line.startswith("committer "):
+                    self.committer, self.committer_time, self.committer_tz = \
+                        self.parse_ident(line[10:])
+            elif line.strip():
+                # Only the summary line is kept. The full message can be
+                # fetched when needed.
+                self.message = line.strip()
+                break
 
-    def get_message(self, with_diff=False):
-        if with_diff:
-            message = self.diff_tree()
-        else:
-            fp = os.popen("git cat-file commit " + self.commit_sha1)
-            message = fp.read()
-            fp.close()
+    def parse_ident(self, ident):
+        """Parses "Name <email> epoch tz" into (ident, epoch, tz)."""
+        parts = ident.rsplit(" ", 2)
 
-        return message
+        if len(parts) != 3 or not parts[1].isdigit():
+            return (intern(ident), 0, "+0000")
 
-    def diff_tree(self):
-        fp = os.popen("git diff-tree --pretty --cc -v -p --always" +
-                      self.commit_sha1)
-        diff = fp.read()
-        fp.close()
+        return (intern(parts[0]), int(parts[1]), intern(parts[2]))
 
-        return diff
+    def get_fields(self):
+        """Returns the parsed fields, which can be marshalled."""
+        return (self.sha1, self.parents, self.message,
+                self.author, self.author_time, self.author_tz,
+                self.committer, self.committer_time, self.committer_tz)
 
     def format_date(self, epoch, tz):
         secs    = float(epoch)
@@ -95,162 +131,708 @@ class Commit(object):
         return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(secs))
 
 
+def parse_record(record):
+    """Parses a rev-list --header record into a Commit."""
+    return Commit(record.split("\n"))
+
+
+def parse_record_fields(record):
+    """Parses a rev-list --header record into a commit's fields.
+
+    This is run by the history pipeline's worker process.
+    """
+    return Commit(record.split("\n")).get_fields()
+
+
+class LoadedHistory(object):
+    """A history loaded earlier, which new commits can be added above.
+
+    This is either read from the graph cache or, when refreshing, is the
+    history that's currently loaded.
+    """
+    def __init__(self, tips, commits, checkpoints, ordinals=None,
+                 ordinal_offset=0, bt_sha1={}):
+        self.tips = tips
+        self.commits = commits
+        self.checkpoints = checkpoints
+        self.ordinals = ordinals
+        self.ordinal_offset = ordinal_offset
+        self.bt_sha1 = bt_sha1
+
+
 class CommitGraph(object):
-    def __init__(self):
-        self.bt_sha1 = {}
+    # The number of commits between snapshots of the layout state.
+    CHECKPOINT_INTERVAL = 256
 
-        self.colors = {}
-        self.node_pos = {}
-        self.incomplete_line = {}
+    # The number of packed objects past which a full history load parses
+    # commits in a worker process. Below this, starting the worker costs
+    # more than it saves.
+    WORKER_MIN_OBJECTS = 250000
 
-    def update_bt_sha1(self):
+    def __init__(self, path=None, pool=None):
+        self.path = path or os.getcwd()
+        self.pool = pool or ProcessPool()
         self.bt_sha1 = {}
-        ls_remote = re.compile('^(.{40})\trefs/([^^]+)(?:\\^(..))?$');
-        fp = os.popen('git ls-remote "${GIT_DIR-.git}"')
+        self.git_dir = None
+        self.ref_reader = None
+
+        # The SHA-1s of the refs the history was loaded from.
+        self.tips = []
+
+        self.layout = LaneLayout()
+        self.layout_count = 0
+
+        # Snapshots of the layout state, keyed by the ordinal of the commit
+        # they were taken after. These let a relayout stop as soon as it
+        # catches up with an existing layout.
+        self.checkpoints = {}
+
+        # The history loaded earlier, which goes below any commits that
+        # are new since it was loaded, and the number of its commits that
+        # had to be laid out again below them.
+        self.cached = None
+        self.relaid_count = 0
+
+        # Whether the current load is adding new commits above the
+        # currently loaded history, rather than replacing it.
+        self.refreshing = False
+
+        # The rev-list process, and the pipeline reading and parsing its
+        # output.
+        self.process = None
+        self.pipeline = None
+
+        # The pool slot that the load's git processes run under, which is
+        # held until it's finished or cancelled.
+        self.slot = None
+
+        # The repository's object store, for its size.
+        self.odb = None
+
+        # Whether the history being loaded should be cached once it's
+        # read, and the thread saving the last one.
+        self.save_pending = False
+        self.save_thread = None
+
+        # Whether a load is under way, and whether the loaded commits are
+        # the whole history. A load that's stopped early or that git
+        # fails leaves part of the history loaded, which mustn't be
+        # cached or refreshed from.
+        self.loading = False
+        self.complete = False
+        self.load_failed = False
+
+        # The last commit read. It's laid out once the commit after it is
+        # known.
+        self.pending = None
+
+        # The loaded commits, in order. A commit's position in this list
+        # is its ordinal. The ordinals map stores each ordinal minus
+        # ordinal_offset, so that commits can be added to the top without
+        # renumbering everything below them.
+        self.commits = []
+        self.ordinals = {}
+        self.ordinal_offset = 0
+
+        # The child index, in compressed sparse row form. The children of
+        # the commit with ordinal i are the ordinals in
+        # child_ordinals[child_offsets[i]:child_offsets[i + 1]].
+        # It's extended to cover the commits loaded since it was last
+        # used, and thrown away when commits are added above the loaded
+        # ones. child_waiting holds the ordinals of the indexed commits
+        # whose parents haven't been indexed yet, by the parent's SHA-1.
+        self.child_offsets = None
+        self.child_ordinals = None
+        self.child_waiting = None
+
+    def close(self):
+        """Stops any load and lets go of the repository's processes."""
+        self.cancel_load()
+        self.__wait_for_save()
+
+        if self.odb:
+            self.odb.close()
+            self.odb = None
+
+        if self.ref_reader:
+            self.ref_reader.close()
+            self.ref_reader = None
 
-        while True:
-            line = fp.readline().strip()
+    def update_bt_sha1(self):
+        if self.ref_reader is None:
+            self.ref_reader = RefReader(self.get_git_dir(), self.path,
+                                        self.pool)
+
+        self.bt_sha1 = self.ref_reader.read(self.slot)
+
+    def get_git_dir(self):
+        if self.git_dir is None:
+            output = self.pool.run(self.path, ["rev-parse", "--git-dir"],
+                                   slot=self.slot)
+            self.git_dir = os.path.abspath(os.path.join(self.path,
+                                                        output.strip()))
+
+        return self.git_dir
+
+    def get_cache(self):
+        return GraphCache(os.path.join(self.get_git_dir(), "gitty",
+                                       "graph-cache"),
+                          Commit)
+
+    def start_load(self, refresh=False, slot=None):
+        """Starts loading the commit history.
+
+        If refresh is True and the whole history has been loaded, only the
+        commits that are new since then are read, and are added above the
+        loaded ones. Otherwise, if there's a cache of the history, only
+        the commits that are new since it was written are read from git.
+        If the whole history has to be read and the repository has a
+        commit-graph file, a worker process walks that for the first
+        commits, so they arrive without waiting for the whole history to
+        be sorted, and leaves the rest to rev-list.
+
+        self.refreshing is set to whether new commits are being added to
+        the loaded history. If it's False, the history is being replaced.
+
+        git runs under slot, a slot from the pool that the load keeps
+        until it's finished or cancelled. The main loop can't wait for
+        one, so it should ask the pool for one first. If slot is None,
+        this waits for one.
+
+        Returns the HistoryPipeline reading the history, or None if
+        nothing needs to be read. read_pipeline() should be called until
+        it returns None, whenever the pipeline has commits ready,
+        followed by a call to finish_load().
+        """
+        cached = None
+
+        if refresh and self.commits and self.complete:
+            cached = LoadedHistory(self.tips, self.commits, self.checkpoints,
+                                   self.ordinals, self.ordinal_offset,
+                                   self.bt_sha1)
+
+        self.cancel_load()
+
+        # The history being saved is about to be replaced, and a refresh
+        # lays out some of its commits again.
+        self.__wait_for_save()
+
+        if slot is None:
+            slot = self.pool.acquire_slot(self.path)
+
+        self.slot = slot
+        self.loading = True
+        self.complete = False
+        self.update_bt_sha1()
 
-            if line == "":
-                break
+        self.commits = []
+        self.ordinals = {}
+        self.ordinal_offset = 0
+        self.checkpoints = {}
+        self.__clear_child_index()
+        self.__reset()
+
+        # A detached HEAD is part of the history too, as it is for
+        # rev-list --all.
+        tips = set([unhexlify(sha1) for sha1 in self.bt_sha1])
+        head = self.__get_detached_head()
+
+        if head:
+            tips.add(head)
+
+        self.tips = sorted(tips)
+
+        args = ["rev-list", "--parents", "--header", "--topo-order"]
+        revs = None
+
+        if not cached:
+            data = self.get_cache().load()
+
+            if data:
+                cached = LoadedHistory(*data)
+
+        if cached:
+            if cached.tips == self.tips:
+                self.cached = cached
+                self.refreshing = refresh
+                return None
+
+            if self.__is_reachable(set(cached.tips) - set(self.tips)):
+                # Everything loaded before is still part of the history,
+                # so only the new commits need to be read.
+                self.cached = cached
+                self.refreshing = refresh
+                revs = [hexlify(sha1) for sha1 in self.tips] + \
+                       ["^" + hexlify(sha1) for sha1 in cached.tips]
+
+        self.save_pending = True
+        full_load = revs is None
+
+        if full_load and self.__has_commit_graph():
+            # The commit-graph gives the order of the commits without
+            # reading the whole history first, so they start arriving
+            # right away. It's walked in a worker process, which writes
+            # the history out the way rev-list would, and which runs under
+            # the load's slot in its place.
+            self.process = start_worker("Gitty.git.commitgraph",
+                                        [self.path, self.get_git_dir()],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+            revs = [hexlify(sha1) for sha1 in self.tips]
+        else:
+            if full_load:
+                args.append("--all")
+            else:
+                args.append("--stdin")
 
-            m = ls_remote.match(line)
+            self.process = self.pool.popen(self.path, args, slot=self.slot,
+                                           stdin=subprocess.PIPE,
+                                           stdout=subprocess.PIPE)
 
-            if m:
-                sha1 = m.group(1)
-                name = m.group(2)
+        if revs:
+            self.process.stdin.write("\n".join(revs) + "\n")
 
-                if sha1 not in self.bt_sha1:
-                    self.bt_sha1[sha1] = []
+        self.process.stdin.close()
 
-                self.bt_sha1[sha1].append(name)
+        if full_load and self.__is_large():
+            self.pipeline = HistoryPipeline(
+                self.process.stdout, parse_record,
+                worker_func="Gitty.git.commits:parse_record_fields",
+                build_func=Commit.from_fields)
+        else:
+            self.pipeline = HistoryPipeline(self.process.stdout,
+                                            parse_record)
 
-        fp.close()
+        return self.pipeline
 
-    def get_commits(self):
-        self.update_bt_sha1()
+    def read_pipeline(self, wait=False):
+        """Lays out the next batch of commits read by the pipeline.
 
-        index = 0
-        last_color = 0
-        last_node_pos = -1
-        out_lines = []
+        Returns the commits laid out, which may be none if the pipeline
+        has nothing ready. If wait is True, this waits for a batch.
+        Once the whole history has been read, None is returned.
+        """
+        commits = self.pipeline.get(wait)
 
-        fp = os.popen("git rev-list --parents --all --header --topo-order")
+        if commits is None:
+            return None
 
-        commit_lines = []
+        return self.__add_commits(commits)
 
-        for input_line in fp.xreadlines():
-            # The commit header ends with '\0'.
-            # This NUL is immediately folllowed by the sha1 of the
-            # next commit.
-            if input_line[0] != '\0':
-                commit_lines.append(input_line)
-            else:
-                commit = Commit(commit_lines)
+    def finish_load(self):
+        """Finishes loading, returning any remaining commits."""
+        commits = []
+
+        if self.cached:
+            commits += self.__add_cached_commits()
+        elif self.pending:
+            self.make_graph(self.pending, None)
+            commits.append(self.pending)
+
+        if self.process:
+            self.__finish_process()
+
+        self.__release_slot()
+        self.loading = False
+        self.complete = not self.load_failed
+
+        if self.save_pending and self.complete:
+            self.save_cache()
+
+        self.__reset()
+
+        return commits
+
+    def save_cache(self):
+        """Saves the loaded history to the cache in a thread.
+
+        If the history was added to one that's in the cache, only the new
+        commits, and the old ones whose layout they changed, are added to
+        it. Otherwise the whole history is written out, which takes long
+        enough that it can't be done on the main loop.
+        """
+        base_tips = None
+        count = None
+
+        if self.cached and self.relaid_count < len(self.cached.commits):
+            base_tips = self.cached.tips
+            count = len(self.commits) - len(self.cached.commits) + \
+                    self.relaid_count
+
+        # Commits read from the cache are only created as they're needed,
+        # so the thread gets a copy to create them in.
+        if isinstance(self.commits, CachedCommits):
+            commits = self.commits.copy()
+        else:
+            commits = list(self.commits)
+
+        self.__wait_for_save()
+        self.save_thread = threading.Thread(
+            target=self.__write_cache,
+            args=(self.get_cache(), self.tips, commits,
+                  dict(self.checkpoints), base_tips, count,
+                  self.relaid_count))
+        self.save_thread.start()
+
+    def cancel_load(self):
+        if self.process:
+            if self.process.poll() is None:
+                self.process.kill()
+
+            # The pipeline's threads have to finish with the process's
+            # output before it's closed.
+            self.pipeline.close()
+            self.process.stdout.close()
+            self.process.wait()
+            self.pool.release(self.process, self.pipeline.bytes_read)
+            self.process = None
+            self.pipeline = None
+
+        self.__release_slot()
+
+        if self.loading:
+            # A refresh goes back to the whole history it started from.
+            # Otherwise, only part of the history is loaded.
+            self.complete = self.refreshing
+            self.loading = False
+
+        if self.refreshing:
+            # Go back to the history we had before the refresh.
+            cached = self.cached
+            self.tips = cached.tips
+            self.commits = cached.commits
+            self.checkpoints = cached.checkpoints
+            self.ordinals = cached.ordinals
+            self.ordinal_offset = cached.ordinal_offset
+            self.bt_sha1 = cached.bt_sha1
+            self.__clear_child_index()
+
+        self.__reset()
 
-                out_lines, last_color, last_node_pos = \
-                    self.make_graph(commit, index, out_lines, last_color,
-                                    last_node_pos)
-                index += 1
+    def get_commits(self):
+        pipeline = self.start_load()
+
+        while pipeline:
+            commits = self.read_pipeline(True)
+
+            if commits is None:
+                break
 
+            for commit in commits:
                 yield commit
 
-                # Skip the '\0'
-                commit_lines = [input_line[1:]]
+        for commit in self.finish_load():
+            yield commit
 
-        fp.close()
+    def get_ordinal(self, sha1):
+        """Returns the ordinal of a loaded commit, or None."""
+        ordinal = self.ordinals.get(sha1)
 
-        # Reset so we don't have to store this data.
-        self.colors = {}
-        self.node_pos = {}
-        self.incomplete_line = {}
+        if ordinal is None:
+            return None
 
+        return ordinal + self.ordinal_offset
 
-    def make_graph(self, commit, index, out_lines, last_color, last_node_pos):
-        in_lines = []
+    def get_commit(self, sha1):
+        """Returns a loaded commit by its binary SHA-1, or None."""
+        ordinal = self.get_ordinal(sha1)
 
-        #   |   -> out_line
-        #   X
-        #   |\  <- in_line
+        if ordinal is None:
+            return None
 
-        # Add the incomplete lines of the last call in this
-        if commit.commit_sha1 not in self.colors:
-            last_color = self.colors[commit.commit_sha1] = last_color + 1
+        return self.commits[ordinal]
 
-        color = self.colors[commit.commit_sha1]
+    def get_references(self):
+        """Returns (ordinal, reference) pairs for the loaded references."""
+        result = []
 
-        if commit.commit_sha1 not in self.node_pos:
-            last_node_pos = self.node_pos[commit.commit_sha1] = \
-                last_node_pos + 1
+        for sha1 in self.bt_sha1:
+            ordinal = self.get_ordinal(unhexlify(sha1))
 
-        node_pos = self.node_pos[commit.commit_sha1]
+            if ordinal is not None:
+                for ref in self.commits[ordinal].references:
+                    result.append((ordinal, ref))
 
-        # The first parent always continues on the same line
-        key = commit.parent_sha1[0]
+        return result
 
-        if key not in self.node_pos:
-            self.colors[key] = color
-            self.node_pos[key] = node_pos
+    def get_children(self, commit):
+        """Returns the loaded children of a commit."""
+        ordinal = self.get_ordinal(commit.sha1)
 
-        for sha1 in self.incomplete_line.keys():
-            if sha1 != commit.commit_sha1:
-                self.make_incomplete_line(sha1, node_pos, out_lines,
-                                          in_lines, index)
-            else:
-                del self.incomplete_line[sha1]
+        if ordinal is None:
+            return []
+
+        self.__update_child_index()
+
+        start = self.child_offsets[ordinal]
+        end = self.child_offsets[ordinal + 1]
+
+        return [self.commits[i] for i in self.child_ordinals[start:end]]
+
+    def __update_child_index(self):
+        """Adds the commits loaded since the child index was last used.
+
+        Commits are loaded children first, so all of a commit's children
+        are known by the time it's added. Commits from the cache are
+        indexed without creating them.
+        """
+        if self.child_offsets is None:
+            self.child_offsets = array('i', [0])
+            self.child_ordinals = array('i')
+            self.child_waiting = {}
+
+        offsets = self.child_offsets
+        children = self.child_ordinals
+        waiting = self.child_waiting
+        commits = self.commits
+
+        if isinstance(commits, CachedCommits):
+            get_sha1 = commits.get_sha1
+            get_parents = commits.get_parents
+        else:
+            get_sha1 = lambda i: commits[i].sha1
+            get_parents = lambda i: commits[i].parents
+
+        for ordinal in xrange(len(offsets) - 1, len(commits)):
+            children.extend(waiting.pop(get_sha1(ordinal), ()))
+            offsets.append(len(children))
+
+            for parent in get_parents(ordinal):
+                waiting.setdefault(parent, []).append(ordinal)
+
+    def __clear_child_index(self):
+        self.child_offsets = None
+        self.child_ordinals = None
+        self.child_waiting = None
+
+    def make_graph(self, commit, next_sha1):
+        """Lays out a commit in the graph and attaches its references.
+
+        next_sha1 is the binary SHA-1 of the commit following it in the
+        history, or None if it's the last.
+        """
+        self.layout.add(commit, next_sha1)
+
+        if (self.layout_count % self.CHECKPOINT_INTERVAL ==
+            self.CHECKPOINT_INTERVAL - 1):
+            self.checkpoints[self.layout_count] = self.layout.get_state()
+
+        self.layout_count += 1
+
+        refs = self.bt_sha1.get(commit.commit_sha1)
 
-        for parent_id in commit.parent_sha1:
-            if parent_id not in self.node_pos:
-                last_color = self.colors[parent_id] = last_color + 1
-                last_node_pos = self.node_pos[parent_id] = \
-                    last_node_pos + 1
+        if refs:
+            commit.references = [Reference(ref, commit) for ref in refs]
+
+    def __has_commit_graph(self):
+        """Returns whether the history can be read from a commit-graph."""
+        common_dir = self.ref_reader.refs_dir
+        info_dir = os.path.join(common_dir, "objects", "info")
+
+        # Git doesn't use the commit-graph when parents can be rewritten.
+        if (os.path.exists(os.path.join(common_dir, "shallow")) or
+            os.path.exists(os.path.join(info_dir, "grafts"))):
+            return False
+
+        for names in self.bt_sha1.itervalues():
+            for name in names:
+                if name.startswith("replace/"):
+                    return False
+
+        return (os.path.exists(os.path.join(info_dir, "commit-graph")) or
+                os.path.exists(os.path.join(info_dir, "commit-graphs",
+                                            "commit-graph-chain")))
+
+    def __get_detached_head(self):
+        try:
+            fp = open(os.path.join(self.get_git_dir(), "HEAD"), "r")
+        except IOError:
+            return None
+
+        try:
+            contents = fp.read().strip()
+        finally:
+            fp.close()
+
+        if len(contents) == 40:
+            try:
+                return unhexlify(contents)
+            except TypeError:
+                pass
+
+        return None
+
+    def __write_cache(self, cache, tips, commits, checkpoints, base_tips,
+                      count, skip):
+        try:
+            if base_tips is not None:
+                top_checkpoints = dict([(ordinal, state) for ordinal, state
+                                        in checkpoints.iteritems()
+                                        if ordinal < count])
+
+                if cache.append(base_tips, tips, commits[:count],
+                                top_checkpoints, skip):
+                    return
+
+            cache.save(tips, commits, checkpoints)
+        except (IOError, OSError):
+            # The cache is only an optimization.
+            pass
+
+    def __wait_for_save(self):
+        if self.save_thread:
+            self.save_thread.join()
+            self.save_thread = None
+
+    def __finish_process(self):
+        self.pipeline.close()
+        self.process.stdout.close()
+
+        if self.process.wait() != 0 or not self.pipeline.completed:
+            self.load_failed = True
+
+        self.pool.release(self.process, self.pipeline.bytes_read)
+        self.process = None
+        self.pipeline = None
+
+    def __release_slot(self):
+        if self.slot:
+            self.pool.release_slot(self.slot)
+            self.slot = None
+
+    def __is_large(self):
+        """Returns whether the repository has a large history to parse."""
+        if self.odb is None:
+            self.odb = ObjectDatabase(self.get_git_dir())
+
+        return self.odb.count_packed() >= self.WORKER_MIN_OBJECTS
+
+    def __is_reachable(self, sha1s):
+        """Returns whether the commits are all reachable from the tips."""
+        if not sha1s:
+            return True
+
+        p = self.pool.popen(self.path, ["rev-list", "-n", "1", "--stdin"],
+                            slot=self.slot,
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+        revs = [hexlify(sha1) for sha1 in sha1s] + \
+               ["^" + hexlify(sha1) for sha1 in self.tips]
+
+        try:
+            output = p.communicate("\n".join(revs) + "\n")[0]
+        finally:
+            self.pool.release(p)
+
+        return p.returncode == 0 and not output.strip()
+
+    def __add_cached_commits(self):
+        cached = self.cached
+        new_commits = self.commits
+        old_commits = cached.commits
+        base = len(new_commits)
+
+        # Put the new commits' ordinals into the existing map, so the
+        # cost of adding them depends only on how many there are.
+        if cached.ordinals is None:
+            ordinals = {}
+
+            for i, commit in enumerate(old_commits):
+                ordinals[commit.sha1] = i
+
+            offset = base
+        else:
+            ordinals = cached.ordinals
+            offset = cached.ordinal_offset + base
+
+        for i, commit in enumerate(new_commits):
+            ordinals[commit.sha1] = i - offset
+
+        self.ordinals = ordinals
+        self.ordinal_offset = offset
+        self.commits = new_commits + old_commits
+        self.__clear_child_index()
+
+        for sha1 in cached.bt_sha1:
+            commit = self.get_commit(unhexlify(sha1))
+
+            if commit:
+                commit.references = ()
+
+        if self.pending:
+            # The new commits go above the old ones. That changes the
+            # layout of the old commits, but only until the lanes match
+            # one of the old checkpoints again. Everything after that is
+            # laid out the same as before.
+            commits = [self.pending]
+
+            if old_commits:
+                self.make_graph(self.pending, old_commits[0].sha1)
             else:
-                last_node_pos = self.node_pos[parent_id]
+                self.make_graph(self.pending, None)
 
-            in_lines.append((node_pos, self.node_pos[parent_id],
-                             self.colors[parent_id]))
-            self.add_incomplete_line(parent_id)
+            self.relaid_count = len(old_commits)
 
-        commit.node = (node_pos, color)
-        commit.references = [
-            Reference(ref, commit)
-            for ref in self.bt_sha1.get(commit.commit_sha1, [])
-        ]
+            for i, commit in enumerate(old_commits):
+                if i + 1 < len(old_commits):
+                    next_sha1 = old_commits[i + 1].sha1
+                else:
+                    next_sha1 = None
 
-        # This is actually not wrong. The commit's out lines are the in lines
-        # we processed, and vice-versa.
-        commit.out_lines = in_lines
-        commit.in_lines = out_lines
+                self.make_graph(commit, next_sha1)
 
-        return (in_lines, last_color, last_node_pos)
+                state = cached.checkpoints.get(i)
 
-    def add_incomplete_line(self, sha1):
-        if sha1 not in self.incomplete_line:
-            self.incomplete_line[sha1] = []
+                if state is not None and state == self.layout.get_state():
+                    if next_sha1:
+                        old_commits[i + 1].in_lines = self.layout.out_lines
 
-        self.incomplete_line[sha1].append(self.node_pos[sha1])
+                    for ordinal, state in cached.checkpoints.iteritems():
+                        if ordinal > i:
+                            self.checkpoints[base + ordinal] = state
 
-    def make_incomplete_line(self, sha1, node_pos, out_lines, in_lines, index):
-        for idx, pos in enumerate(self.incomplete_line[sha1]):
-            if pos == node_pos:
-                # Remove the straight line and add a slash
-                line = (pos, pos, self.colors[sha1])
+                    self.relaid_count = i + 1
+                    break
+        else:
+            commits = []
+            self.checkpoints = cached.checkpoints
 
-                if line in out_lines:
-                    out_lines.remove(line)
+        for sha1, refs in self.bt_sha1.iteritems():
+            commit = self.get_commit(unhexlify(sha1))
 
-                out_lines.append((pos, pos + 0.5, self.colors[sha1]))
-                self.incomplete_line[sha1][idx] = pos = pos + 0.5
+            if commit:
+                commit.references = [Reference(ref, commit) for ref in refs]
 
-            next_index = index + 1
+        if self.refreshing:
+            # The old commits have already been handed out.
+            return commits
+        else:
+            return commits + old_commits
 
-#            if len(self.commits) > next_index + 1:
-#                next_commit = self.commits[next_index]
-#
-#                if next_commit.commit_sha1 == sha1 and pos != int(pos):
-#                    # Join the line back to the node point.
-#                    # This needs to be done only if we modified it.
-#                    in_lines.append((pos, pos - 0.5, self.colors[sha1]))
-#                    continue
+    def __add_commits(self, commits):
+        laid_out = []
 
-            in_lines.append((pos, pos, self.colors[sha1]))
+        for commit in commits:
+            self.ordinals[commit.sha1] = \
+                len(self.commits) - self.ordinal_offset
+            self.commits.append(commit)
+
+            if self.pending:
+                self.make_graph(self.pending, commit.sha1)
+                laid_out.append(self.pending)
+
+            self.pending = commit
+
+        return laid_out
+
+    def __reset(self):
+        # Reset so we don't have to store this data.
+        self.pending = None
+        self.cached = None
+        self.relaid_count = 0
+        self.refreshing = False
+        self.layout.reset()
+        self.layout_count = 0
+        self.save_pending = False
+        self.load_failed = False
@@ -1,12 +1,137 @@
-import os
+import re
+from array import array
+
+from Gitty.tracing import tracer
+
+
+def to_utf8(data, encoding="utf-8"):
+    """Converts text in the given encoding to UTF-8.
+
+    Bytes that aren't valid in the encoding are replaced, rather than
+    failing the whole conversion. Valid UTF-8 is returned as it is.
+    """
+    span = tracer.span("unicode", "to_utf8", encoding=encoding)
+    span.bytes = len(data)
+
+    try:
+        try:
+            if encoding.lower() in ("utf-8", "utf8"):
+                unicode(data, "utf-8")
+                return data
+
+            return unicode(data, encoding).encode("utf-8")
+        except LookupError:
+            encoding = "utf-8"
+        except UnicodeError:
+            pass
+
+        return unicode(data, encoding, "replace").encode("utf-8")
+    finally:
+        span.finish()
+
+
+def find_chunk_end(text, start, end, size):
+    """Returns where a chunk of about size bytes of text[start:end] ends.
+
+    Chunks end after a newline where there is one, and never split up a
+    multi-byte UTF-8 character. A chunk always holds at least one
+    character, even if it's longer than size.
+    """
+    if end - start <= size:
+        return end
+
+    chunk_end = text.rfind("\n", start, start + size) + 1
+
+    if chunk_end > start:
+        return chunk_end
+
+    # Back up to the start of the character the chunk would end inside.
+    chunk_end = start + size
+
+    while chunk_end > start and (ord(text[chunk_end]) & 0xC0) == 0x80:
+        chunk_end -= 1
+
+    if chunk_end == start:
+        # The first character doesn't fit, so the chunk is just that
+        # character.
+        chunk_end += 1
+
+        while chunk_end < end and (ord(text[chunk_end]) & 0xC0) == 0x80:
+            chunk_end += 1
+
+    return chunk_end
 
 
 class Diff(object):
-    def __init__(self, commit_sha1, parent_sha1):
-        self.commit_sha1 = None
-        self.parent_sha1 = None
+    """A diff, as the raw bytes git output it.
+
+    The bytes are kept in a single string and only decoded a piece at a
+    time, as they're shown. The positions of the files and hunks in the
+    diff are indexed the first time they're asked for.
+    """
+    BOUNDARY_RE = re.compile(r"^(?:diff |@@ )", re.M)
+
+    def __init__(self, data, encoding="utf-8"):
+        self.data = data
+        self.encoding = encoding
+
+        # The offsets of the start of each file, followed by the end of
+        # the diff. file_hunks[i] is the index in hunk_offsets of the
+        # first hunk of file i.
+        self.file_offsets = None
+        self.file_hunks = None
+        self.hunk_offsets = None
+
+    def __len__(self):
+        return len(self.data)
+
+    def get_files(self):
+        """Returns the (start, end) offsets of each file in the diff."""
+        self.__build_index()
+        offsets = self.file_offsets
+
+        return [(offsets[i], offsets[i + 1])
+                for i in xrange(len(offsets) - 1)]
+
+    def get_hunks(self, file_index):
+        """Returns the (start, end) offsets of each hunk in a file."""
+        self.__build_index()
+        first = self.file_hunks[file_index]
+        last = self.file_hunks[file_index + 1]
+        end = self.file_offsets[file_index + 1]
+        offsets = list(self.hunk_offsets[first:last]) + [end]
+
+        return [(offsets[i], offsets[i + 1])
+                for i in xrange(len(offsets) - 1)]
+
+    def get_text(self, start=0, end=None):
+        """Returns part of the diff as UTF-8."""
+        if end is None:
+            end = len(self.data)
+
+        return to_utf8(self.data[start:end], self.encoding)
+
+    def __build_index(self):
+        if self.file_offsets is not None:
+            return
+
+        data = self.data
+        file_offsets = array('l')
+        file_hunks = array('l')
+        hunk_offsets = array('l')
+
+        for m in self.BOUNDARY_RE.finditer(data):
+            pos = m.start()
 
+            if data.startswith("diff ", pos):
+                file_offsets.append(pos)
+                file_hunks.append(len(hunk_offsets))
+            elif file_offsets:
+                hunk_offsets.append(pos)
 
+        file_offsets.append(len(data))
+        file_hunks.append(len(hunk_offsets))
 
-    def __unicode__(self):
-        return self.contents
+        self.file_offsets = file_offsets
+        self.file_hunks = file_hunks
+        self.hunk_offsets = hunk_offsets
@@ -0,0 +1,187 @@
+import json
+import os
+import struct
+import subprocess
+from binascii import unhexlify
+
+from Gitty.git.layout import LaneLayout
+from Gitty.git.pool import ProcessPool
+from Gitty.git.refs import RefReader
+
+
+class LayoutRow(object):
+    """A commit being laid out. SHA-1s are kept in hex."""
+    __slots__ = ('sha1', 'parents', 'node', 'in_lines', 'out_lines')
+
+    def __init__(self, sha1, parents):
+        self.sha1 = sha1
+        self.parents = parents
+
+
+class HexLaneLayout(LaneLayout):
+    """A LaneLayout of commits with hex SHA-1s.
+
+    Colors are the same as for binary SHA-1s, so they match the ones
+    gitty shows.
+    """
+    def get_color(self, sha1):
+        return int(sha1[:2], 16)
+
+
+class LayoutStream(object):
+    """Lays out a repository's history without keeping it in memory.
+
+    The history is read from git rev-list a line at a time, and each
+    commit is handed out as soon as the commit after it is known, which
+    is all the layout needs. Only the active lanes are kept, so memory
+    use doesn't grow with the length of the history.
+
+    Iterating yields a tuple of (sha1, parents, node, in_lines,
+    out_lines, refs) for each commit, in order, with the same values as
+    the Commit attributes of the same names. SHA-1s are in hex, and refs
+    is a list of ref names without the "refs/" prefix.
+    """
+    def __init__(self, path, revs=None, date_order=False, pool=None):
+        self.path = path
+        self.revs = revs or ["--all"]
+        self.date_order = date_order
+        self.pool = pool or ProcessPool()
+
+    def __iter__(self):
+        output = self.pool.run(self.path, ["rev-parse", "--git-dir"])
+        git_dir = os.path.join(self.path, output.strip())
+        reader = RefReader(git_dir, self.path, self.pool)
+
+        try:
+            refs = reader.read()
+        finally:
+            reader.close()
+
+        # Both orders list children before parents, which the layout
+        # needs. Date order doesn't have to read the whole history first.
+        if self.date_order:
+            order = "--date-order"
+        else:
+            order = "--topo-order"
+
+        process = self.pool.popen(self.path,
+                                  ["rev-list", "--parents", order] +
+                                  self.revs,
+                                  stdout=subprocess.PIPE)
+        layout = HexLaneLayout()
+        pending = None
+        bytes_read = 0
+
+        try:
+            for line in process.stdout:
+                bytes_read += len(line)
+                shas = line.split()
+
+                if not shas:
+                    continue
+
+                row = LayoutRow(shas[0], shas[1:])
+
+                if pending:
+                    layout.add(pending, row.sha1)
+                    yield (pending.sha1, pending.parents, pending.node,
+                           pending.in_lines, pending.out_lines,
+                           refs.get(pending.sha1, ()))
+
+                pending = row
+
+            if pending:
+                layout.add(pending, None)
+                yield (pending.sha1, pending.parents, pending.node,
+                       pending.in_lines, pending.out_lines,
+                       refs.get(pending.sha1, ()))
+        finally:
+            if process.poll() is None:
+                process.kill()
+
+            process.stdout.close()
+            process.wait()
+            self.pool.release(process, bytes_read)
+
+        if process.returncode != 0:
+            raise IOError("git rev-list exited with status %d" %
+                          process.returncode)
+
+
+def write_ndjson(rows, fp):
+    """Writes layout rows as newline-delimited JSON.
+
+    Each line is an object with "sha1", "parents", "column", "color",
+    "in", "out" and "refs" keys. "in" and "out" are lists of
+    [start, end, color] lines.
+    """
+    last_lines = None
+    last_text = "[]"
+
+    for sha1, parents, node, in_lines, out_lines, refs in rows:
+        # A row's in_lines are the previous row's out_lines, so they're
+        # only formatted once.
+        if in_lines is last_lines:
+            in_text = last_text
+        else:
+            in_text = format_lines(in_lines)
+
+        out_text = format_lines(out_lines)
+        last_lines = out_lines
+        last_text = out_text
+
+        if refs:
+            refs_text = json.dumps(refs)
+        else:
+            refs_text = "[]"
+
+        fp.write('{"sha1":"%s","parents":[%s],"column":%d,"color":%d,'
+                 '"in":%s,"out":%s,"refs":%s}\n' %
+                 (sha1, ",".join(['"%s"' % parent for parent in parents]),
+                  node[0], node[1], in_text, out_text, refs_text))
+
+
+def format_lines(lines):
+    return "[%s]" % ",".join(["[%d,%d,%d]" % line for line in lines])
+
+
+BINARY_MAGIC = "GLAY"
+BINARY_VERSION = 1
+
+
+def write_binary(rows, fp):
+    """Writes layout rows in a compact binary format.
+
+    The stream starts with "GLAY" and a version byte. Each row is then:
+
+        20 bytes    the binary SHA-1
+        uint16      the node's column
+        uint8       the node's color
+        uint8       the number of parents
+        uint16      the number of out lines
+        uint16      the number of refs
+        20 bytes    for each parent, its binary SHA-1
+        5 bytes     for each out line, its start and end as uint16s and
+                    its color as a uint8
+        for each ref, a uint16 length and the UTF-8 name
+
+    Everything is little-endian. A row's in lines aren't stored, since
+    they're the previous row's out lines.
+    """
+    fp.write(BINARY_MAGIC + chr(BINARY_VERSION))
+
+    pack_row = struct.Struct("<20sHBBHH").pack
+    pack_line = struct.Struct("<HHB").pack
+    pack_length = struct.Struct("<H").pack
+
+    for sha1, parents, node, in_lines, out_lines, refs in rows:
+        parts = [pack_row(unhexlify(sha1), node[0], node[1], len(parents),
+                          len(out_lines), len(refs))]
+        parts.extend([unhexlify(parent) for parent in parents])
+        parts.extend([pack_line(*line) for line in out_lines])
+
+        for ref in refs:
+            parts.append(pack_length(len(ref)))
+            parts.append(ref)
+
+        fp.write("".join(parts))
@@ -0,0 +1,132 @@
+class LaneLayout(object):
+    """Assigns commits to columns ("lanes") in the history graph.
+
+    Commits must be added in topological order (children before parents).
+    The layout keeps an array of active lanes, each holding the SHA-1 of
+    the commit its line is heading to. Lanes are freed as soon as their
+    line reaches its commit, and freed columns are reused, so the graph
+    only grows as wide as the number of lines running side by side.
+
+    Each commit gets the attributes used by CommitCellRenderer:
+
+        node      - (column, color) of the commit's node.
+        in_lines  - (start, end, color) lines from the previous row.
+        out_lines - (start, end, color) lines to the next row.
+
+    A commit's in_lines are the previous commit's out_lines.
+
+    Colors are derived from the SHA-1 of the commit a lane starts at,
+    so a lane gets the same color no matter where in the history
+    it's laid out.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lanes = []
+        self.colors = []
+        self.out_lines = []
+
+    def add(self, commit, next_sha1):
+        """Lays out a commit.
+
+        next_sha1 is the binary SHA-1 of the commit that will be added
+        next, or None if this is the last one. Lines heading to it are
+        joined up in this row so they meet at its node.
+        """
+        lanes = self.lanes
+        colors = self.colors
+        sha1 = commit.sha1
+
+        if sha1 in lanes:
+            column = lanes.index(sha1)
+            color = colors[column]
+
+            # The line heading to this commit ends at its node.
+            lanes[column] = None
+        else:
+            # Nothing leads to this commit. It starts a new lane.
+            column = self.__alloc_lane()
+            color = self.get_color(sha1)
+
+        parent_columns = []
+
+        # The lanes started in this row for the commit's other parents.
+        # Any other lane was already running through it.
+        new_columns = []
+
+        if commit.parents:
+            # The first parent always continues on the commit's own lane.
+            lanes[column] = commit.parents[0]
+            colors[column] = color
+            parent_columns.append(column)
+
+            for parent in commit.parents[1:]:
+                if parent in lanes:
+                    parent_column = lanes.index(parent)
+                else:
+                    parent_column = self.__alloc_lane()
+                    lanes[parent_column] = parent
+                    colors[parent_column] = self.get_color(parent)
+                    new_columns.append(parent_column)
+
+                parent_columns.append(parent_column)
+
+        # Lines heading to the next commit are joined into its column now,
+        # so that they all meet at its node in the next row.
+        ends = range(len(lanes))
+        joined = []
+
+        if next_sha1 is not None and next_sha1 in lanes:
+            next_column = i = lanes.index(next_sha1)
+
+            try:
+                while True:
+                    i = lanes.index(next_sha1, i + 1)
+                    ends[i] = next_column
+                    joined.append(i)
+            except ValueError:
+                pass
+
+        out_lines = [
+            (column, ends[i], colors[i])
+            for i in parent_columns
+        ]
+        out_lines.extend([
+            (i, ends[i], colors[i])
+            for i, target in enumerate(lanes)
+            if target is not None and i != column and i not in new_columns
+        ])
+
+        for i in joined:
+            lanes[i] = None
+
+        while lanes and lanes[-1] is None:
+            lanes.pop()
+            colors.pop()
+
+        commit.node = (column, color)
+        commit.in_lines = self.out_lines
+        commit.out_lines = out_lines
+
+        self.out_lines = out_lines
+
+    def get_state(self):
+        """Returns a snapshot of the active lanes.
+
+        Two layouts with the same state will lay out the rest of a history
+        identically.
+        """
+        return (tuple(self.lanes), tuple(self.colors))
+
+    def get_color(self, sha1):
+        return ord(sha1[0])
+
+    def __alloc_lane(self):
+        try:
+            return self.lanes.index(None)
+        except ValueError:
+            self.lanes.append(None)
+            self.colors.append(0)
+
+            return len(self.lanes) - 1
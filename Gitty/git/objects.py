@@ -0,0 +1,537 @@
+import mmap
+import os
+import struct
+import threading
+import zlib
+from binascii import unhexlify
+
+from Gitty.lru import LRUCache
+
+
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+TYPE_NAMES = {
+    OBJ_COMMIT: "commit",
+    OBJ_TREE: "tree",
+    OBJ_BLOB: "blob",
+    OBJ_TAG: "tag",
+}
+
+
+def map_file(path):
+    """Returns a read-only memory map of a file."""
+    fp = open(path, "rb")
+
+    try:
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        fp.close()
+
+
+def apply_delta(base, delta):
+    """Rebuilds an object from its delta base and the delta."""
+    pos = 0
+
+    # The delta starts with the sizes of the base and the result.
+    for i in xrange(2):
+        size = 0
+        shift = 0
+
+        while True:
+            c = ord(delta[pos])
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+
+            if not c & 0x80:
+                break
+
+        if i == 0 and size != len(base):
+            raise ValueError("Delta base has the wrong size")
+
+    result_size = size
+    result = []
+    delta_len = len(delta)
+
+    while pos < delta_len:
+        op = ord(delta[pos])
+        pos += 1
+
+        if op & 0x80:
+            # Copy a range of the base. The low bits say which bytes of
+            # the offset and size follow.
+            offset = 0
+            size = 0
+
+            for bit in xrange(4):
+                if op & (1 << bit):
+                    offset |= ord(delta[pos]) << (bit * 8)
+                    pos += 1
+
+            for bit in xrange(3):
+                if op & (0x10 << bit):
+                    size |= ord(delta[pos]) << (bit * 8)
+                    pos += 1
+
+            result.append(base[offset:offset + (size or 0x10000)])
+        elif op:
+            # Insert the next op bytes of the delta.
+            result.append(delta[pos:pos + op])
+            pos += op
+        else:
+            raise ValueError("Invalid delta opcode")
+
+    result = "".join(result)
+
+    if len(result) != result_size:
+        raise ValueError("Delta result has the wrong size")
+
+    return result
+
+
+class PackIndex(object):
+    """A memory-mapped pack index (.idx) file.
+
+    Objects are found by using the fanout table to narrow the search to
+    the SHA-1s sharing their first byte, and then binary searching the
+    sorted SHA-1s. Both version 1 and version 2 indexes can be read.
+    """
+    V2_MAGIC = "\377tOc"
+
+    def __init__(self, path):
+        self.data = map_file(path)
+
+        if self.data[:4] == self.V2_MAGIC:
+            self.version = struct.unpack(">L", self.data[4:8])[0]
+            fanout_start = 8
+        else:
+            self.version = 1
+            fanout_start = 0
+
+        if self.version not in (1, 2):
+            raise ValueError("Unsupported pack index version %s" %
+                             self.version)
+
+        self.fanout = struct.unpack(">256L",
+                                    self.data[fanout_start:
+                                              fanout_start + 256 * 4])
+        self.count = self.fanout[255]
+        table_start = fanout_start + 256 * 4
+
+        if self.version == 1:
+            # Each entry is a 4-byte offset followed by the SHA-1.
+            self.sha1_start = table_start + 4
+            self.sha1_stride = 24
+        else:
+            self.sha1_start = table_start
+            self.sha1_stride = 20
+            self.offsets_start = table_start + self.count * 24
+            self.large_offsets_start = self.offsets_start + self.count * 4
+
+    def close(self):
+        self.data.close()
+
+    def find(self, sha1):
+        """Returns the pack offset of a binary SHA-1, or None."""
+        data = self.data
+        first = ord(sha1[0])
+
+        if first:
+            lo = self.fanout[first - 1]
+        else:
+            lo = 0
+
+        hi = self.fanout[first]
+        start = self.sha1_start
+        stride = self.sha1_stride
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = start + mid * stride
+            entry = data[pos:pos + 20]
+
+            if entry < sha1:
+                lo = mid + 1
+            elif entry > sha1:
+                hi = mid
+            else:
+                return self.__get_offset(mid)
+
+        return None
+
+    def __get_offset(self, i):
+        data = self.data
+
+        if self.version == 1:
+            pos = self.sha1_start - 4 + i * 24
+            return struct.unpack(">L", data[pos:pos + 4])[0]
+
+        pos = self.offsets_start + i * 4
+        offset = struct.unpack(">L", data[pos:pos + 4])[0]
+
+        if offset & 0x80000000:
+            # The offset is an index into the table of 8-byte offsets.
+            pos = self.large_offsets_start + (offset & 0x7fffffff) * 8
+            offset = struct.unpack(">Q", data[pos:pos + 8])[0]
+
+        return offset
+
+
+class PackFile(object):
+    """A memory-mapped pack file, along with its index."""
+    # The amount of compressed data to inflate at a time.
+    INFLATE_CHUNK_SIZE = 16 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.index = PackIndex(path[:-len(".pack")] + ".idx")
+        self.data = map_file(path)
+
+        if self.data[:4] != "PACK":
+            raise ValueError("%s isn't a pack file" % path)
+
+    def close(self):
+        self.index.close()
+        self.data.close()
+
+    def read_header(self, offset):
+        """Reads an object's header.
+
+        Returns a tuple of (type, size, data_offset, base), where base is
+        the offset of the delta base for OFS_DELTA objects, or its binary
+        SHA-1 for REF_DELTA objects.
+        """
+        data = self.data
+        start = offset
+        c = ord(data[offset])
+        offset += 1
+        obj_type = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+
+        while c & 0x80:
+            c = ord(data[offset])
+            offset += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+
+        base = None
+
+        if obj_type == OBJ_OFS_DELTA:
+            c = ord(data[offset])
+            offset += 1
+            distance = c & 0x7f
+
+            while c & 0x80:
+                c = ord(data[offset])
+                offset += 1
+                distance = ((distance + 1) << 7) | (c & 0x7f)
+
+            base = start - distance
+        elif obj_type == OBJ_REF_DELTA:
+            base = data[offset:offset + 20]
+            offset += 20
+
+        return (obj_type, size, offset, base)
+
+    def read_raw(self, offset):
+        """Reads an object without resolving deltas.
+
+        Returns a tuple of (type, contents, base). For deltas, the
+        contents are the delta itself.
+        """
+        obj_type, size, data_offset, base = self.read_header(offset)
+
+        return (obj_type, self.inflate(data_offset, size), base)
+
+    def inflate(self, offset, size):
+        data = self.data
+        decompressor = zlib.decompressobj()
+        result = []
+        length = 0
+        end = len(data)
+
+        while length < size and offset < end:
+            chunk = data[offset:offset + self.INFLATE_CHUNK_SIZE]
+            offset += len(chunk)
+            output = decompressor.decompress(chunk)
+            result.append(output)
+            length += len(output)
+
+            if decompressor.unused_data:
+                break
+
+        result = "".join(result)
+
+        if len(result) != size:
+            raise ValueError("Corrupt object in %s" % self.path)
+
+        return result
+
+
+class ObjectDatabase(object):
+    """Reads objects straight from a repository's object store.
+
+    Loose objects are inflated from their files, and packed ones are
+    found through the memory-mapped pack indexes. Delta chains are
+    resolved in-process, with the recently used delta bases cached, so
+    reading a commit or tree costs no more than inflating it.
+
+    read() returns None for anything it can't find, such as objects in
+    a pack added after the packs were last listed and then repacked
+    away, so callers can fall back on git itself.
+    """
+    # The maximum total size of the delta bases to keep cached.
+    DELTA_CACHE_SIZE = 16 * 1024 * 1024
+
+    # The longest delta chain to follow. Git's default maximum is 50.
+    MAX_DELTA_DEPTH = 1000
+
+    def __init__(self, git_dir):
+        self.objects_dir = os.path.join(self.__get_common_dir(git_dir),
+                                        "objects")
+        self.lock = threading.RLock()
+        self.packs = None
+        self.packs_stamp = None
+
+        # Resolved objects, keyed by the pack and offset they're at.
+        self.delta_cache = LRUCache(self.DELTA_CACHE_SIZE,
+                                    lambda entry: len(entry[1]))
+
+    def close(self):
+        self.lock.acquire()
+
+        try:
+            for pack in self.packs or []:
+                pack.close()
+
+            self.packs = None
+            self.delta_cache.clear()
+        finally:
+            self.lock.release()
+
+    def read(self, sha1):
+        """Returns the (type, contents) of an object, or None.
+
+        sha1 is the object's hex SHA-1.
+        """
+        self.lock.acquire()
+
+        try:
+            try:
+                binary_sha1 = unhexlify(sha1)
+            except TypeError:
+                return None
+
+            if len(binary_sha1) != 20:
+                return None
+
+            for rescan in (False, True):
+                if rescan and not self.__update_packs():
+                    break
+
+                result = self.__read_packed(binary_sha1)
+
+                if result is None:
+                    result = self.__read_loose(sha1)
+
+                if result is not None:
+                    return result
+
+            return None
+        finally:
+            self.lock.release()
+
+    def count_packed(self):
+        """Returns the number of objects in the repository's packs."""
+        self.lock.acquire()
+
+        try:
+            if self.packs is None:
+                self.__update_packs()
+
+            return sum([pack.index.count for pack in self.packs])
+        finally:
+            self.lock.release()
+
+    def __get_common_dir(self, git_dir):
+        try:
+            fp = open(os.path.join(git_dir, "commondir"), "r")
+        except IOError:
+            return git_dir
+
+        try:
+            common_dir = fp.read().strip()
+        finally:
+            fp.close()
+
+        return os.path.normpath(os.path.join(git_dir, common_dir))
+
+    def __get_object_dirs(self):
+        dirs = [self.objects_dir]
+
+        try:
+            fp = open(os.path.join(self.objects_dir, "info", "alternates"),
+                      "r")
+        except IOError:
+            return dirs
+
+        try:
+            for line in fp:
+                line = line.strip()
+
+                if line and not line.startswith("#"):
+                    dirs.append(os.path.join(self.objects_dir, line))
+        finally:
+            fp.close()
+
+        return dirs
+
+    def __update_packs(self):
+        """Relists the packs, if they've changed.
+
+        Returns whether anything changed.
+        """
+        pack_dirs = [os.path.join(path, "pack")
+                     for path in self.__get_object_dirs()]
+        stamp = []
+
+        for path in pack_dirs:
+            try:
+                st = os.stat(path)
+                stamp.append((path, st.st_mtime, st.st_ino))
+            except OSError:
+                pass
+
+        if self.packs is not None and stamp == self.packs_stamp:
+            return False
+
+        old_packs = dict([(pack.path, pack) for pack in self.packs or []])
+        packs = []
+
+        for path in pack_dirs:
+            try:
+                names = os.listdir(path)
+            except OSError:
+                continue
+
+            for name in sorted(names):
+                if not name.endswith(".pack"):
+                    continue
+
+                filename = os.path.join(path, name)
+                pack = old_packs.pop(filename, None)
+
+                if pack is None:
+                    try:
+                        pack = PackFile(filename)
+                    except (IOError, OSError, ValueError, EnvironmentError):
+                        continue
+
+                packs.append(pack)
+
+        for pack in old_packs.itervalues():
+            pack.close()
+
+        if old_packs:
+            self.delta_cache.clear()
+
+        self.packs = packs
+        self.packs_stamp = stamp
+
+        return True
+
+    def __read_loose(self, sha1):
+        for path in self.__get_object_dirs():
+            try:
+                fp = open(os.path.join(path, sha1[:2], sha1[2:]), "rb")
+            except IOError:
+                continue
+
+            try:
+                data = zlib.decompress(fp.read())
+            except zlib.error:
+                continue
+            finally:
+                fp.close()
+
+            # The contents are preceded by "type size\0".
+            header, contents = data.split("\0", 1)
+            obj_type = header.split(" ", 1)[0]
+
+            return (obj_type, contents)
+
+        return None
+
+    def __read_packed(self, sha1):
+        if self.packs is None:
+            self.__update_packs()
+
+        for pack in self.packs:
+            offset = pack.index.find(sha1)
+
+            if offset is not None:
+                try:
+                    obj_type, contents = self.__read_pack_object(pack, offset)
+                except (ValueError, IndexError, zlib.error):
+                    return None
+
+                return (TYPE_NAMES[obj_type], contents)
+
+        return None
+
+    def __read_pack_object(self, pack, offset):
+        # Follow the chain of deltas back to an object that's either whole
+        # or cached, and then apply the deltas on the way back out.
+        deltas = []
+        cache = self.delta_cache
+
+        while True:
+            entry = cache.get((pack.path, offset))
+
+            if entry is not None:
+                obj_type, contents = entry
+                break
+
+            obj_type, contents, base = pack.read_raw(offset)
+
+            if obj_type in TYPE_NAMES:
+                break
+
+            deltas.append((pack, offset, contents))
+
+            if len(deltas) > self.MAX_DELTA_DEPTH:
+                raise ValueError("Delta chain is too long")
+
+            if obj_type == OBJ_OFS_DELTA:
+                offset = base
+            elif obj_type == OBJ_REF_DELTA:
+                pack, offset = self.__find_packed(base)
+            else:
+                raise ValueError("Unknown object type %s" % obj_type)
+
+        if deltas:
+            cache.set((pack.path, offset), (obj_type, contents))
+
+        for pack, offset, delta in reversed(deltas):
+            contents = apply_delta(contents, delta)
+
+            # Bases are the objects most likely to be needed again, and
+            # every object in a chain is another's base.
+            cache.set((pack.path, offset), (obj_type, contents))
+
+        return (obj_type, contents)
+
+    def __find_packed(self, sha1):
+        for pack in self.packs:
+            offset = pack.index.find(sha1)
+
+            if offset is not None:
+                return (pack, offset)
+
+        raise ValueError("Missing delta base")
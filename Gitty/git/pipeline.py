@@ -0,0 +1,290 @@
+import marshal
+import os
+import select
+import struct
+import subprocess
+import sys
+import threading
+from Queue import Empty, Queue
+
+from Gitty.tracing import tracer
+
+
+def read_records(fd, read_size):
+    """Reads NUL-separated records from a file descriptor.
+
+    Yields a (size, records) tuple for each read, with the number of
+    bytes read and the records it completed. Anything after the last NUL
+    is yielded as a record of its own at the end, unless it's blank.
+    """
+    buffer = ""
+
+    while True:
+        data = os.read(fd, read_size)
+
+        if not data:
+            break
+
+        records = (buffer + data).split("\0")
+        buffer = records.pop()
+
+        yield len(data), records
+
+    if buffer.strip():
+        yield 0, [buffer]
+
+
+def start_worker(module, args, **kwargs):
+    """Starts a Python worker process running one of gitty's modules.
+
+    args are the arguments to the module. Any other keyword arguments
+    are passed on to subprocess.Popen.
+    """
+    # The worker finds Gitty the same way this process did, and must not
+    # write over this process's trace.
+    env = dict(os.environ)
+    env.pop("GITTY_TRACE", None)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))] +
+        [path for path in [env.get("PYTHONPATH")] if path])
+
+    return subprocess.Popen([sys.executable, "-m", module] + list(args),
+                            close_fds=True, env=env, **kwargs)
+
+
+class HistoryPipeline(object):
+    """Reads and parses git rev-list --header output in stages.
+
+    A reader thread takes the output off the pipe in large reads and
+    splits it into records, and a parser thread turns the records into
+    commits. The stages are joined by bounded queues, so git keeps
+    writing while commits are parsed and laid out, and memory use is
+    capped if the caller falls behind.
+
+    Large histories can be parsed by a worker process instead, which
+    reads git's output itself. It sends back each commit's fields as
+    marshalled tuples, and build_func turns them into commits in the
+    parser thread, which is far quicker than parsing. That way parsing
+    runs alongside the layout, rather than taking turns with it under
+    the interpreter lock. worker_func is the "module:function" the
+    worker parses each record with.
+
+    get() returns the parsed commits a batch at a time. The file
+    descriptor from fileno() is readable while there are batches
+    waiting, so it can be watched from a main loop.
+    """
+    # The most to read from a pipe at once.
+    READ_SIZE = 1024 * 1024
+
+    # The number of commits handed out at a time.
+    BATCH_SIZE = 1000
+
+    # The number of batches a queue holds before the stage feeding it has
+    # to wait.
+    QUEUE_SIZE = 32
+
+    # The header of each batch a worker sends: the size of the marshalled
+    # batch, and how much of git's output it covers.
+    FRAME_FORMAT = "<LL"
+
+    def __init__(self, fp, parse_func, worker_func=None, build_func=None):
+        self.parse_func = parse_func
+        self.worker = None
+        self.stopped = False
+        self.finished = False
+        self.failed = False
+
+        # Whether every commit was read and parsed. This is known once the
+        # pipeline is closed.
+        self.completed = False
+
+        # The amount of git's output read, for the trace.
+        self.bytes_read = 0
+
+        if worker_func:
+            self.worker = start_worker("Gitty.git.pipeline", [worker_func],
+                                       stdin=fp, stdout=subprocess.PIPE)
+            self.fd = self.worker.stdout.fileno()
+            self.parse_func = build_func
+        else:
+            self.fd = fp.fileno()
+
+        self.records = Queue(self.QUEUE_SIZE)
+        self.output = Queue(self.QUEUE_SIZE)
+
+        # A byte is written here for each batch put on the output queue,
+        # and read back when it's taken off.
+        self.notify_read, self.notify_write = os.pipe()
+
+        self.threads = [threading.Thread(target=self.__read),
+                        threading.Thread(target=self.__parse)]
+
+        for thread in self.threads:
+            thread.setDaemon(True)
+            thread.start()
+
+    def fileno(self):
+        return self.notify_read
+
+    def get(self, wait=False):
+        """Returns the next batch of commits.
+
+        If there isn't one ready, this returns an empty list, or waits
+        for one if wait is True. Once every commit has been returned,
+        None is returned.
+        """
+        if self.finished:
+            return None
+
+        if not wait and not select.select([self.notify_read], [], [], 0)[0]:
+            return []
+
+        os.read(self.notify_read, 1)
+        batch = self.output.get()
+
+        if batch is None:
+            self.finished = True
+
+        return batch
+
+    def close(self):
+        """Stops the pipeline and waits for its threads.
+
+        If git is still running, it should be killed first, so that the
+        reader isn't left waiting on it.
+        """
+        self.stopped = True
+
+        if self.worker and self.worker.poll() is None:
+            self.worker.kill()
+
+        for thread in self.threads:
+            while thread.isAlive():
+                # Make room for anything waiting to be queued.
+                self.__drain()
+                thread.join(0.01)
+
+        if self.worker:
+            self.worker.stdout.close()
+            self.worker.wait()
+
+        os.close(self.notify_read)
+        os.close(self.notify_write)
+
+        self.completed = (self.finished and not self.failed and
+                          (self.worker is None or
+                           self.worker.returncode == 0))
+
+    def __drain(self):
+        for queue in (self.records, self.output):
+            try:
+                while True:
+                    queue.get_nowait()
+            except Empty:
+                pass
+
+        while select.select([self.notify_read], [], [], 0)[0]:
+            os.read(self.notify_read, 4096)
+
+    def __read(self):
+        try:
+            try:
+                if self.worker:
+                    batches = self.__read_frames()
+                else:
+                    batches = read_records(self.fd, self.READ_SIZE)
+
+                for size, batch in batches:
+                    self.bytes_read += size
+
+                    if self.stopped:
+                        break
+
+                    if batch:
+                        self.records.put(batch)
+            except (IOError, OSError, ValueError, EOFError):
+                self.failed = True
+        finally:
+            self.records.put(None)
+
+    def __read_frames(self):
+        header_size = struct.calcsize(self.FRAME_FORMAT)
+
+        while True:
+            header = self.__read_exactly(header_size)
+
+            if not header:
+                break
+
+            length, size = struct.unpack(self.FRAME_FORMAT, header)
+
+            yield size, marshal.loads(self.__read_exactly(length))
+
+    def __read_exactly(self, size):
+        data = []
+        remaining = size
+
+        while remaining:
+            chunk = os.read(self.fd, min(remaining, self.READ_SIZE))
+
+            if not chunk:
+                break
+
+            data.append(chunk)
+            remaining -= len(chunk)
+
+        if remaining and remaining != size:
+            raise EOFError("Worker output ended mid-batch")
+
+        return "".join(data)
+
+    def __parse(self):
+        parse_func = self.parse_func
+
+        try:
+            try:
+                while not self.stopped:
+                    records = self.records.get()
+
+                    if records is None:
+                        break
+
+                    span = tracer.span("history", "parse batch")
+                    items = [parse_func(record) for record in records]
+                    span.args['commits'] = len(items)
+                    span.finish()
+
+                    for i in xrange(0, len(items), self.BATCH_SIZE):
+                        self.__put(items[i:i + self.BATCH_SIZE])
+            except Exception:
+                self.failed = True
+                raise
+        finally:
+            self.__put(None)
+
+    def __put(self, batch):
+        self.output.put(batch)
+        os.write(self.notify_write, "\0")
+
+
+def main():
+    """Runs a parsing worker.
+
+    Records are read from stdin and parsed with the function named by
+    the first argument, and each batch is written to stdout as a frame
+    of marshalled results.
+    """
+    module_name, func_name = sys.argv[1].split(":")
+    module = __import__(module_name, {}, {}, [func_name])
+    parse_func = getattr(module, func_name)
+
+    for size, records in read_records(0, HistoryPipeline.READ_SIZE):
+        data = marshal.dumps([parse_func(record) for record in records])
+        sys.stdout.write(struct.pack(HistoryPipeline.FRAME_FORMAT,
+                                     len(data), size) + data)
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+import os
+import subprocess
+import threading
+
+from Gitty.git.batch import CatFileBatch
+from Gitty.tracing import tracer
+
+
+class Slot(object):
+    """One of the pool's places for a running git process.
+
+    Callers in the main loop can't wait for a slot, so they ask for one
+    with request_slot() and are called back once it's granted. Any
+    processes they start under it don't take slots of their own, so a
+    slot can be used for several processes in turn. It's given back with
+    release_slot().
+    """
+    def __init__(self, key, callback=None):
+        self.key = key
+        self.callback = callback
+        self.granted = False
+        self.released = False
+
+
+class ProcessPool(object):
+    """Runs git for every open repository.
+
+    git is run with an argument list, in the repository's directory. The
+    number of git processes running at once is capped, both for each
+    repository and overall, so that several open repositories don't
+    fight over the disk. When processes have to wait for a slot, the
+    ones for the foreground repository go first.
+
+    The long-lived cat-file batch processes are shared by everything
+    using the same repository. Each takes a slot while it's answering a
+    request, rather than for as long as it runs, so idle ones don't keep
+    anything else from running.
+
+    Each process is traced, from when it starts to when it's released.
+    """
+    MAX_PROCESSES = 6
+    MAX_PROCESSES_PER_REPO = 3
+
+    # How often a process waiting for a slot checks if its job was
+    # cancelled, in seconds.
+    CANCEL_CHECK_INTERVAL = 0.1
+
+    def __init__(self, max_processes=MAX_PROCESSES,
+                 max_per_repo=MAX_PROCESSES_PER_REPO):
+        self.max_processes = max_processes
+        self.max_per_repo = max_per_repo
+
+        self.condition = threading.Condition()
+        self.foreground = None
+        self.total = 0
+        self.counts = {}
+
+        # The Slots waiting to be granted, in the order they were asked
+        # for.
+        self.waiting = []
+
+        # The batch processes for each repository, and the number of
+        # users of each repository.
+        self.batches = {}
+        self.users = {}
+
+    def set_foreground(self, path):
+        """Sets the repository whose processes should run first."""
+        self.condition.acquire()
+
+        try:
+            self.foreground = self.__get_key(path)
+            granted = self.__update()
+        finally:
+            self.condition.release()
+
+        self.__call_back(granted)
+
+    def open_repository(self, path):
+        """Registers a user of a repository's batch processes."""
+        key = self.__get_key(path)
+        self.condition.acquire()
+        self.users[key] = self.users.get(key, 0) + 1
+        self.condition.release()
+
+    def close_repository(self, path):
+        """Unregisters a user of a repository's batch processes.
+
+        Once a repository has no users left, its batch processes are
+        closed.
+        """
+        key = self.__get_key(path)
+        batches = []
+        self.condition.acquire()
+
+        try:
+            self.users[key] = self.users.get(key, 1) - 1
+
+            if self.users[key] <= 0:
+                del self.users[key]
+
+                for check in (False, True):
+                    batch = self.batches.pop((key, check), None)
+
+                    if batch:
+                        batches.append(batch)
+        finally:
+            self.condition.release()
+
+        for batch in batches:
+            batch.close()
+
+    def get_batch(self, path, check=False):
+        """Returns the shared cat-file batch process for a repository."""
+        key = (self.__get_key(path), check)
+        self.condition.acquire()
+
+        try:
+            batch = self.batches.get(key)
+
+            if batch is None:
+                batch = self.batches[key] = CatFileBatch(path, check, self)
+
+            return batch
+        finally:
+            self.condition.release()
+
+    def request_slot(self, path, callback):
+        """Asks for a slot in a repository, without waiting for one.
+
+        Returns a Slot, which is granted right away if there's one free.
+        Otherwise, callback is called with the Slot once it's granted.
+        That happens in whichever thread freed a slot, so callers in the
+        main loop should pass the call on to it.
+        """
+        slot = Slot(self.__get_key(path), callback)
+        self.condition.acquire()
+
+        try:
+            self.waiting.append(slot)
+            granted = self.__update()
+        finally:
+            self.condition.release()
+
+        self.__call_back([other for other in granted if other is not slot])
+
+        return slot
+
+    def acquire_slot(self, path, job=None):
+        """Waits for a slot in a repository, and returns it.
+
+        If job is cancelled while waiting, None is returned.
+        """
+        return self.__acquire(self.__get_key(path), job)
+
+    def release_slot(self, slot):
+        """Gives back a slot, or stops asking for it if it's waiting."""
+        self.condition.acquire()
+
+        try:
+            if slot.released:
+                return
+
+            slot.released = True
+
+            if slot.granted:
+                self.__add(slot.key, -1)
+            else:
+                self.waiting.remove(slot)
+
+            granted = self.__update()
+        finally:
+            self.condition.release()
+
+        self.__call_back(granted)
+
+    def popen(self, path, args, job=None, slot=None, **kwargs):
+        """Starts git in a repository.
+
+        args are the arguments to git. Any other keyword arguments are
+        passed on to subprocess.Popen.
+
+        If slot is given, git runs under it. Otherwise, this waits for a
+        free slot, and if job is cancelled while waiting, None is
+        returned.
+
+        The process must be passed to release() once it's finished.
+        """
+        own_slot = None
+
+        if slot is None:
+            slot = own_slot = self.__acquire(self.__get_key(path), job)
+
+            if slot is None:
+                return None
+
+        span = tracer.span("git", args[0], argv=list(args), path=path)
+
+        try:
+            p = subprocess.Popen(["git"] + list(args), cwd=path,
+                                 close_fds=True, **kwargs)
+        except:
+            if own_slot:
+                self.release_slot(own_slot)
+
+            raise
+
+        p.pool_slot = own_slot
+        p.trace_span = span
+
+        if job:
+            job.set_process(p)
+
+        return p
+
+    def release(self, process, bytes_read=None):
+        """Gives back the slot used by a finished process.
+
+        bytes_read is the amount of output read from it, for the trace.
+        """
+        span = getattr(process, 'trace_span', None)
+
+        if span is not None:
+            process.trace_span = None
+            span.bytes = bytes_read
+            span.args['exit_status'] = process.poll()
+            span.finish()
+
+        slot = getattr(process, 'pool_slot', None)
+
+        if slot is not None:
+            process.pool_slot = None
+            self.release_slot(slot)
+
+    def run(self, path, args, job=None, input=None, slot=None):
+        """Runs git in a repository, returning its output.
+
+        This returns None if the job is cancelled before git starts.
+        """
+        if input is None:
+            stdin = None
+        else:
+            stdin = subprocess.PIPE
+
+        p = self.popen(path, args, job, slot, stdin=stdin,
+                       stdout=subprocess.PIPE)
+
+        if p is None:
+            return None
+
+        output = ""
+
+        try:
+            output = p.communicate(input)[0]
+        finally:
+            self.release(p, len(output))
+
+        return output
+
+    def __get_key(self, path):
+        return os.path.realpath(path)
+
+    def __acquire(self, key, job):
+        slot = Slot(key)
+        self.condition.acquire()
+
+        try:
+            self.waiting.append(slot)
+
+            try:
+                while self.__get_next() is not slot:
+                    if job and job.cancelled:
+                        break
+
+                    self.condition.wait(self.CANCEL_CHECK_INTERVAL)
+                else:
+                    self.__add(key, 1)
+                    slot.granted = True
+            finally:
+                self.waiting.remove(slot)
+
+                # Someone else may be able to go now.
+                granted = self.__update()
+        finally:
+            self.condition.release()
+
+        self.__call_back(granted)
+
+        if slot.granted:
+            return slot
+
+        return None
+
+    def __get_next(self):
+        """Returns the waiting Slot that should be granted next, if any."""
+        if self.total >= self.max_processes:
+            return None
+
+        first = None
+
+        for slot in self.waiting:
+            if self.counts.get(slot.key, 0) < self.max_per_repo:
+                if slot.key == self.foreground:
+                    return slot
+
+                if first is None:
+                    first = slot
+
+        return first
+
+    def __update(self):
+        """Grants slots to the requests that can go next.
+
+        This is called with the condition held, whenever a slot might
+        have freed up. Anything waiting in acquire is woken to check if
+        it can go. The granted requests are returned, to be called back
+        once the condition is released.
+        """
+        granted = []
+
+        while True:
+            slot = self.__get_next()
+
+            if slot is None or slot.callback is None:
+                break
+
+            self.waiting.remove(slot)
+            self.__add(slot.key, 1)
+            slot.granted = True
+            granted.append(slot)
+
+        self.condition.notifyAll()
+
+        return granted
+
+    def __call_back(self, granted):
+        for slot in granted:
+            slot.callback(slot)
+
+    def __add(self, key, count):
+        self.total += count
+        self.counts[key] = self.counts.get(key, 0) + count
+
+        if not self.counts[key]:
+            del self.counts[key]
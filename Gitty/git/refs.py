@@ -0,0 +1,268 @@
+import os
+import time
+
+from Gitty.git.pool import ProcessPool
+
+
+class RefReader(object):
+    """Reads a repository's refs straight from its git directory.
+
+    Refs are read from packed-refs and from the loose ref files under
+    refs/. Annotated tags are peeled, so that every ref maps to the
+    commit it names.
+
+    The refs are cached along with the modification times of
+    packed-refs and of the directories holding loose refs. Git replaces
+    a loose ref by renaming a new file over it, which updates its
+    directory's time, so if none of them have changed, neither have the
+    refs. A time is only kept to some resolution, though, so anything
+    changed too recently to tell is read again every time until it's
+    older.
+
+    Any git processes are run through the pool, in path, which defaults
+    to the git directory.
+    """
+    # How close to now a modification time has to be for a change within
+    # the same tick to go unnoticed, in seconds. Some file systems only
+    # keep times to the second, or two.
+    RACY_INTERVAL = 2
+
+    # The stamp kept for something changed too recently to be trusted. It
+    # never matches, so it's read again next time.
+    RACY_STAMP = ()
+
+    def __init__(self, git_dir, path=None, pool=None):
+        self.git_dir = git_dir
+        self.refs_dir = self.__get_common_dir()
+        self.path = path or git_dir
+        self.pool = pool or ProcessPool()
+        self.pool.open_repository(self.path)
+
+        self.packed_stamp = None
+        self.packed_refs = []
+
+        # The loose refs, by the directory they're in. Each entry is the
+        # directory's stamp, the refs in it and its subdirectories.
+        self.loose_dirs = {}
+
+        # Tag objects never change, so what they peel to is kept for
+        # as long as the reader is.
+        self.peeled = {}
+
+        self.result = None
+
+    def read(self, slot=None):
+        """Returns the refs, as a dictionary.
+
+        The dictionary maps the hex SHA-1 of each commit to a list of
+        the names of the refs pointing at it, without the "refs/" prefix.
+        The same dictionary is returned for as long as the refs don't
+        change.
+
+        If slot is given, any git processes run under that pool slot,
+        rather than waiting for one.
+        """
+        if os.path.exists(os.path.join(self.refs_dir, "reftable")):
+            # There aren't any ref files to read.
+            return self.__read_from_git(slot)
+
+        changed = self.__read_packed_refs()
+        changed = self.__read_loose_refs() or changed
+
+        if changed or self.result is None:
+            self.result = self.__build_result(slot)
+
+        return self.result
+
+    def close(self):
+        self.pool.close_repository(self.path)
+
+    def __get_common_dir(self):
+        # Linked worktrees keep their refs in the main git directory.
+        try:
+            fp = open(os.path.join(self.git_dir, "commondir"), "r")
+        except IOError:
+            return self.git_dir
+
+        try:
+            common_dir = fp.read().strip()
+        finally:
+            fp.close()
+
+        return os.path.normpath(os.path.join(self.git_dir, common_dir))
+
+    def __get_stamp(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def __get_stamp_to_keep(self, stamp):
+        if stamp and stamp[0] >= time.time() - self.RACY_INTERVAL:
+            return self.RACY_STAMP
+
+        return stamp
+
+    def __read_packed_refs(self):
+        path = os.path.join(self.refs_dir, "packed-refs")
+        stamp = self.__get_stamp(path)
+
+        if stamp == self.packed_stamp:
+            return False
+
+        old_refs = self.packed_refs
+        self.packed_stamp = self.__get_stamp_to_keep(stamp)
+        self.packed_refs = []
+
+        if stamp is None:
+            return bool(old_refs)
+
+        fp = open(path, "rb")
+
+        try:
+            data = fp.read()
+        finally:
+            fp.close()
+
+        # Each ref is a "sha1 name" line. If it's an annotated tag, it
+        # may be followed by a "^sha1" line with the commit it peels to.
+        # With "fully-peeled", every annotated tag has one, so a tag
+        # without one isn't annotated.
+        fully_peeled = False
+        peeled_tags = False
+        refs = self.packed_refs
+        peeled = self.peeled
+
+        for line in data.splitlines():
+            if line.startswith("#"):
+                traits = line.split()
+                fully_peeled = "fully-peeled" in traits
+                peeled_tags = "peeled" in traits
+            elif line.startswith("^"):
+                if refs:
+                    peeled[refs[-1][1]] = line[1:41]
+            elif len(line) > 41:
+                name = line[41:]
+                refs.append((name, line[:40]))
+
+                if ((fully_peeled or peeled_tags) and
+                    name.startswith("refs/tags/")):
+                    peeled.setdefault(line[:40], None)
+
+        return refs != old_refs
+
+    def __read_loose_refs(self):
+        changed = False
+        loose_dirs = {}
+        dirs = [os.path.join(self.refs_dir, "refs")]
+
+        while dirs:
+            path = dirs.pop()
+            stamp = self.__get_stamp(path)
+
+            if stamp is None:
+                continue
+
+            entry = self.loose_dirs.get(path)
+
+            if entry is None or entry[0] != stamp:
+                refs, subdirs = self.__read_loose_dir(path)
+
+                # A directory read again because its stamp was racy may
+                # not have changed at all.
+                if entry is None or entry[1:] != (refs, subdirs):
+                    changed = True
+
+                entry = (self.__get_stamp_to_keep(stamp), refs, subdirs)
+
+            loose_dirs[path] = entry
+            dirs.extend(entry[2])
+
+        changed = changed or len(loose_dirs) != len(self.loose_dirs)
+        self.loose_dirs = loose_dirs
+
+        return changed
+
+    def __read_loose_dir(self, path):
+        refs = {}
+        subdirs = []
+        prefix = path[len(self.refs_dir) + 1:].replace(os.sep, "/")
+
+        for name in os.listdir(path):
+            filename = os.path.join(path, name)
+
+            if os.path.isdir(filename):
+                subdirs.append(filename)
+                continue
+
+            if name.endswith(".lock"):
+                continue
+
+            try:
+                fp = open(filename, "rb")
+            except IOError:
+                continue
+
+            try:
+                contents = fp.read(41).strip()
+            finally:
+                fp.close()
+
+            # Symbolic refs, like remotes' HEADs, are left out.
+            if len(contents) == 40:
+                refs["%s/%s" % (prefix, name)] = contents
+
+        return refs, subdirs
+
+    def __build_result(self, slot):
+        # Loose refs are newer than packed ones with the same name.
+        refs = dict(self.packed_refs)
+
+        for stamp, loose_refs, subdirs in self.loose_dirs.itervalues():
+            refs.update(loose_refs)
+
+        result = {}
+
+        for name, sha1 in refs.iteritems():
+            if not name.startswith("refs/"):
+                continue
+
+            if name.startswith("refs/tags/"):
+                sha1 = self.__peel(sha1, slot)
+
+            result.setdefault(sha1, []).append(name[5:])
+
+        return result
+
+    def __peel(self, sha1, slot):
+        if sha1 in self.peeled:
+            return self.peeled[sha1] or sha1
+
+        batch = self.pool.get_batch(self.path, check=True)
+        info = batch.request(sha1 + "^{}", slot=slot)
+
+        if info and info[0] != sha1:
+            self.peeled[sha1] = info[0]
+        else:
+            self.peeled[sha1] = None
+
+        return self.peeled[sha1] or sha1
+
+    def __read_from_git(self, slot):
+        output = self.pool.run(self.path,
+                               ["for-each-ref",
+                                "--format=%(objectname) %(*objectname) "
+                                "%(refname)"],
+                               slot=slot)
+        result = {}
+
+        for line in output.splitlines(True):
+            parts = line.rstrip("\n").split(" ", 2)
+
+            if len(parts) == 3 and parts[2].startswith("refs/"):
+                sha1 = parts[1] or parts[0]
+                result.setdefault(sha1, []).append(parts[2][5:])
+
+        return result
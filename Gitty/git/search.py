@@ -0,0 +1,217 @@
+import heapq
+import re
+from array import array
+from binascii import hexlify, unhexlify
+from bisect import bisect_left
+
+
+class SearchIndex(object):
+    """An index for searching the loaded commits.
+
+    Commit summaries and authors are split into words, and each word maps
+    to the commits containing it. Words in a query match any word they
+    are a prefix of, so a search can be made while it's being typed.
+    SHA-1s are kept in a sorted table for looking up abbreviations.
+
+    Commits are identified by their ordinal in the history. Like the
+    ordinals in CommitGraph, they're stored relative to an offset, so
+    commits can be added to the top without renumbering the rest. Each
+    word's postings are kept in order.
+    """
+    WORD_RE = re.compile(r"[0-9a-z_\x80-\xff]+")
+    SHA1_RE = re.compile(r"^[0-9a-f]{4,40}$")
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.offset = 0
+        self.postings = {}
+
+        # The words and SHA-1s, sorted when they're next needed.
+        self.words = []
+        self.words_sorted = True
+        self.sha1s = []
+        self.sha1s_sorted = True
+
+    def append(self, commits):
+        """Adds commits below the ones already indexed."""
+        for commit in commits:
+            self.__add_words(self.__add(commit, self.count - self.offset,
+                                        self.postings))
+            self.count += 1
+
+    def prepend(self, commits):
+        """Adds commits above the ones already indexed."""
+        self.offset += len(commits)
+        self.count += len(commits)
+
+        # The new commits' postings go in front of the existing ones.
+        added = {}
+
+        for i, commit in enumerate(commits):
+            self.__add(commit, i - self.offset, added)
+
+        for word, word_postings in added.iteritems():
+            old_postings = self.postings.get(word)
+
+            if old_postings is None:
+                self.__add_words([word])
+            else:
+                word_postings.extend(old_postings)
+
+            self.postings[word] = word_postings
+
+    def sort(self):
+        """Sorts the word and SHA-1 tables.
+
+        This is done when they're next searched anyway, but can be done
+        ahead of time so that the first search is fast.
+        """
+        if not self.words_sorted:
+            self.words.sort()
+            self.words_sorted = True
+
+        if not self.sha1s_sorted:
+            self.sha1s.sort()
+            self.sha1s_sorted = True
+
+    def search(self, text, limit=None):
+        """Returns the sorted ordinals of the commits matching a query.
+
+        If limit is given, only the first that many are returned. They're
+        found without going through the rest, which keeps the short
+        queries that match most of the history quick.
+
+        This doesn't include SHA-1 matches. See find_sha1s().
+        """
+        groups = [list(self.__find_words(word))
+                  for word in self.WORD_RE.findall(text.strip().lower())]
+
+        if not groups:
+            return []
+
+        # The other words only have to be checked against the commits
+        # matching the word with the fewest.
+        groups.sort(key=lambda group: sum([len(postings)
+                                           for postings in group]))
+
+        if limit is None:
+            result = self.__intersect(groups)
+        else:
+            result = self.__intersect_first(groups, limit)
+
+        offset = self.offset
+
+        return [i + offset for i in result]
+
+    def find_sha1s(self, text):
+        """Returns the binary SHA-1s starting with a query."""
+        text = text.strip().lower()
+
+        if not self.SHA1_RE.match(text):
+            return []
+
+        self.sort()
+
+        # Binary SHA-1s only hold whole bytes, so an odd-length prefix
+        # starts looking from its smallest completion.
+        sha1s = self.sha1s
+        i = bisect_left(sha1s, unhexlify(text + "0" * (len(text) & 1)))
+        result = []
+
+        while i < len(sha1s) and hexlify(sha1s[i]).startswith(text):
+            result.append(sha1s[i])
+            i += 1
+
+        return result
+
+    def __add(self, commit, stored, postings):
+        """Adds a commit to postings, returning any words new to it."""
+        text = "%s %s" % (commit.message, commit.author)
+        new_words = []
+
+        for word in set(self.WORD_RE.findall(text.lower())):
+            word_postings = postings.get(word)
+
+            if word_postings is None:
+                word_postings = postings[word] = array('i')
+                new_words.append(word)
+
+            word_postings.append(stored)
+
+        self.sha1s.append(commit.sha1)
+        self.sha1s_sorted = False
+
+        return new_words
+
+    def __add_words(self, words):
+        if words:
+            self.words.extend(words)
+            self.words_sorted = False
+
+    def __intersect(self, groups):
+        """Returns the commits in every group of postings, in order."""
+        result = set()
+
+        for postings in groups[0]:
+            result.update(postings)
+
+        for group in groups[1:]:
+            if not result:
+                break
+
+            matches = set()
+
+            for postings in group:
+                matches.update(result.intersection(postings))
+
+            result = matches
+
+        return sorted(result)
+
+    def __intersect_first(self, groups, limit):
+        """Returns the first commits in every group of postings."""
+        result = []
+        last = None
+
+        # A commit is likeliest to be found in the words with the most.
+        others = [sorted(group, key=len, reverse=True)
+                  for group in groups[1:]]
+
+        for stored in heapq.merge(*groups[0]):
+            if stored == last:
+                continue
+
+            last = stored
+
+            for group in others:
+                if not self.__contains(group, stored):
+                    break
+            else:
+                result.append(stored)
+
+                if len(result) == limit:
+                    break
+
+        return result
+
+    def __contains(self, group, stored):
+        for postings in group:
+            i = bisect_left(postings, stored)
+
+            if i < len(postings) and postings[i] == stored:
+                return True
+
+        return False
+
+    def __find_words(self, prefix):
+        self.sort()
+
+        words = self.words
+        i = bisect_left(words, prefix)
+
+        while i < len(words) and words[i].startswith(prefix):
+            yield self.postings[words[i]]
+            i += 1
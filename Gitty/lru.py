@@ -0,0 +1,57 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A cache that evicts the least recently used entries.
+
+    The cache is bounded by the total size of its values, as measured by
+    get_size, rather than by the number of entries.
+    """
+    def __init__(self, max_size, get_size=len):
+        self.max_size = max_size
+        self.get_size = get_size
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        try:
+            value, size = self.entries.pop(key)
+        except KeyError:
+            return default
+
+        # Move it to the most recently used end.
+        self.entries[key] = (value, size)
+
+        return value
+
+    def set(self, key, value):
+        self.remove(key)
+
+        size = self.get_size(value)
+
+        if size > self.max_size:
+            return
+
+        self.entries[key] = (value, size)
+        self.size += size
+
+        while self.size > self.max_size:
+            old_key, (old_value, old_size) = self.entries.popitem(last=False)
+            self.size -= old_size
+
+    def remove(self, key):
+        try:
+            value, size = self.entries.pop(key)
+            self.size -= size
+        except KeyError:
+            pass
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
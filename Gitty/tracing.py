@@ -0,0 +1,147 @@
+import atexit
+import json
+import os
+import thread
+import threading
+import time
+from collections import deque
+
+
+class Span(object):
+    """A timed piece of work.
+
+    A span is finished either by calling finish() or, when it's used in
+    a with statement, on leaving the block. bytes and args can be set
+    while the span is running.
+    """
+    __slots__ = ('tracer', 'category', 'name', 'args', 'bytes', 'start')
+
+    def __init__(self, tracer, category, name, args):
+        self.tracer = tracer
+        self.category = category
+        self.name = name
+        self.args = args
+        self.bytes = None
+        self.start = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.finish()
+
+        return False
+
+    def finish(self):
+        self.tracer.record(self.category, self.name, self.start,
+                           time.time() - self.start, self.bytes, self.args)
+
+
+class Tracer(object):
+    """Records how long git calls and UI work take.
+
+    Totals are kept for each kind of work, by category and name, for the
+    statistics panel. If a trace filename is given, every span is also
+    kept as a Chrome trace event and written to the file on exit. The
+    file can be loaded into chrome://tracing or Perfetto.
+    """
+    # The most events to keep for the trace file. The oldest are dropped
+    # past this.
+    MAX_EVENTS = 1000000
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.pid = os.getpid()
+
+        # Each entry is [count, total time, max time, bytes].
+        self.stats = {}
+
+        if filename:
+            self.events = deque(maxlen=self.MAX_EVENTS)
+        else:
+            self.events = None
+
+    def span(self, category, name, **args):
+        """Starts a span. It's recorded once it's finished."""
+        return Span(self, category, name, args)
+
+    def record(self, category, name, start, duration, bytes=None,
+               args=None):
+        self.lock.acquire()
+
+        try:
+            stat = self.stats.get((category, name))
+
+            if stat is None:
+                stat = self.stats[(category, name)] = [0, 0.0, 0.0, 0]
+
+            stat[0] += 1
+            stat[1] += duration
+            stat[2] = max(stat[2], duration)
+            stat[3] += bytes or 0
+
+            if self.events is not None:
+                if bytes is not None:
+                    args = dict(args or {}, bytes=bytes)
+
+                self.events.append({
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": int((start - self.start_time) * 1000000),
+                    "dur": int(duration * 1000000),
+                    "pid": self.pid,
+                    "tid": thread.get_ident(),
+                    "args": args or {},
+                })
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        """Returns the totals, as a sorted list.
+
+        Each entry is a tuple of (category, name, count, total time,
+        max time, bytes).
+        """
+        self.lock.acquire()
+
+        try:
+            return sorted([key + tuple(stat)
+                           for key, stat in self.stats.iteritems()])
+        finally:
+            self.lock.release()
+
+    def reset_stats(self):
+        self.lock.acquire()
+        self.stats.clear()
+        self.lock.release()
+
+    def save(self, filename=None):
+        """Writes the recorded events as a Chrome trace file."""
+        filename = filename or self.filename
+
+        self.lock.acquire()
+
+        try:
+            events = list(self.events or [])
+        finally:
+            self.lock.release()
+
+        fp = open(filename, "w")
+
+        try:
+            json.dump({
+                "traceEvents": events,
+                "displayTimeUnit": "ms",
+            }, fp)
+        finally:
+            fp.close()
+
+
+# Setting GITTY_TRACE to a filename writes a trace there on exit.
+tracer = Tracer(os.environ.get("GITTY_TRACE") or None)
+
+if tracer.filename:
+    atexit.register(tracer.save)
@@ -2,6 +2,8 @@ import gtk
 import os
 
 
+from Gitty.git.pool import ProcessPool
+from Gitty.ui.stats import StatsPanel
 from Gitty.ui.tabs import ProjectTab
 
 
@@ -34,14 +36,25 @@ class GittyWindow(gtk.Window):
         menubar.show()
         main_vbox.pack_start(menubar, False, False, 0)
 
+        # All tabs share one pool, so the git processes for the visible
+        # tab go ahead of those for the others.
+        self.pool = ProcessPool()
+
         self.notebook = gtk.Notebook()
         self.notebook.show()
         main_vbox.pack_start(self.notebook, True, True, 0)
+        self.notebook.connect('switch-page', self.__on_switch_page)
+
+        # The statistics panel is hidden until Ctrl+Shift+S is pressed.
+        self.stats_panel = StatsPanel()
+        self.stats_panel.set_size_request(-1, 200)
+        main_vbox.pack_start(self.stats_panel, False, True, 0)
+        self.connect('key-press-event', self.__on_key_press)
 
         self.new_tab(os.getcwd())
 
     def new_tab(self, path):
-        tab = ProjectTab(path)
+        tab = ProjectTab(path, self.pool)
         tab.show()
         self.notebook.append_page(tab, gtk.Label(path))
 
@@ -55,5 +68,22 @@ class GittyWindow(gtk.Window):
 
         return action_group
 
+    def __on_switch_page(self, notebook, page, page_num):
+        self.pool.set_foreground(notebook.get_nth_page(page_num).path)
+
+    def __on_key_press(self, widget, event):
+        modifiers = gtk.gdk.CONTROL_MASK | gtk.gdk.SHIFT_MASK
+
+        if (event.state & modifiers == modifiers and
+            gtk.gdk.keyval_to_lower(event.keyval) == gtk.keysyms.s):
+            if self.stats_panel.get_property('visible'):
+                self.stats_panel.hide()
+            else:
+                self.stats_panel.show()
+
+            return True
+
+        return False
+
     def __on_quit(self, action):
         self.destroy()
@@ -2,10 +2,17 @@ import cairo
 import gobject
 import gtk
 import math
+from bisect import bisect_left, bisect_right
 import pango
+import pangocairo
 from xml.sax.saxutils import escape
 
+from binascii import unhexlify
+
 from Gitty.git.commits import Commit, CommitGraph, Reference
+from Gitty.git.search import SearchIndex
+from Gitty.lru import LRUCache
+from Gitty.tracing import tracer
 
 
 class ReferencesCellRenderer(gtk.GenericCellRenderer):
@@ -14,9 +21,19 @@ class ReferencesCellRenderer(gtk.GenericCellRenderer):
                        gobject.PARAM_READWRITE),
     }
 
+    # The maximum size of the cached reference labels, in bytes.
+    LABEL_CACHE_SIZE = 4 * 1024 * 1024
+
     def __init__(self):
         gtk.GenericCellRenderer.__init__(self)
         self.references = []
+        self._style = None
+        self._text_height = None
+
+        # Each reference's label is drawn once into its own surface, and
+        # copied into the cell from then on.
+        self._labels = LRUCache(self.LABEL_CACHE_SIZE,
+            lambda label: label[0].get_stride() * label[0].get_height())
 
     def do_set_property(self, pspec, value):
         setattr(self, pspec.name, value)
@@ -24,6 +41,30 @@ class ReferencesCellRenderer(gtk.GenericCellRenderer):
     def do_get_property(self, pspec):
         return getattr(self, pspec.name)
 
+    def check_style(self, widget):
+        """Drops everything cached if the widget's style has changed.
+
+        The cached labels depend on the font and theme, which come from
+        the style. Returns True if the style changed.
+        """
+        style = widget.get_style()
+
+        if style is self._style:
+            return False
+
+        self._style = style
+        self._text_height = None
+        self._labels.clear()
+
+        return True
+
+    def clear_labels(self):
+        """Drops the cached reference labels.
+
+        This should be called when the references change.
+        """
+        self._labels.clear()
+
     def build_box_layout(self, text, widget):
         layout = widget.create_pango_layout("")
         layout.set_markup("<small>%s</small>" % text)
@@ -37,9 +78,16 @@ class ReferencesCellRenderer(gtk.GenericCellRenderer):
             widget, "cellrenderertext",
             x_offset, y_offset, layout)
 
-    def draw_box(self, ctx, window, widget, expose_area,
-                 text, x_offset, y_offset, fill_color, stroke_color):
-        layout = self.build_box_layout(text, widget)
+    def draw_label_text(self, ctx, layout, widget, x_offset, y_offset):
+        pango_ctx = pangocairo.CairoContext(ctx)
+        pango_ctx.update_layout(layout)
+        pango_ctx.set_source_color(
+            widget.get_style().text[gtk.STATE_NORMAL])
+        pango_ctx.move_to(x_offset, y_offset)
+        pango_ctx.show_layout(layout)
+
+    def draw_box(self, ctx, widget, layout, x_offset, y_offset,
+                 fill_color, stroke_color):
         text_width, text_height = layout.get_pixel_size()
         width = text_width + 10
         height = text_height + 3
@@ -52,70 +100,135 @@ class ReferencesCellRenderer(gtk.GenericCellRenderer):
                            stroke_color[2])
         ctx.stroke()
 
-        self.draw_text(layout, window, widget, expose_area,
-                       x_offset + (width  - text_width)  / 2,
-                       y_offset + (height - text_height) / 2)
+        self.draw_label_text(ctx, layout, widget,
+                             x_offset + (width  - text_width)  / 2,
+                             y_offset + (height - text_height) / 2)
 
         return width + 1
 
-    def render_reference(self, ctx, window, widget, expose_area,
-                         ref, x_offset, y_offset):
-        parts = ref.name.split("/")
+    def draw_tag(self, ctx, widget, layout, x_offset, y_offset):
+        text_width, text_height = layout.get_pixel_size()
+        width = text_width + 14
+        height = text_height + 4
+
+        x1 = x_offset + 0.5
+        x2 = x1 + width
+        y1 = y_offset + 0.5
+        y2 = y1 + height
+
+        ctx.move_to(x1, y1 + height / 2)
+        ctx.line_to(x1 + 5, y1)
+        ctx.line_to(x2, y1)
+        ctx.line_to(x2, y2)
+        ctx.line_to(x1 + 5, y2)
+        ctx.line_to(x1, y1 + height / 2)
+
+        ctx.set_source_rgb(1.00, 0.91, 0.51)
+        ctx.fill_preserve()
 
-        ctx.set_line_width(1)
+        ctx.set_source_rgb(0.87, 0.73, 0.1)
+        ctx.stroke()
+
+        self.draw_label_text(ctx, layout, widget,
+                             x_offset + (width  - text_width)  / 2 + 2,
+                             y_offset + (height - text_height) / 2)
+
+        return width + 1
+
+    def get_label(self, widget, ref):
+        """Returns the label for a reference.
+
+        The label is a tuple of (surface, width), where width is how far
+        the next label should be placed. This is None for references of
+        an unknown type.
+        """
+        label = self._labels.get(ref.name)
+
+        if label is None:
+            label = self.__build_label(widget, ref)
+
+        return label
+
+    def __build_label(self, widget, ref):
+        parts = ref.name.split("/")
 
         if parts[0] == "heads":
-            x_offset += self.draw_box(ctx, window, widget, expose_area,
-                                      parts[1], x_offset, y_offset,
-                                      (0.5, 1, 0.5), (0.2, 0.65, 0.2))
+            boxes = [(parts[1], (0.5, 1, 0.5), (0.2, 0.65, 0.2))]
         elif parts[0] == "remotes":
-            x_offset += self.draw_box(ctx, window, widget, expose_area,
-                                      "/".join(parts[:-1]), x_offset, y_offset,
-                                      (0.96, 0.78, 0.48),
-                                      (0.56, 0.35, 0.01))
-            x_offset += self.draw_box(ctx, window, widget, expose_area,
-                                      parts[-1], x_offset - 1, y_offset,
-                                      (0.5, 1, 0.5), (0.2, 0.65, 0.2))
+            boxes = [("/".join(parts[:-1]),
+                      (0.96, 0.78, 0.48), (0.56, 0.35, 0.01)),
+                     (parts[-1], (0.5, 1, 0.5), (0.2, 0.65, 0.2))]
         elif parts[0] == "tags":
-            layout = self.build_box_layout(parts[1], widget)
+            boxes = [(parts[1], None, None)]
+        elif parts[0] == "stash":
+            boxes = [(parts[0], (0.9, 0.9, 0.9), (0.2, 0.2, 0.2))]
+        else:
+            return None
+
+        # Measure the text first, so the surface is exactly the size of
+        # the label.
+        layouts = [self.build_box_layout(box[0], widget) for box in boxes]
+        width = 0
+        height = 0
+
+        for layout, box in zip(layouts, boxes):
             text_width, text_height = layout.get_pixel_size()
-            width = text_width + 14
-            height = text_height + 4
 
-            x1 = x_offset + 0.5
-            x2 = x1 + width
-            y1 = y_offset + 0.5
-            y2 = y1 + height
+            if box[1]:
+                width += text_width + 11
+                height = max(height, text_height + 3)
+            else:
+                width += text_width + 15
+                height = max(height, text_height + 4)
 
-            ctx.move_to(x1, y1 + height / 2)
-            ctx.line_to(x1 + 5, y1)
-            ctx.line_to(x2, y1)
-            ctx.line_to(x2, y2)
-            ctx.line_to(x1 + 5, y2)
-            ctx.line_to(x1, y1 + height / 2)
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width + 1,
+                                     height + 2)
+        ctx = cairo.Context(surface)
+        ctx.set_line_width(1)
+        x_offset = 0
+
+        for layout, (text, fill_color, stroke_color) in zip(layouts, boxes):
+            if fill_color:
+                # Boxes after the first share a border with the one before.
+                x_offset += self.draw_box(ctx, widget, layout,
+                                          max(x_offset - 1, 0), 0,
+                                          fill_color, stroke_color)
+            else:
+                x_offset += self.draw_tag(ctx, widget, layout, x_offset, 0)
 
-            ctx.set_source_rgb(1.00, 0.91, 0.51)
-            ctx.fill_preserve()
+        label = (surface, width)
+        self._labels.set(ref.name, label)
 
-            ctx.set_source_rgb(0.87, 0.73, 0.1)
-            ctx.stroke()
+        return label
 
-            self.draw_text(layout, window, widget, expose_area,
-                           x_offset + (width  - text_width)  / 2 + 2,
-                           y_offset + (height - text_height) / 2)
+    def render_reference(self, ctx, window, widget, expose_area,
+                         ref, x_offset, y_offset):
+        label = self.get_label(widget, ref)
 
-            x_offset += width + 1
-        elif parts[0] == "stash":
-            x_offset += self.draw_box(ctx, window, widget, expose_area,
-                                      parts[0], x_offset, y_offset,
-                                      (0.9, 0.9, 0.9), (0.2, 0.2, 0.2))
-        else:
+        if not label:
             return (False, x_offset)
 
-        return (True, x_offset)
+        surface, width = label
+        ctx.set_source_surface(surface, x_offset, y_offset)
+        ctx.paint()
 
+        return (True, x_offset + width)
+
+    def get_reference_width(self, widget, ref):
+        """Returns the width render_reference uses for a reference.
+
+        This is 0 for references of an unknown type.
+        """
+        label = self.get_label(widget, ref)
+
+        if label:
+            return label[1]
+
+        return 0
 
     def on_render(self, window, widget, bg_area, cell_area, expose_area, flags):
+        self.check_style(widget)
+
         ctx = window.cairo_create()
         ctx.rectangle(bg_area.x, bg_area.y, bg_area.width, bg_area.height)
         ctx.clip()
@@ -125,21 +238,23 @@ class ReferencesCellRenderer(gtk.GenericCellRenderer):
 
         # Draw the tags and branches
         for ref in self.references:
-            self.render_reference(ctx, window, widget, expose_area,
-                                  ref, x_offset, y_offset)
+            known, x_offset = self.render_reference(ctx, window, widget,
+                                                    expose_area, ref,
+                                                    x_offset, y_offset)
 
 
     def on_get_size(self, widget, cell_area=None):
-        layout = self.build_box_layout("", widget)
-        text_width, text_height = layout.get_pixel_size()
+        self.check_style(widget)
 
-        names_len = 0
+        if self._text_height is None:
+            layout = self.build_box_layout("", widget)
+            self._text_height = layout.get_pixel_size()[1]
 
-        for ref in self.references:
-            names_len += len(ref.name)
+        width = 0
+        height = self._text_height + 3
 
-        width = names_len
-        height = text_height + 3
+        for ref in self.references:
+            width += self.get_reference_width(widget, ref)
 
         return (0, 0, width, height)
 
@@ -150,11 +265,31 @@ class CommitCellRenderer(ReferencesCellRenderer):
                    gobject.PARAM_READWRITE),
     }
 
+    # The number of commits to keep message layouts and reference
+    # positions for.
+    LAYOUT_CACHE_SIZE = 2048
+
+    # The maximum size of the cached graph drawings, in bytes.
+    GRAPH_CACHE_SIZE = 8 * 1024 * 1024
+
     def __init__(self):
         ReferencesCellRenderer.__init__(self)
         self.commit = None
         self._box_size = None
 
+        self._layouts = LRUCache(self.LAYOUT_CACHE_SIZE, lambda entry: 1)
+        self._ref_positions = LRUCache(self.LAYOUT_CACHE_SIZE,
+                                       lambda entry: 1)
+
+        # Most rows in a history have the same lines running through
+        # them, so the graph part of a row is drawn once per distinct
+        # set of lines and node, and copied from then on.
+        self._graph_surfaces = LRUCache(self.GRAPH_CACHE_SIZE,
+            lambda surface: surface.get_stride() * surface.get_height())
+
+        # The number of rows rendered, for the trace.
+        self.render_count = 0
+
     def do_set_property(self, pspec, value):
         setattr(self, pspec.name, value)
 
@@ -163,109 +298,46 @@ class CommitCellRenderer(ReferencesCellRenderer):
 
 
     def on_render(self, window, widget, bg_area, cell_area, expose_area, flags):
+        self.check_style(widget)
+        self.render_count += 1
+
         ctx = window.cairo_create()
         ctx.rectangle(bg_area.x, bg_area.y, bg_area.width, bg_area.height)
         ctx.clip()
 
         box_size = self.__get_box_size(widget)
 
-        ctx.set_line_width(box_size / 8)
-        ctx.set_line_cap(cairo.LINE_CAP_SQUARE)
-
-        bg_area_y2 = bg_area.y + bg_area.height
-
-        # Draw the lines into the cell
-        for start, end, color in self.commit.in_lines:
-            ctx.move_to(cell_area.x + box_size * start + box_size / 2,
-                        bg_area.y - bg_area.height / 2)
-
-            if start - end > 1:
-                ctx.line_to(cell_area.x + box_size * start, bg_area.y)
-                ctx.line_to(cell_area.x + box_size * end + box_size, bg_area.y)
-            elif start - end < -1:
-                ctx.line_to(cell_area.x + box_size * start + box_size,
-                            bg_area.y)
-                ctx.line_to(cell_area.x + box_size * end, bg_area.y)
-
-            ctx.line_to(cell_area.x + box_size * end + box_size / 2,
-                        bg_area.y + bg_area.height / 2)
-
-            self.set_color(ctx, color, 0, 0.65)
-            ctx.stroke()
-
-        # Draw the lines out of the cell
-        for start, end, color in self.commit.out_lines:
-            ctx.move_to(cell_area.x + box_size * start + box_size / 2,
-                        bg_area.y + bg_area.height / 2)
-
-            if start - end > 1:
-                ctx.line_to(cell_area.x + box_size * start, bg_area_y2)
-                ctx.line_to(cell_area.x + box_size * end + box_size, bg_area_y2)
-            elif start - end < -1:
-                ctx.line_to(cell_area.x + box_size * start + box_size,
-                            bg_area_y2)
-                ctx.line_to(cell_area.x + box_size * end, bg_area_y2)
-
-            ctx.line_to(cell_area.x + box_size * end + box_size / 2,
-                        bg_area.y + bg_area.height * 1.5)
-
-            self.set_color(ctx, color, 0, 0.65)
-            ctx.stroke()
+        # Draw the lines and the revision node
+        surface = self.__get_graph_surface(bg_area, cell_area, box_size)
+        ctx.set_source_surface(surface, cell_area.x, bg_area.y)
+        ctx.paint()
 
-        # Draw the revision node in the right column
+        # Draw the tags and branches
         column, color = self.commit.node
-        x_offset = cell_area.x + box_size * column + box_size / 2
-        ctx.arc(x_offset, cell_area.y + cell_area.height / 2,
-                box_size / 4, 0, 2 * math.pi)
-
-        self.set_color(ctx, color, 0, 0.5)
-        ctx.stroke_preserve()
-
-        self.set_color(ctx, color, 0.5, 1)
-        ctx.fill()
-
-        #x_offset = box_size * column + box_size
-        #y_offset = (cell_area.height - text_height) / 2
-
         line_y = cell_area.y + cell_area.height / 2
-        x_offset += box_size / 4 + 1
         y_offset = cell_area.y + 1
 
+        ref_positions, text_x = self.__get_ref_positions(widget, box_size)
         self.commit.ref_boxes = []
 
-        # Draw the tags and branches
-        for ref in self.commit.references:
+        ctx.set_line_cap(cairo.LINE_CAP_SQUARE)
+
+        for line_x, ref, box in ref_positions:
             # Draw the line to the box
             ctx.set_line_width(box_size / 8)
-            ctx.move_to(x_offset, line_y)
-            x_offset += box_size / 2
-            ctx.line_to(x_offset, line_y)
+            ctx.move_to(cell_area.x + line_x, line_y)
+            ctx.line_to(cell_area.x + line_x + box_size / 2, line_y)
             self.set_color(ctx, color, 0, 0.5)
             ctx.stroke()
 
-            parts = ref.name.split("/")
-
-            box = {
-                'ref': ref.name,
-                'type': parts[0],
-                'x': x_offset - cell_area.x,
-                'y': y_offset - cell_area.y,
-                'width': 0,
-                'height': cell_area.height,
-            }
-
-            known, x_offset = self.render_reference(ctx, window, widget,
-                                                    expose_area, ref,
-                                                    x_offset, y_offset)
-
-            if known:
-                box['width'] = x_offset - box['x']
+            if box:
+                self.render_reference(ctx, window, widget, expose_area, ref,
+                                      cell_area.x + box['x'], y_offset)
+                box['height'] = cell_area.height
                 self.commit.ref_boxes.append(box)
 
-
-        layout = self.__build_layout(widget)
-        text_width, text_height = layout.get_pixel_size()
-        x_offset += 10
+        layout, text_width, text_height = self.__get_layout(widget)
+        x_offset = cell_area.x + text_x + 10
         y_offset = cell_area.y + (cell_area.height - text_height) / 2
 
         if flags & gtk.CELL_RENDERER_SELECTED:
@@ -280,6 +352,8 @@ class CommitCellRenderer(ReferencesCellRenderer):
                        x_offset, y_offset, state)
 
     def on_get_size(self, widget, cell_area=None):
+        self.check_style(widget)
+
         box_size = self.__get_box_size(widget)
 
         cols = self.commit.node[0]
@@ -293,6 +367,151 @@ class CommitCellRenderer(ReferencesCellRenderer):
 
         return (x, y, w, h)
 
+    def check_style(self, widget):
+        if not ReferencesCellRenderer.check_style(self, widget):
+            return False
+
+        self._box_size = None
+        self._layouts.clear()
+        self._ref_positions.clear()
+        self._graph_surfaces.clear()
+
+        return True
+
+    def __get_layout(self, widget):
+        """Returns the commit message layout and its size."""
+        entry = self._layouts.get(self.commit.sha1)
+
+        if entry is None:
+            layout = self.__build_layout(widget)
+            text_width, text_height = layout.get_pixel_size()
+            entry = (layout, text_width, text_height)
+            self._layouts.set(self.commit.sha1, entry)
+
+        return entry
+
+    def __get_ref_positions(self, widget, box_size):
+        """Returns where the commit's references go in the cell.
+
+        This returns a list of (line_x, ref, box) tuples, along with the
+        position of the message text. box is None for references of an
+        unknown type. Positions are relative to the cell.
+        """
+        commit = self.commit
+        entry = self._ref_positions.get(commit.sha1)
+
+        # The positions depend on the column the commit was laid out in,
+        # and on its references. Both can change on a refresh.
+        if (entry is not None and entry[0] == commit.node and
+            entry[1] is commit.references):
+            return entry[2], entry[3]
+
+        column = commit.node[0]
+        x_offset = box_size * column + box_size / 2 + box_size / 4 + 1
+        positions = []
+
+        for ref in commit.references:
+            line_x = x_offset
+            x_offset += box_size / 2
+            width = self.get_reference_width(widget, ref)
+
+            if width:
+                parts = ref.name.split("/")
+                box = {
+                    'ref': ref.name,
+                    'type': parts[0],
+                    'x': x_offset,
+                    'y': 1,
+                    'width': width,
+                    'height': 0,
+                }
+                x_offset += width
+            else:
+                box = None
+
+            positions.append((line_x, ref, box))
+
+        self._ref_positions.set(commit.sha1, (commit.node, commit.references,
+                                              positions, x_offset))
+
+        return positions, x_offset
+
+    def __get_graph_surface(self, bg_area, cell_area, box_size):
+        """Returns a drawing of the commit's lines and node.
+
+        The drawing starts at the left of the cell and the top of the
+        background area.
+        """
+        commit = self.commit
+        cell_y = cell_area.y - bg_area.y
+        key = (commit.node, tuple(commit.in_lines), tuple(commit.out_lines),
+               box_size, bg_area.height, cell_y, cell_area.height)
+        surface = self._graph_surfaces.get(key)
+
+        if surface is not None:
+            return surface
+
+        columns = commit.node[0]
+
+        for start, end, color in commit.in_lines + commit.out_lines:
+            columns = max(columns, start, end)
+
+        height = bg_area.height
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                     box_size * (columns + 1) + 1, height)
+        ctx = cairo.Context(surface)
+
+        ctx.set_line_width(box_size / 8)
+        ctx.set_line_cap(cairo.LINE_CAP_SQUARE)
+
+        # Draw the lines into the cell
+        for start, end, color in commit.in_lines:
+            ctx.move_to(box_size * start + box_size / 2, -height / 2)
+
+            if start - end > 1:
+                ctx.line_to(box_size * start, 0)
+                ctx.line_to(box_size * end + box_size, 0)
+            elif start - end < -1:
+                ctx.line_to(box_size * start + box_size, 0)
+                ctx.line_to(box_size * end, 0)
+
+            ctx.line_to(box_size * end + box_size / 2, height / 2)
+
+            self.set_color(ctx, color, 0, 0.65)
+            ctx.stroke()
+
+        # Draw the lines out of the cell
+        for start, end, color in commit.out_lines:
+            ctx.move_to(box_size * start + box_size / 2, height / 2)
+
+            if start - end > 1:
+                ctx.line_to(box_size * start, height)
+                ctx.line_to(box_size * end + box_size, height)
+            elif start - end < -1:
+                ctx.line_to(box_size * start + box_size, height)
+                ctx.line_to(box_size * end, height)
+
+            ctx.line_to(box_size * end + box_size / 2, height * 1.5)
+
+            self.set_color(ctx, color, 0, 0.65)
+            ctx.stroke()
+
+        # Draw the revision node in the right column
+        column, color = commit.node
+        ctx.arc(box_size * column + box_size / 2,
+                cell_y + cell_area.height / 2,
+                box_size / 4, 0, 2 * math.pi)
+
+        self.set_color(ctx, color, 0, 0.5)
+        ctx.stroke_preserve()
+
+        self.set_color(ctx, color, 0.5, 1)
+        ctx.fill()
+
+        self._graph_surfaces.set(key, surface)
+
+        return surface
+
     def __build_layout(self, widget):
         layout = widget.create_pango_layout("")
         layout.set_markup("<small>%s</small>" % escape(self.commit.message))
@@ -328,6 +547,197 @@ class CommitCellRenderer(ReferencesCellRenderer):
         return self._box_size
 
 
+class CommitsModel(gtk.GenericTreeModel):
+    """A list model over the commits in a CommitGraph.
+
+    The rows are the graph's commits themselves, so the model stores
+    nothing per row. The author and date markup is built only for the
+    rows being displayed.
+
+    While a refresh is loading, the graph's old history is kept as it
+    was, and the new commits are shown above it until the refresh
+    finishes.
+    """
+    (COLUMN_COMMIT,
+     COLUMN_AUTHOR,
+     COLUMN_DATE) = range(3)
+
+    COLUMN_TYPES = (gobject.TYPE_PYOBJECT, gobject.TYPE_STRING,
+                    gobject.TYPE_STRING)
+
+    def __init__(self, graph):
+        gtk.GenericTreeModel.__init__(self)
+
+        # The commits are kept alive by the graph, so the iters don't
+        # need to hold references to them.
+        self.set_property("leak-references", False)
+
+        self.graph = graph
+
+        # The commits in the history. Only the first count of them are
+        # rows, as the graph may have read commits that haven't been
+        # laid out yet.
+        self.commits = []
+        self.ordinals = {}
+        self.ordinal_offset = 0
+        self.count = 0
+
+        # The commits added by a refresh, which go above the others.
+        self.new_commits = []
+        self.new_ordinals = {}
+
+    def reset(self):
+        """Empties the model.
+
+        This doesn't signal each row's removal, so the model should be
+        taken off its view first.
+        """
+        self.invalidate_iters()
+        self.__bind()
+        self.count = 0
+        self.new_commits = []
+        self.new_ordinals = {}
+
+    def append(self, commits):
+        """Adds commits to the bottom of the history.
+
+        The commits must be the next ones in the graph.
+        """
+        self.__bind()
+
+        for i in xrange(len(commits)):
+            path = (len(self.new_commits) + self.count,)
+            self.count += 1
+            self.row_inserted(path, self.get_iter(path))
+
+    def insert_new(self, commits):
+        """Adds commits from a refresh, below those already added."""
+        for commit in commits:
+            path = (len(self.new_commits),)
+            self.new_ordinals[commit.sha1] = len(self.new_commits)
+            self.new_commits.append(commit)
+            self.row_inserted(path, self.get_iter(path))
+
+    def remove_new(self):
+        """Removes the commits added by a cancelled refresh."""
+        while self.new_commits:
+            commit = self.new_commits.pop()
+            del self.new_ordinals[commit.sha1]
+            self.row_deleted((len(self.new_commits),))
+
+    def update(self):
+        """Catches up with the graph once loading has finished.
+
+        Any commits added by a refresh become part of the history.
+        """
+        self.__bind()
+        self.count += len(self.new_commits)
+        self.new_commits = []
+        self.new_ordinals = {}
+
+    def get_commit_path(self, commit):
+        """Returns the path of a commit's row, or None."""
+        return self.get_sha1_path(commit.sha1)
+
+    def get_sha1_path(self, sha1):
+        """Returns the path of the row for a binary SHA-1, or None."""
+        i = self.__get_index(sha1)
+
+        if i is None:
+            return None
+
+        return (i,)
+
+    def __bind(self):
+        self.commits = self.graph.commits
+        self.ordinals = self.graph.ordinals
+        self.ordinal_offset = self.graph.ordinal_offset
+
+    def __get_index(self, sha1):
+        i = self.new_ordinals.get(sha1)
+
+        if i is not None:
+            return i
+
+        i = self.ordinals.get(sha1)
+
+        if i is None:
+            return None
+
+        i += self.ordinal_offset
+
+        if i >= self.count:
+            return None
+
+        return i + len(self.new_commits)
+
+    def __get_row(self, i):
+        num_new = len(self.new_commits)
+
+        if i < num_new:
+            return self.new_commits[i]
+
+        i -= num_new
+
+        if 0 <= i < self.count:
+            return self.commits[i]
+
+        return None
+
+    def on_get_flags(self):
+        return gtk.TREE_MODEL_LIST_ONLY | gtk.TREE_MODEL_ITERS_PERSIST
+
+    def on_get_n_columns(self):
+        return len(self.COLUMN_TYPES)
+
+    def on_get_column_type(self, index):
+        return self.COLUMN_TYPES[index]
+
+    def on_get_iter(self, path):
+        return self.__get_row(path[0])
+
+    def on_get_path(self, commit):
+        return (self.__get_index(commit.sha1),)
+
+    def on_get_value(self, commit, column):
+        if column == self.COLUMN_COMMIT:
+            return commit
+        elif column == self.COLUMN_AUTHOR:
+            i = commit.author.find("<")
+            return "<small>%s</small>" % escape(commit.author[0:i - 1])
+        elif column == self.COLUMN_DATE:
+            return "<small>%s</small>" % escape(commit.date)
+
+        return None
+
+    def on_iter_next(self, commit):
+        return self.__get_row(self.__get_index(commit.sha1) + 1)
+
+    def on_iter_children(self, commit):
+        if commit is None:
+            return self.__get_row(0)
+
+        return None
+
+    def on_iter_has_child(self, commit):
+        return False
+
+    def on_iter_n_children(self, commit):
+        if commit is None:
+            return len(self.new_commits) + self.count
+
+        return 0
+
+    def on_iter_nth_child(self, commit, n):
+        if commit is None:
+            return self.__get_row(n)
+
+        return None
+
+    def on_iter_parent(self, commit):
+        return None
+
+
 class CommitsTree(gtk.TreeView):
     __gsignals__ = {
         'commit_changed': (gobject.SIGNAL_RUN_FIRST,
@@ -336,73 +746,475 @@ class CommitsTree(gtk.TreeView):
         'references_changed': (gobject.SIGNAL_RUN_FIRST,
                                gobject.TYPE_NONE,
                                (gobject.TYPE_PYOBJECT,)),
+        'load_progress': (gobject.SIGNAL_RUN_FIRST,
+                          gobject.TYPE_NONE,
+                          (gobject.TYPE_INT,)),
+        'load_finished': (gobject.SIGNAL_RUN_FIRST,
+                          gobject.TYPE_NONE,
+                          (gobject.TYPE_BOOLEAN,)),
     }
 
-    COLUMN_COMMIT = 0
-    COLUMN_AUTHOR = 1
-    COLUMN_DATE = 2
+    # The number of commits to add to the search index per main loop
+    # iteration.
+    INDEX_CHUNK_SIZE = 2000
 
-    def __init__(self):
-        self.model = gtk.ListStore(gobject.TYPE_PYOBJECT, # Commit
-                                   gobject.TYPE_STRING,   # Author
-                                   gobject.TYPE_STRING)   # Date
+    # The number of rows to add per main loop iteration when the history
+    # comes from the cache.
+    FILL_CHUNK_SIZE = 5000
+
+    # Queries whose words are all shorter than this match most of the
+    # history, so only their first SHORT_QUERY_LIMIT matches are found.
+    SHORT_QUERY_LENGTH = 3
+    SHORT_QUERY_LIMIT = 1000
+
+    COLUMN_COMMIT = CommitsModel.COLUMN_COMMIT
+
+    def __init__(self, path=None, pool=None):
+        self.graph = CommitGraph(path, pool)
+        self.model = CommitsModel(self.graph)
 
         gtk.TreeView.__init__(self, self.model)
 
         self.selected_commit = None
+
+        # The references, by name. These are known as soon as loading
+        # starts, before their commits have been read.
         self.references = {}
 
-        column = gtk.TreeViewColumn("Commit", CommitCellRenderer(),
+        # The binary SHA-1 of a commit to select once it's loaded.
+        self.pending_sha1 = None
+
+        self.commit_renderer = CommitCellRenderer()
+        column = gtk.TreeViewColumn("Commit", self.commit_renderer,
                                     commit=self.COLUMN_COMMIT)
         column.set_resizable(True)
         column.set_expand(True)
         self.append_column(column)
 
         column = gtk.TreeViewColumn("Author", gtk.CellRendererText(),
-                                    markup=self.COLUMN_AUTHOR)
+                                    markup=CommitsModel.COLUMN_AUTHOR)
         column.set_resizable(True)
         self.append_column(column)
 
         column = gtk.TreeViewColumn("Date", gtk.CellRendererText(),
-                                    markup=self.COLUMN_DATE)
+                                    markup=CommitsModel.COLUMN_DATE)
         column.set_resizable(True)
         #column.set_sizing(gtk.TREE_VIEW_COLUMN_AUTOSIZE)
         self.append_column(column)
 
         self.connect("button-press-event", self.on_button_press)
+
+        # Each redraw of the list is traced.
+        self._render_span = None
+        self.connect("expose-event", self.__on_expose_start)
+        self.connect_after("expose-event", self.__on_expose_end)
         self.get_selection().connect("changed", self.on_selection_changed)
 
-        self.set_search_equal_func(self.__search_equal_func)
-        self.set_search_column(self.COLUMN_COMMIT)
+        # Searching is done through the search index instead, which
+        # doesn't have to look at every row.
+        self.set_enable_search(False)
+
+        self.search_index = SearchIndex()
+        self.search_text = ""
 
-        self.graph = CommitGraph()
+        self._load_watch_id = None
+        self._load_slot = None
+        self._load_refresh = False
+        self._refreshing = False
+        self._fill_commits = None
+        self._fill_pos = 0
+        self._index_queue = []
+        self._index_pos = 0
+        self._index_id = None
+
+        self.connect('destroy', self.__on_destroy)
+
+    def __on_destroy(self, widget):
+        self.__stop_load()
+        self.__clear_index()
+        self.graph.close()
 
     def update_commits(self):
-        self.model.clear()
-        self.references = {}
+        """Reloads the commit history.
+
+        The history is read from git in the background and added to the
+        list in batches as it arrives, so the first commits show up
+        without waiting on the rest of the history.
+        """
+        self.__start_load(False)
+
+    def refresh_commits(self):
+        """Loads the commits added since the history was last loaded.
+
+        The new commits are added above the existing ones, and the
+        selection and the rows in view are kept. If the history was
+        rewritten, it's reloaded in full instead.
+        """
+        self.__start_load(True)
+
+    def __start_load(self, refresh):
+        self.cancel_load()
+
+        # The main loop can't wait for git, so the load starts once the
+        # pool has a slot for it.
+        self._load_refresh = refresh
+        self._load_slot = self.graph.pool.request_slot(self.graph.path,
+                                                       self.__on_load_slot)
+
+        if self._load_slot.granted:
+            self.__begin_load(self._load_slot)
+
+    def __on_load_slot(self, slot):
+        # This is called from whichever thread gave back a slot.
+        gobject.idle_add(self.__begin_load, slot)
+
+    def __begin_load(self, slot):
+        if slot is not self._load_slot:
+            # The load was cancelled or started again while it waited.
+            return False
+
+        self._load_slot = None
+        pipeline = self.graph.start_load(self._load_refresh, slot)
+        self._refreshing = self.graph.refreshing
+
+        if not self._refreshing:
+            # Taking the model off the view while the history is
+            # replaced saves signalling the removal of every row.
+            self.set_model(None)
+            self.model.reset()
+            self.set_model(self.model)
+            self.__clear_index()
+
+        self.__update_references()
+
+        if not pipeline:
+            # Nothing needed to be read.
+            commits = self.graph.finish_load()
+
+            if self._refreshing or len(commits) <= self.FILL_CHUNK_SIZE:
+                self.__append_commits(commits)
+                self.__finish_load(False)
+
+                return False
+
+            # The view looks at every row it's given, so a history from
+            # the cache is added a chunk at a time. That way its first
+            # rows show without every commit being created first.
+            self._fill_commits = commits
+            self._fill_pos = 0
+            self.__fill_next_chunk()
+            self._load_watch_id = gobject.idle_add(
+                self.__fill_next_chunk, priority=gobject.PRIORITY_DEFAULT_IDLE)
+
+            return False
+
+        # This runs below the redraw priority so that the list keeps
+        # painting while history is streaming in.
+        self._load_watch_id = gobject.io_add_watch(
+            pipeline.fileno(), gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR,
+            self.__on_history_data, priority=gobject.PRIORITY_DEFAULT_IDLE)
 
-        for commit in self.graph.get_commits():
-            i = commit.author.find("<")
-            author_name = commit.author[0:i - 1]
-            iter = self.model.append((
-                commit,
-                "<small>%s</small>" % escape(author_name),
-                "<small>%s</small>" % escape(commit.date)
-            ))
+        return False
+
+    def cancel_load(self):
+        """Stops loading the commit history, if it's still loading."""
+        if self.__stop_load():
+            self.__finish_load(True)
+
+    def is_loading(self):
+        return self._load_watch_id is not None or self._load_slot is not None
+
+    def __stop_load(self):
+        if self._load_slot is not None:
+            # Nothing has been loaded while waiting for a slot.
+            self.graph.pool.release_slot(self._load_slot)
+            self._load_slot = None
+
+            return False
+
+        if self._load_watch_id is None:
+            return False
+
+        gobject.source_remove(self._load_watch_id)
+
+        if self._fill_commits is not None:
+            # The history has already been loaded, so the rest of it is
+            # added rather than thrown away.
+            self.__fill_next_chunk(len(self._fill_commits))
+
+            return False
+
+        self._load_watch_id = None
+        self.graph.cancel_load()
+
+        if self._refreshing:
+            # Take out the rows this refresh added.
+            self.model.remove_new()
+
+        return True
+
+    def __on_history_data(self, fd, condition):
+        span = tracer.span("layout", "history batch")
+        commits = self.graph.read_pipeline()
+
+        if commits is not None:
+            self.__append_commits(commits)
+            span.args['commits'] = len(commits)
+            span.finish()
 
-            for ref in commit.references:
-                self.references[ref] = iter;
+            self.__emit_progress()
 
-        self.emit('references_changed', self.references.keys())
+            return True
+
+        self._load_watch_id = None
+        self.__append_commits(self.graph.finish_load())
+        self.__finish_load(False)
+
+        return False
+
+    def __fill_next_chunk(self, count=FILL_CHUNK_SIZE):
+        start = self._fill_pos
+        end = self._fill_pos = start + count
+        self.__append_commits(self._fill_commits[start:end])
+        self.__emit_progress()
+
+        if end < len(self._fill_commits):
+            return True
+
+        self._fill_commits = None
+        self._fill_pos = 0
+        self._load_watch_id = None
+        self.__finish_load(False)
+
+        return False
+
+    def __emit_progress(self):
+        if self._refreshing:
+            self.emit('load_progress', len(self.model.new_commits))
+        else:
+            self.emit('load_progress', self.model.count)
+
+    def __append_commits(self, commits):
+        if self._refreshing:
+            self.__insert_commits(commits)
+            return
+
+        self.model.append(commits)
+        self.__queue_index(commits)
+        self.__select_pending()
+
+    def __insert_commits(self, commits):
+        if not commits:
+            return
+
+        visible_range = self.get_visible_range()
+
+        self.model.insert_new(commits)
+
+        if visible_range:
+            # Keep the rows that were in view where they were.
+            top_row = visible_range[0][0] + len(commits)
+            self.scroll_to_cell((top_row,), None, True, 0.0, 0.0)
+
+        self.__select_pending()
+
+    def __finish_load(self, cancelled):
+        new_commits = len(self.model.new_commits)
+        self.model.update()
+
+        if new_commits:
+            # These are few enough to index right away. Commits still
+            # waiting to be indexed go below them.
+            self.search_index.prepend(self.graph.commits[:new_commits])
+
+        if self._refreshing:
+            # The rows below the new ones may have been laid out again.
+            self._refreshing = False
+            self.queue_draw()
+
+        if cancelled:
+            # A cancelled refresh goes back to the old references.
+            self.__update_references()
+
+        self.__select_pending()
+        self.pending_sha1 = None
+
+        self.emit('load_finished', cancelled)
 
         self.queue_resize()
 
+    def __queue_index(self, commits):
+        """Queues commits to add to the search index when idle.
+
+        Commits from the cache are created as they're indexed, a chunk at
+        a time, rather than all at once.
+        """
+        self._index_queue.append(commits)
+
+        if self._index_id is None:
+            self._index_id = gobject.idle_add(self.__index_next_chunk,
+                                              priority=gobject.PRIORITY_LOW)
+
+    def __index_next_chunk(self):
+        commits = self._index_queue[0]
+        start = self._index_pos
+        end = start + self.INDEX_CHUNK_SIZE
+        self.search_index.append(commits[start:end])
+
+        if end < len(commits):
+            self._index_pos = end
+            return True
+
+        self._index_queue.pop(0)
+        self._index_pos = 0
+
+        if self._index_queue:
+            return True
+
+        self._index_id = None
+        self.search_index.sort()
+
+        return False
+
+    def __clear_index(self):
+        if self._index_id is not None:
+            gobject.source_remove(self._index_id)
+            self._index_id = None
+
+        self._index_queue = []
+        self._index_pos = 0
+        self.search_index.clear()
+
+    def search(self, text):
+        """Searches the commits for text.
+
+        The commit summaries, authors and SHA-1s are searched. The first
+        match at or below the cursor is selected. Returns the number of
+        matches, and whether that's all of them. A short query only finds
+        the first SHORT_QUERY_LIMIT.
+        """
+        self.search_text = text
+        rows, complete = self.__get_search_rows()
+        self.__select_search_row(rows, 0)
+
+        return len(rows), complete
+
+    def find_next(self):
+        """Selects the next match for the search, wrapping around."""
+        self.__select_search_row(self.__get_search_rows()[0], 1)
+
+    def find_previous(self):
+        """Selects the previous match for the search, wrapping around."""
+        self.__select_search_row(self.__get_search_rows()[0], -1)
+
+    def __get_search_rows(self):
+        words = self.search_text.split()
+
+        if not words:
+            return [], True
+
+        if max([len(word) for word in words]) < self.SHORT_QUERY_LENGTH:
+            limit = self.SHORT_QUERY_LIMIT
+        else:
+            limit = None
+
+        # Commits being added by a refresh aren't indexed until it
+        # finishes, and are shown above the ones that are.
+        top = len(self.model.new_commits)
+        num_rows = len(self.model)
+        ordinals = self.search_index.search(self.search_text, limit)
+        rows = set([ordinal + top for ordinal in ordinals
+                    if ordinal + top < num_rows])
+
+        for sha1 in self.search_index.find_sha1s(self.search_text):
+            path = self.model.get_sha1_path(sha1)
+
+            if path is not None:
+                rows.add(path[0])
+
+        return sorted(rows), limit is None or len(ordinals) < limit
+
+    def __select_search_row(self, rows, direction):
+        if not rows:
+            return
+
+        path = self.get_cursor()[0]
+
+        if path is None:
+            current = -1
+        else:
+            current = path[0]
+
+        if direction < 0:
+            i = bisect_left(rows, current) - 1
+        elif direction > 0:
+            i = bisect_right(rows, current)
+        else:
+            i = bisect_left(rows, current)
+
+        row = rows[i % len(rows)]
+        self.set_cursor((row,))
+        self.scroll_to_cell((row,), use_align=True, row_align=0.5)
+
+    def __update_references(self):
+        """Updates the references from those read for the graph."""
+        references = {}
+
+        for sha1, names in self.graph.bt_sha1.iteritems():
+            sha1 = unhexlify(sha1)
+            commit = self.graph.get_commit(sha1)
+
+            for name in names:
+                references[name] = Reference(name, commit, sha1)
+
+        if (sorted(references.keys()) == sorted(self.references.keys()) and
+            all([references[name].sha1 == self.references[name].sha1
+                 for name in references])):
+            return
+
+        self.references = references
+        self.commit_renderer.clear_labels()
+        self.emit('references_changed',
+                  [references[name] for name in sorted(references)])
+
     def select_reference(self, ref):
-        if ref in self.references:
-            iter = self.references[ref]
-            self.get_selection().select_iter(iter)
-            self.scroll_to_cell(self.model.get_path(iter), use_align=True,
-                                row_align=0.5)
+        """Selects the commit a reference points to.
+
+        If the commit hasn't been loaded yet, it's selected once it is.
+        """
+        ref = self.references.get(ref.name)
+
+        if ref is None:
+            return
+
+        self.pending_sha1 = ref.sha1
+        self.__select_pending()
+
+        if not self.is_loading():
+            # It isn't part of the loaded history.
+            self.pending_sha1 = None
+
+    def __select_pending(self):
+        if self.pending_sha1 is None:
+            return
+
+        path = self.model.get_sha1_path(self.pending_sha1)
+
+        if path is not None:
+            self.pending_sha1 = None
+            self.get_selection().select_path(path)
+            self.scroll_to_cell(path, use_align=True, row_align=0.5)
+
+    def __on_expose_start(self, widget, event):
+        self._render_span = tracer.span("render", "commits",
+            rows=-self.commit_renderer.render_count)
+
+    def __on_expose_end(self, widget, event):
+        if self._render_span:
+            self._render_span.args['rows'] += \
+                self.commit_renderer.render_count
+            self._render_span.finish()
+            self._render_span = None
 
     def on_button_press(self, widget, event):
         if event.button == 3:
@@ -439,13 +1251,6 @@ class CommitsTree(gtk.TreeView):
                 self.selected_commit = commit
                 self.emit('commit_changed', commit)
 
-    def __search_equal_func(self, model, column, key, iter):
-        commit = model.get(iter, column)[0]
-        assert isinstance(commit, Commit)
-
-        # Oddly, we return False to indicate a match.
-        return not commit.message.lower().startswith(key.lower())
-
 
 class ReferencesTree(gtk.TreeView):
     __gsignals__ = {
@@ -458,7 +1263,8 @@ class ReferencesTree(gtk.TreeView):
         self.model = gtk.ListStore(gobject.TYPE_PYOBJECT) # Commit
         gtk.TreeView.__init__(self, self.model)
 
-        column = gtk.TreeViewColumn("References", ReferencesCellRenderer(),
+        self.renderer = ReferencesCellRenderer()
+        column = gtk.TreeViewColumn("References", self.renderer,
                                     references=0)
         self.append_column(column)
 
@@ -470,6 +1276,7 @@ class ReferencesTree(gtk.TreeView):
 
     def load(self, references):
         self.model.clear()
+        self.renderer.clear_labels()
 
         for reference in references:
             self.model.append(([reference],))
@@ -34,4 +34,4 @@ class DiffViewer(gtk.HBox):
         sourceview.modify_font(pango.FontDescription("Monospace"))
 
     def set_diff(self, diff):
-        self.buffer.set_text(diff.contents)
+        self.buffer.set_text(diff.get_text())
@@ -0,0 +1,148 @@
+import threading
+import traceback
+
+import gobject
+
+from Gitty.git.client import CancelledError, Job
+from Gitty.tracing import tracer
+
+
+class DetailsLoader(object):
+    """Loads commit details in a worker thread.
+
+    Only the most recently requested commit matters. A new request
+    supersedes the one before it, killing its git process if it's still
+    running. Prefetch requests are handled when there's nothing else to
+    do.
+
+    load_func(commit, job) is called in the worker thread to do the
+    loading. callback(commit, result) is called in the main loop with
+    the result.
+    """
+    def __init__(self, load_func, callback):
+        self.load_func = load_func
+        self.callback = callback
+
+        # Loads are traced under the name of the function, without the
+        # class name private methods get.
+        self.trace_name = load_func.__name__.split("__")[-1]
+
+        self.condition = threading.Condition()
+        self.running = True
+        self.requested = None
+        self.prefetch_queue = []
+        self.job = None
+        self.job_commit = None
+
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def load(self, commit):
+        """Requests a commit's details, superseding earlier requests."""
+        self.condition.acquire()
+
+        try:
+            self.prefetch_queue = []
+
+            # A commit that's already being loaded isn't requested again,
+            # unless that load was cancelled and won't be delivered.
+            if (self.job and self.job_commit is commit and
+                not self.job.cancelled):
+                self.requested = None
+            else:
+                self.requested = commit
+
+                if self.job:
+                    self.job.cancel()
+
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def prefetch(self, commits):
+        """Queues commits to load once nothing else is requested."""
+        self.condition.acquire()
+
+        try:
+            self.prefetch_queue.extend(commits)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def cancel(self):
+        """Cancels all pending and running requests."""
+        self.condition.acquire()
+
+        try:
+            self.requested = None
+            self.prefetch_queue = []
+
+            if self.job:
+                self.job.cancel()
+        finally:
+            self.condition.release()
+
+    def shutdown(self):
+        self.condition.acquire()
+
+        try:
+            self.running = False
+            self.requested = None
+            self.prefetch_queue = []
+
+            if self.job:
+                self.job.cancel()
+
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def __run(self):
+        while True:
+            self.condition.acquire()
+
+            try:
+                while (self.running and not self.requested and
+                       not self.prefetch_queue):
+                    self.condition.wait()
+
+                if not self.running:
+                    return
+
+                if self.requested:
+                    commit = self.requested
+                    self.requested = None
+                else:
+                    commit = self.prefetch_queue.pop(0)
+
+                job = self.job = Job()
+                self.job_commit = commit
+            finally:
+                self.condition.release()
+
+            span = tracer.span("details", self.trace_name)
+
+            try:
+                result = self.load_func(commit, job)
+            except CancelledError:
+                result = None
+            except Exception:
+                traceback.print_exc()
+                result = None
+
+            span.args['cancelled'] = job.cancelled
+            span.finish()
+
+            self.condition.acquire()
+            self.job = None
+            self.job_commit = None
+            self.condition.release()
+
+            if result is not None and not job.cancelled:
+                gobject.idle_add(self.__deliver, commit, result)
+
+    def __deliver(self, commit, result):
+        self.callback(commit, result)
+
+        return False
@@ -1,3 +1,4 @@
+import gobject
 import gtk
 import pango
 
@@ -6,31 +7,206 @@ try:
 except ImportError:
     gtksourceview = None
 
+from Gitty.git.diffs import find_chunk_end, to_utf8
+
 
 class SourceView(gtk.ScrolledWindow):
-    def __init__(self):
+    # Text larger than this is added to the buffer a chunk at a time
+    # when idle, rather than all at once.
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, highlight_limit=1024 * 1024,
+                 collapse_limit=256 * 1024):
         gtk.ScrolledWindow.__init__(self)
         self.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
         self.set_shadow_type(gtk.SHADOW_IN)
 
+        # Syntax highlighting is turned off for text larger than this.
+        self.highlight_limit = highlight_limit
+
+        # Files in a diff larger than this are collapsed into a button
+        # that shows them on demand.
+        self.collapse_limit = collapse_limit
+
+        self.mimetype = None
+
+        self._text = ""
+        self._encoding = "utf-8"
+        self._pending = []
+        self._offset = 0
+        self._load_id = None
+
         if gtksourceview:
             self.buffer = gtksourceview.SourceBuffer()
             self.buffer.set_highlight(True)
-            sourceview = gtksourceview.SourceView(self.buffer)
+            self.sourceview = gtksourceview.SourceView(self.buffer)
         else:
             self.buffer = gtk.TextBuffer()
-            sourceview = gtk.TextView(self.buffer)
+            self.sourceview = gtk.TextView(self.buffer)
 
-        sourceview.show()
-        self.add(sourceview)
-        sourceview.set_editable(False)
-        sourceview.modify_font(pango.FontDescription("Monospace"))
+        self.sourceview.show()
+        self.add(self.sourceview)
+        self.sourceview.set_editable(False)
+        self.sourceview.modify_font(pango.FontDescription("Monospace"))
+
+        self.connect('destroy', lambda w: self.__stop_loading())
 
     def set_mimetype(self, mimetype):
+        self.mimetype = mimetype
+
         if gtksourceview:
             slm = gtksourceview.SourceLanguagesManager()
             gsl = slm.get_language_from_mime_type(mimetype)
             self.buffer.set_language(gsl)
 
     def set_text(self, text):
-        self.buffer.set_text(unicode(text))
+        self.__stop_loading()
+
+        if gtksourceview:
+            self.buffer.set_highlight(len(text) <= self.highlight_limit)
+
+        if len(text) <= self.CHUNK_SIZE:
+            self.buffer.set_text(to_utf8(text))
+            return
+
+        self.buffer.set_text("")
+
+        if self.mimetype == "text/x-patch":
+            sections = self.__split_diff(text)
+        else:
+            sections = [(0, len(text), False)]
+
+        self.__start_loading(text, "utf-8", sections)
+
+    def set_diff(self, diff, header=""):
+        """Shows a Diff, following a header.
+
+        The diff's bytes are only decoded as they're added to the buffer,
+        and the files that are collapsed aren't decoded until they're
+        shown.
+        """
+        self.__stop_loading()
+
+        if gtksourceview:
+            self.buffer.set_highlight(len(diff) <= self.highlight_limit)
+
+        self.buffer.set_text(to_utf8(header))
+
+        files = diff.get_files()
+        sections = []
+
+        if files:
+            if files[0][0] > 0:
+                sections.append((0, files[0][0], False))
+
+            for start, end in files:
+                sections.append((start, end,
+                                 end - start > self.collapse_limit))
+        elif len(diff):
+            sections.append((0, len(diff), False))
+
+        self.__start_loading(diff.data, diff.encoding, sections)
+
+    def __start_loading(self, text, encoding, sections):
+        self._text = text
+        self._encoding = encoding
+        self._offset = 0
+        self._pending = sections
+
+        # Anything that fits in one chunk is added right away.
+        if self.__load_next_chunk():
+            self._load_id = gobject.idle_add(self.__load_next_chunk,
+                                             priority=gobject.PRIORITY_LOW)
+
+    def __split_diff(self, text):
+        """Splits a diff up into one section per file.
+
+        Returns a list of (start, end, collapsed) tuples.
+        """
+        sections = []
+        start = 0
+
+        while start < len(text):
+            end = text.find("\ndiff ", start)
+
+            if end == -1:
+                end = len(text)
+            else:
+                end += 1
+
+            sections.append((start, end,
+                             end - start > self.collapse_limit and
+                             text.startswith("diff ", start)))
+            start = end
+
+        return sections
+
+    def __load_next_chunk(self):
+        text = self._text
+        remaining = self.CHUNK_SIZE
+
+        while self._pending and remaining > 0:
+            start, end, collapsed = self._pending[0]
+            start += self._offset
+
+            if collapsed:
+                self.__insert_collapsed(start, end)
+                self._pending.pop(0)
+                self._offset = 0
+                remaining -= self.CHUNK_SIZE / 16
+                continue
+
+            chunk_end = find_chunk_end(text, start, end, remaining)
+
+            self.buffer.insert(self.buffer.get_end_iter(),
+                               to_utf8(text[start:chunk_end], self._encoding))
+            remaining -= chunk_end - start
+
+            if chunk_end == end:
+                self._pending.pop(0)
+                self._offset = 0
+            else:
+                self._offset += chunk_end - start
+
+        if self._pending:
+            return True
+
+        self._text = ""
+        self._load_id = None
+
+        return False
+
+    def __insert_collapsed(self, start, end):
+        text = self._text
+        header_end = text.find("\n", start, end) + 1 or end
+        body = text[header_end:end]
+
+        self.buffer.insert(self.buffer.get_end_iter(),
+                           to_utf8(text[start:header_end], self._encoding))
+
+        anchor = self.buffer.create_child_anchor(self.buffer.get_end_iter())
+        self.buffer.insert(self.buffer.get_end_iter(), "\n")
+
+        button = gtk.Button("Show %d more lines (%d KB)" %
+                            (body.count("\n"), len(body) / 1024))
+        button.show()
+        self.sourceview.add_child_at_anchor(button, anchor)
+        button.connect('clicked', self.__on_expand_clicked, anchor, body,
+                       self._encoding)
+
+    def __on_expand_clicked(self, button, anchor, body, encoding):
+        # Replace the button and the line it's on with the hidden text.
+        start = self.buffer.get_iter_at_child_anchor(anchor)
+        end = start.copy()
+        end.forward_chars(2)
+        self.buffer.delete(start, end)
+        self.buffer.insert(start, to_utf8(body, encoding))
+
+    def __stop_loading(self):
+        if self._load_id is not None:
+            gobject.source_remove(self._load_id)
+            self._load_id = None
+
+        self._text = ""
+        self._pending = []
+        self._offset = 0
@@ -0,0 +1,106 @@
+import gobject
+import gtk
+
+from Gitty.tracing import tracer
+
+
+class StatsPanel(gtk.VBox):
+    """Shows the totals recorded by the tracer.
+
+    There's a row for each kind of work, such as a git command or a
+    redraw of the commit list, with how many times it was done and how
+    long it took. The totals are refreshed while the panel is shown.
+    """
+    # How often to refresh the totals, in milliseconds.
+    REFRESH_INTERVAL = 1000
+
+    # The title and format of each column. Columns without a format are
+    # shown as they are.
+    COLUMNS = (
+        ("Category", None),
+        ("Name", None),
+        ("Count", "%d"),
+        ("Total (ms)", "%.1f"),
+        ("Mean (ms)", "%.2f"),
+        ("Max (ms)", "%.1f"),
+        ("Bytes", "%d"),
+    )
+
+    def __init__(self):
+        gtk.VBox.__init__(self, False, 6)
+        self.set_border_width(6)
+        self._refresh_id = None
+
+        self.model = gtk.ListStore(str, str, int, float, float, float,
+                                   gobject.TYPE_INT64)
+
+        swin = gtk.ScrolledWindow()
+        swin.show()
+        swin.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        swin.set_shadow_type(gtk.SHADOW_IN)
+        self.pack_start(swin, True, True, 0)
+
+        tree = gtk.TreeView(self.model)
+        tree.show()
+        swin.add(tree)
+
+        for i, (title, format) in enumerate(self.COLUMNS):
+            renderer = gtk.CellRendererText()
+            column = gtk.TreeViewColumn(title, renderer)
+
+            if format:
+                renderer.set_property("xalign", 1.0)
+                column.set_cell_data_func(renderer, self.__format_cell,
+                                          (i, format))
+            else:
+                column.add_attribute(renderer, "text", i)
+
+            column.set_resizable(True)
+            column.set_sort_column_id(i)
+            tree.append_column(column)
+
+        buttonbox = gtk.HButtonBox()
+        buttonbox.show()
+        buttonbox.set_layout(gtk.BUTTONBOX_END)
+        self.pack_start(buttonbox, False, False, 0)
+
+        button = gtk.Button("_Reset")
+        button.show()
+        buttonbox.pack_start(button, False, False, 0)
+        button.connect("clicked", self.__on_reset)
+
+        self.connect("map", self.__on_map)
+        self.connect("unmap", self.__on_unmap)
+
+    def refresh(self):
+        self.model.clear()
+
+        for category, name, count, total, longest, bytes in \
+            tracer.get_stats():
+            self.model.append((category, name, count, total * 1000,
+                               total * 1000 / count, longest * 1000, bytes))
+
+        return True
+
+    def __format_cell(self, column, renderer, model, iter, data):
+        i, format = data
+        value = model.get_value(iter, i)
+
+        if value:
+            renderer.set_property("text", format % value)
+        else:
+            renderer.set_property("text", "")
+
+    def __on_map(self, widget):
+        self.refresh()
+        self._refresh_id = gobject.timeout_add(self.REFRESH_INTERVAL,
+                                               self.refresh)
+
+    def __on_unmap(self, widget):
+        if self._refresh_id is not None:
+            gobject.source_remove(self._refresh_id)
+            self._refresh_id = None
+
+    def __on_reset(self, button):
+        tracer.reset_stats()
+        self.refresh()
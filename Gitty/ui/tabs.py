@@ -1,3 +1,4 @@
+import mimetypes
 from datetime import datetime
 
 import gobject
@@ -5,14 +6,39 @@ import gtk
 
 from Gitty.git.client import Client
 from Gitty.git.commits import Commit
+from Gitty.lru import LRUCache
 from Gitty.ui.commits import CommitsTree, ReferencesTree
+from Gitty.ui.loader import DetailsLoader
 from Gitty.ui.sourceview import SourceView
 
 
 class ProjectTab(gtk.VBox):
-    def __init__(self, path):
+    # The maximum size of the commit details to keep cached, in bytes.
+    DETAILS_CACHE_SIZE = 32 * 1024 * 1024
+
+    # The number of commits on each side of the selection to prefetch.
+    PREFETCH_DISTANCE = 2
+
+    # How long to wait for more typing before searching, in milliseconds.
+    SEARCH_DELAY = 150
+
+    def __init__(self, path, pool=None):
         gtk.VBox.__init__(self, False, 0)
-        self.client = Client(path)
+        self.path = path
+        self.client = Client(path, pool)
+
+        # Each entry is the formatted header, the Diff and the list of
+        # changed files. The files are counted roughly by their path
+        # length.
+        self.details_cache = LRUCache(self.DETAILS_CACHE_SIZE,
+            lambda entry: len(entry[0]) + len(entry[1]) +
+                          sum([len(f[0]) + 100 for f in entry[2]]))
+        self.details_loader = DetailsLoader(self.__load_commit_details,
+                                            self.on_details_loaded)
+        self.versions_loader = DetailsLoader(self.__load_file_versions,
+                                             self.on_file_versions_loaded)
+        self.changed_files = []
+        self._search_id = None
 
         self.set_border_width(6)
 
@@ -28,6 +54,8 @@ class ProjectTab(gtk.VBox):
         widget.show()
         paned.pack2(widget, False)
 
+        self.connect('destroy', self.on_destroy)
+
     def __build_top_pane(self):
         def on_references_toggled(toggle):
             if toggle.get_active():
@@ -37,9 +65,13 @@ class ProjectTab(gtk.VBox):
 
         vbox = gtk.VBox(False, 6)
 
+        hbox = gtk.HBox(False, 6)
+        hbox.show()
+        vbox.pack_start(hbox, False, False, 0)
+
         buttonbox = gtk.HButtonBox()
         buttonbox.show()
-        vbox.pack_start(buttonbox, False, False, 0)
+        hbox.pack_start(buttonbox, False, False, 0)
         buttonbox.set_layout(gtk.BUTTONBOX_START)
 
         refs_button = gtk.ToggleButton("References")
@@ -48,6 +80,48 @@ class ProjectTab(gtk.VBox):
         refs_button.set_active(True)
         refs_button.connect('toggled', on_references_toggled)
 
+        self.refresh_button = gtk.Button(stock=gtk.STOCK_REFRESH)
+        self.refresh_button.show()
+        buttonbox.pack_start(self.refresh_button, False, False, 0)
+        self.refresh_button.connect('clicked', self.on_refresh_clicked)
+
+        button = gtk.Button(stock=gtk.STOCK_GO_DOWN)
+        button.show()
+        hbox.pack_end(button, False, False, 0)
+        button.connect('clicked',
+                       lambda w: self.__find(self.commits_tree.find_next))
+
+        button = gtk.Button(stock=gtk.STOCK_GO_UP)
+        button.show()
+        hbox.pack_end(button, False, False, 0)
+        button.connect('clicked',
+                       lambda w: self.__find(self.commits_tree.find_previous))
+
+        self.search_entry = gtk.Entry()
+        self.search_entry.show()
+        hbox.pack_end(self.search_entry, False, False, 0)
+        self.search_entry.connect('changed', self.on_search_changed)
+        self.search_entry.connect('activate',
+                                  lambda w: self.__find(
+                                      self.commits_tree.find_next))
+
+        self.search_label = gtk.Label()
+        self.search_label.show()
+        hbox.pack_end(self.search_label, False, False, 0)
+
+        self.load_box = gtk.HBox(False, 6)
+        vbox.pack_start(self.load_box, False, False, 0)
+
+        self.load_progress = gtk.ProgressBar()
+        self.load_progress.show()
+        self.load_box.pack_start(self.load_progress, True, True, 0)
+
+        stop_button = gtk.Button(stock=gtk.STOCK_STOP)
+        stop_button.show()
+        self.load_box.pack_start(stop_button, False, False, 0)
+        stop_button.connect('clicked',
+                            lambda w: self.commits_tree.cancel_load())
+
         paned = gtk.HPaned()
         paned.show()
         vbox.pack_start(paned, True, True, 0)
@@ -73,14 +147,19 @@ class ProjectTab(gtk.VBox):
         swin.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_ALWAYS)
         swin.set_shadow_type(gtk.SHADOW_IN)
 
-        self.commits_tree = CommitsTree()
+        self.commits_tree = CommitsTree(path, self.client.pool)
         self.commits_tree.show()
         swin.add(self.commits_tree)
 
         self.commits_tree.connect('commit_changed', self.on_commit_changed)
         self.commits_tree.connect('references_changed',
                                   lambda w, refs: self.refs_tree.load(refs))
+        self.commits_tree.connect('load_progress', self.on_load_progress)
+        self.commits_tree.connect('load_finished', self.on_load_finished)
 
+        self.load_progress.set_text("Loading history...")
+        self.load_box.show()
+        self.refresh_button.set_sensitive(False)
         self.commits_tree.update_commits()
 
         return vbox
@@ -103,6 +182,16 @@ class ProjectTab(gtk.VBox):
         self.sha1_label.set_max_width_chars(40)
         self.sha1_label.set_selectable(True)
 
+        self.file_combo = gtk.combo_box_new_text()
+        self.file_combo.show()
+        hbox.pack_end(self.file_combo, False, False, 0)
+        self.file_combo.connect('changed', self.on_file_changed)
+
+        label = gtk.Label("<b>File:</b>")
+        label.show()
+        hbox.pack_end(label, False, False, 0)
+        label.set_use_markup(True)
+
         paned = gtk.HPaned()
         paned.show()
         vbox.pack_start(paned, True, True, 0)
@@ -128,31 +217,217 @@ class ProjectTab(gtk.VBox):
 
         return vbox
 
+    def on_destroy(self, widget):
+        if self._search_id is not None:
+            gobject.source_remove(self._search_id)
+            self._search_id = None
+
+        self.details_loader.shutdown()
+        self.versions_loader.shutdown()
+        self.client.close()
+
     def on_commit_changed(self, widget, commit):
         self.sha1_label.set_text(commit.commit_sha1)
-        self.diff_viewer.set_text(self.get_commit_contents(commit))
 
-        self.old_version_view.set_text(self.get_commit_contents(commit))
-        self.new_version_view.set_text(self.get_commit_contents(commit))
+        entry = self.details_cache.get(commit.sha1)
+
+        if entry is None:
+            # Load it in the background. Anything still loading for the
+            # previous selection is dropped.
+            self.__set_commit_contents("", None, [])
+            self.details_loader.load(commit)
+        else:
+            self.details_loader.cancel()
+            self.__set_commit_contents(*entry)
+
+        self.__queue_prefetch(commit)
+
+    def on_details_loaded(self, commit, result):
+        header, diff, files = result
+        contents = self.__format_commit_contents(commit, header)
+        self.details_cache.set(commit.sha1, (contents, diff, files))
+
+        if commit is self.commits_tree.selected_commit:
+            self.__set_commit_contents(contents, diff, files)
+
+    def on_file_changed(self, combo):
+        i = combo.get_active()
+
+        if 0 <= i < len(self.changed_files):
+            self.versions_loader.load((self.commits_tree.selected_commit,
+                                       self.changed_files[i]))
+        else:
+            self.versions_loader.cancel()
+            self.old_version_view.set_text("")
+            self.new_version_view.set_text("")
+
+    def on_file_versions_loaded(self, request, blobs):
+        commit, changed_file = request
+        i = self.file_combo.get_active()
+
+        if (commit is not self.commits_tree.selected_commit or
+            not 0 <= i < len(self.changed_files) or
+            self.changed_files[i] is not changed_file):
+            return
+
+        path = changed_file[0]
+        old_blob, new_blob = blobs
+        self.__show_blob(self.old_version_view, path, old_blob)
+        self.__show_blob(self.new_version_view, path, new_blob)
+
+    def on_search_changed(self, entry):
+        # The search waits until typing stops for a moment, rather than
+        # running for every key.
+        if self._search_id is not None:
+            gobject.source_remove(self._search_id)
+
+        self._search_id = gobject.timeout_add(self.SEARCH_DELAY,
+                                              self.__run_search)
+
+    def on_refresh_clicked(self, widget):
+        self.load_progress.set_text("Refreshing history...")
+        self.load_box.show()
+        self.refresh_button.set_sensitive(False)
+        self.commits_tree.refresh_commits()
+
+    def on_load_progress(self, widget, count):
+        self.load_progress.set_text("Loaded %d commits" % count)
+        self.load_progress.pulse()
+
+    def on_load_finished(self, widget, cancelled):
+        # The details list each commit's children, which may have changed.
+        self.details_cache.clear()
+        self.load_box.hide()
+        self.refresh_button.set_sensitive(True)
 
     def on_references_clicked(self, widget):
         pass
 
 
-    def get_commit_contents(self, commit):
-        diff = self.client.diff_tree(commit.commit_sha1, commit.parent_sha1[0])
-
+    def __run_search(self):
+        self._search_id = None
+        text = self.search_entry.get_text()
+        count, complete = self.commits_tree.search(text)
+
+        if not text.strip():
+            self.search_label.set_text("")
+        elif not complete:
+            self.search_label.set_text("%d+ matches" % count)
+        elif count == 1:
+            self.search_label.set_text("1 match")
+        else:
+            self.search_label.set_text("%d matches" % count)
+
+        return False
+
+    def __find(self, find_func):
+        if self._search_id is None:
+            find_func()
+        else:
+            # The search hasn't run yet. Running it selects the first
+            # match.
+            gobject.source_remove(self._search_id)
+            self.__run_search()
+
+
+        if diff is None:
+            self.diff_viewer.set_text(contents)
+        else:
+            self.diff_viewer.set_diff(diff, contents)
+
+        self.changed_files = files
+        model = self.file_combo.get_model()
+        model.clear()
+
+        for changed_file in files:
+            self.file_combo.append_text(changed_file[0])
+
+        if files:
+            self.file_combo.set_active(0)
+        else:
+            self.on_file_changed(self.file_combo)
+
+    def __show_blob(self, view, path, blob):
+        if blob is None:
+            view.set_text("")
+        elif blob.is_binary():
+            view.set_text("Binary file (%d bytes)" % blob.size)
+        else:
+            view.set_mimetype(mimetypes.guess_type(path)[0] or "text/plain")
+            view.set_text(blob.data)
+
+    def __queue_prefetch(self, commit):
+        """Queues up the commits around a commit to be loaded when idle.
+
+        This way, moving the selection up or down finds the details
+        already loaded.
+        """
+        graph = self.commits_tree.graph
+        ordinal = graph.get_ordinal(commit.sha1)
+
+        if ordinal is None:
+            return
+
+        commits = []
+
+        for distance in xrange(1, self.PREFETCH_DISTANCE + 1):
+            for i in (ordinal + distance, ordinal - distance):
+                if (0 <= i < len(graph.commits) and
+                    graph.commits[i].sha1 not in self.details_cache):
+                    commits.append(graph.commits[i])
+
+        self.details_loader.prefetch(commits)
+
+    def __load_commit_details(self, commit, job):
+        """Loads the header, diff and changed files of a commit.
+
+        This is called in the details loader's thread.
+        """
+        diff = self.client.diff_tree(commit.parent_sha1[0],
+                                     commit.commit_sha1, job)
+        job.check_cancelled()
         header = self.client.get_commit_header(commit.commit_sha1)
+        files = self.client.get_changed_files(commit.parent_sha1[0],
+                                              commit.commit_sha1, job)
+
+        return (header, diff, files)
+
+    def __load_file_versions(self, request, job):
+        """Loads the old and new blobs of a changed file.
+
+        This is called in the versions loader's thread. Either blob is
+        None if the file didn't exist on that side.
+        """
+        path, old_sha1, new_sha1, status = request[1]
+        blobs = []
 
+        for sha1 in (old_sha1, new_sha1):
+            job.check_cancelled()
+
+            if sha1 == Client.NULL_SHA1:
+                blobs.append(None)
+            else:
+                blobs.append(self.client.get_blob(sha1))
+
+        return tuple(blobs)
+
+    def __format_commit_contents(self, commit, header):
         contents  = "Author:    %s  %s\n" % (header["author"]["name"],
                                              header["author"]["time"])
         contents += "Committer: %s  %s\n" % (header["committer"]["name"],
                                              header["committer"]["time"])
-        contents += "Parent:    %s (%s)\n" % (header["parent"], "")
-        contents += "Child:     %s (%s)\n" % ("", "")
+        contents += "Parent:    %s (%s)\n" % (header.get("parent", ""), "")
+        children = self.commits_tree.graph.get_children(commit)
+
+        if children:
+            for child in children:
+                contents += "Child:     %s (%s)\n" % (child.commit_sha1,
+                                                      child.message)
+        else:
+            contents += "Child:     %s (%s)\n" % ("", "")
+
         contents += "Branch:    %s\n" % ("")
 
         contents += "\n%s\n\n" % header["message"]
-        contents += diff
 
         return contents
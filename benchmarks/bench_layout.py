@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""Benchmarks the graph layout against the original implementation.
+
+This lays out a synthetic history with both LaneLayout and the layout
+code CommitGraph used before it, and reports the time taken and the
+width of the resulting graph.
+
+Usage: bench_layout.py [count] [seed]
+"""
+
+import os
+import random
+import sys
+import time
+from binascii import hexlify
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from Gitty.git.layout import LaneLayout
+
+
+class FakeCommit(object):
+    def __init__(self, sha1, parents):
+        self.sha1 = sha1
+        self.parents = parents
+        self.commit_sha1 = hexlify(sha1)
+        self.parent_sha1 = [hexlify(parent) for parent in parents] or [0]
+
+
+def make_history(count, seed):
+    """Builds a history of topic branches being forked and merged.
+
+    Returns the commits in topological order, newest first.
+    """
+    rand = random.Random(seed)
+    heads = []
+    commits = []
+
+    for i in xrange(count):
+        sha1 = "%020d" % i
+
+        if not heads:
+            parents = ()
+            heads.append(sha1)
+        elif len(heads) > 1 and rand.random() < 0.15:
+            # Merge a topic branch into the main line.
+            topic = rand.randrange(1, len(heads))
+            parents = (heads[0], heads.pop(topic))
+            heads[0] = sha1
+        elif rand.random() < 0.1:
+            # Fork a new topic branch.
+            parents = (rand.choice(heads),)
+            heads.append(sha1)
+        else:
+            head = rand.randrange(len(heads))
+            parents = (heads[head],)
+            heads[head] = sha1
+
+        commits.append(FakeCommit(sha1, parents))
+
+    commits.reverse()
+
+    return commits
+
+
+class LegacyLayout(object):
+    """The layout code CommitGraph.make_graph used originally."""
+    def __init__(self):
+        self.colors = {}
+        self.node_pos = {}
+        self.incomplete_line = {}
+
+    def run(self, commits):
+        index = 0
+        last_color = 0
+        last_node_pos = -1
+        out_lines = []
+
+        for commit in commits:
+            out_lines, last_color, last_node_pos = \
+                self.make_graph(commit, index, out_lines, last_color,
+                                last_node_pos)
+            index += 1
+
+    def make_graph(self, commit, index, out_lines, last_color, last_node_pos):
+        in_lines = []
+
+        if commit.commit_sha1 not in self.colors:
+            last_color = self.colors[commit.commit_sha1] = last_color + 1
+
+        color = self.colors[commit.commit_sha1]
+
+        if commit.commit_sha1 not in self.node_pos:
+            last_node_pos = self.node_pos[commit.commit_sha1] = \
+                last_node_pos + 1
+
+        node_pos = self.node_pos[commit.commit_sha1]
+
+        key = commit.parent_sha1[0]
+
+        if key not in self.node_pos:
+            self.colors[key] = color
+            self.node_pos[key] = node_pos
+
+        for sha1 in self.incomplete_line.keys():
+            if sha1 != commit.commit_sha1:
+                self.make_incomplete_line(sha1, node_pos, out_lines,
+                                          in_lines, index)
+            else:
+                del self.incomplete_line[sha1]
+
+        for parent_id in commit.parent_sha1:
+            if parent_id not in self.node_pos:
+                last_color = self.colors[parent_id] = last_color + 1
+                last_node_pos = self.node_pos[parent_id] = \
+                    last_node_pos + 1
+            else:
+                last_node_pos = self.node_pos[parent_id]
+
+            in_lines.append((node_pos, self.node_pos[parent_id],
+                             self.colors[parent_id]))
+            self.add_incomplete_line(parent_id)
+
+        commit.node = (node_pos, color)
+        commit.out_lines = in_lines
+        commit.in_lines = out_lines
+
+        return (in_lines, last_color, last_node_pos)
+
+    def add_incomplete_line(self, sha1):
+        if sha1 not in self.incomplete_line:
+            self.incomplete_line[sha1] = []
+
+        self.incomplete_line[sha1].append(self.node_pos[sha1])
+
+    def make_incomplete_line(self, sha1, node_pos, out_lines, in_lines,
+                             index):
+        for idx, pos in enumerate(self.incomplete_line[sha1]):
+            if pos == node_pos:
+                line = (pos, pos, self.colors[sha1])
+
+                if line in out_lines:
+                    out_lines.remove(line)
+
+                out_lines.append((pos, pos + 0.5, self.colors[sha1]))
+                self.incomplete_line[sha1][idx] = pos = pos + 0.5
+
+            in_lines.append((pos, pos, self.colors[sha1]))
+
+
+def run_lane_layout(commits):
+    layout = LaneLayout()
+
+    for i, commit in enumerate(commits):
+        if i + 1 < len(commits):
+            next_sha1 = commits[i + 1].sha1
+        else:
+            next_sha1 = None
+
+        layout.add(commit, next_sha1)
+
+
+def measure(name, func, commits):
+    start = time.time()
+    func(commits)
+    elapsed = time.time() - start
+
+    width = 0
+
+    for commit in commits:
+        width = max(width, commit.node[0] + 1,
+                    *[max(start, end) + 1
+                      for start, end, color in commit.out_lines] or [0])
+
+    print "%-8s %8d commits  %8.3fs  %8.1f us/commit  max width %d" % \
+        (name, len(commits), elapsed, elapsed * 1000000 / len(commits),
+         width)
+
+
+def main():
+    count = 5000
+    seed = 0
+
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    if len(sys.argv) > 2:
+        seed = int(sys.argv[2])
+
+    measure("legacy", LegacyLayout().run, make_history(count, seed))
+    measure("lanes", run_lane_layout, make_history(count, seed))
+
+
+if __name__ == "__main__":
+    main()
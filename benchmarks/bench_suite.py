@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+"""Benchmarks gitty against synthetic repositories.
+
+For each repository shape (see synthetic.py), this times:
+
+    parse_commits        parsing rev-list output into Commit objects
+    load_revlist         a full history load through git rev-list
+    load_commit_graph    a full history load from the commit-graph file
+    load_cached          a history load from gitty's graph cache
+    layout               laying out the loaded history with make_graph
+    refs_cold            reading the refs with a new RefReader
+    refs_warm            reading the refs again, when nothing changed
+    details              loading the header, diff and changed files of
+                         the first commits
+    render               rendering rows with CommitCellRenderer, when
+                         gtk and a display are available
+
+Results are written as JSON. Each one has the shape, the benchmark name,
+the number of items it covered and the best and median times of the
+runs, in seconds. For history loads, the time to the first commit is
+also reported.
+
+If a thresholds file is given, any result whose best time is over its
+threshold is listed under "failures", and the exit status is 1. Times
+grow with the size of the repositories, so thresholds are keyed by the
+scale they're for, formatted with %g, and then by "shape/benchmark".
+thresholds.json has thresholds for the default scale, with room for
+slower machines. Benchmarks that take well under 50ms are left out, as
+their times are mostly noise.
+
+The repositories are built once and kept in the work directory.
+
+Usage: bench_suite.py [options]
+"""
+
+import json
+import optparse
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from Gitty.git.client import Client
+from Gitty.git.commits import Commit, CommitGraph
+from Gitty.git.refs import RefReader
+
+import synthetic
+
+
+# The size of each shape at a scale of 1. For giant_diff, it's the number
+# of files changed at once.
+SIZES = {
+    "linear": 20000,
+    "octopus": 10000,
+    "crisscross": 10000,
+    "refs": 8000,
+    "giant_diff": 3000,
+}
+
+# Bump this when the generator changes, so old repositories are rebuilt.
+REPO_VERSION = 1
+
+# The number of commits to load details for.
+DETAILS_COUNT = 20
+
+# The number of rows to render.
+RENDER_ROWS = 2000
+
+# Root commits are diffed against the empty tree.
+EMPTY_TREE_SHA1 = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+
+
+def get_repo(work_dir, shape, scale):
+    """Returns the path of a synthetic repository, building it if needed."""
+    size = max(int(SIZES[shape] * scale), 1)
+    path = os.path.join(work_dir, "%s-%d-v%d" % (shape, size, REPO_VERSION))
+
+    if not os.path.exists(os.path.join(path, ".git", "gitty-bench-ready")):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+        synthetic.make_repo(shape, path, size)
+        open(os.path.join(path, ".git", "gitty-bench-ready"), "w").close()
+
+    return path
+
+
+def measure(func, repeat):
+    """Runs func repeat times, returning the times and its last result."""
+    times = []
+    result = None
+
+    for i in xrange(repeat):
+        start = time.time()
+        result = func()
+        times.append(time.time() - start)
+
+    return times, result
+
+
+def make_result(shape, name, times, count, **extra):
+    times = sorted(times)
+    result = {
+        "shape": shape,
+        "name": name,
+        "count": count,
+        "best": times[0],
+        "median": times[len(times) // 2],
+        "runs": len(times),
+    }
+    result.update(extra)
+
+    return result
+
+
+def load_history(path):
+    """Loads the history, returning the commits and the time to the first."""
+    graph = CommitGraph(path)
+    start = time.time()
+    first_time = None
+    commits = []
+
+    try:
+        for commit in graph.get_commits():
+            if first_time is None:
+                first_time = time.time() - start
+
+            commits.append(commit)
+    finally:
+        graph.close()
+
+    return commits, first_time
+
+
+def bench_history(shape, path, repeat):
+    results = []
+    git_dir = os.path.join(path, ".git")
+    cache_dir = os.path.join(git_dir, "gitty")
+    commit_graph = os.path.join(git_dir, "objects", "info", "commit-graph")
+
+    def load_uncached():
+        shutil.rmtree(cache_dir, True)
+
+        return load_history(path)
+
+    # rev-list --header output, for parsing on its own.
+    p = subprocess.Popen(["git", "rev-list", "--parents", "--header",
+                          "--topo-order", "--all"],
+                         cwd=path, stdout=subprocess.PIPE)
+    records = p.communicate()[0].split("\0")[:-1]
+    times, commits = measure(lambda: [Commit(record.split("\n"))
+                                      for record in records], repeat)
+    results.append(make_result(shape, "parse_commits", times, len(records)))
+
+    if os.path.exists(commit_graph):
+        os.remove(commit_graph)
+
+    times, (commits, first_time) = measure(load_uncached, repeat)
+    results.append(make_result(shape, "load_revlist", times, len(commits),
+                               first_commit=first_time))
+
+    subprocess.check_call(["git", "commit-graph", "write", "--reachable"],
+                          cwd=path)
+    times, (commits, first_time) = measure(load_uncached, repeat)
+    results.append(make_result(shape, "load_commit_graph", times,
+                               len(commits), first_commit=first_time))
+
+    # The last load left a cache behind.
+    times, (commits, first_time) = measure(lambda: load_history(path),
+                                           repeat)
+    results.append(make_result(shape, "load_cached", times, len(commits),
+                               first_commit=first_time))
+
+    def layout():
+        graph = CommitGraph(path)
+
+        for i, commit in enumerate(commits):
+            if i + 1 < len(commits):
+                graph.make_graph(commit, commits[i + 1].sha1)
+            else:
+                graph.make_graph(commit, None)
+
+    times, result = measure(layout, repeat)
+    results.append(make_result(shape, "layout", times, len(commits)))
+
+    return results, commits
+
+
+def bench_refs(shape, path, repeat):
+    git_dir = os.path.join(path, ".git")
+    results = []
+
+    def read_cold():
+        reader = RefReader(git_dir, path)
+
+        try:
+            return reader.read()
+        finally:
+            reader.close()
+
+    times, refs = measure(read_cold, repeat)
+    count = sum([len(names) for names in refs.itervalues()])
+    results.append(make_result(shape, "refs_cold", times, count))
+
+    reader = RefReader(git_dir, path)
+    reader.read()
+    times, refs = measure(reader.read, repeat)
+    reader.close()
+    results.append(make_result(shape, "refs_warm", times, count))
+
+    return results
+
+
+def bench_details(shape, path, commits, repeat):
+    commits = commits[:DETAILS_COUNT]
+
+    def load_details():
+        # A new client each time, so nothing is cached between runs.
+        client = Client(path)
+
+        try:
+            for commit in commits:
+                parent = commit.parent_sha1[0] or EMPTY_TREE_SHA1
+                client.get_commit_header(commit.commit_sha1)
+                diff = client.diff_tree(parent, commit.commit_sha1)
+                diff.get_files()
+                client.get_changed_files(commit.parent_sha1[0] or None,
+                                         commit.commit_sha1)
+        finally:
+            client.close()
+
+    times, result = measure(load_details, repeat)
+
+    return [make_result(shape, "details", times, len(commits))]
+
+
+def bench_render(shape, commits, repeat):
+    """Renders rows offscreen, or returns nothing if gtk can't be used."""
+    try:
+        import gtk
+        import gtk.gdk
+    except (ImportError, RuntimeError):
+        return []
+
+    if gtk.gdk.display_get_default() is None:
+        return []
+
+    from Gitty.ui.commits import CommitCellRenderer
+
+    commits = commits[:RENDER_ROWS]
+    window = gtk.OffscreenWindow()
+    widget = gtk.TreeView()
+    window.add(widget)
+    window.show_all()
+
+    row_height = 22
+    width = 600
+    pixmap = gtk.gdk.Pixmap(widget.window, width, row_height)
+
+    def render():
+        # A new renderer each time, so the caches start out empty.
+        renderer = CommitCellRenderer()
+        area = gtk.gdk.Rectangle(0, 0, width, row_height)
+
+        for commit in commits:
+            renderer.set_property("commit", commit)
+            renderer.on_render(pixmap, widget, area, area, area, 0)
+
+    times, result = measure(render, repeat)
+    window.destroy()
+
+    return [make_result(shape, "render", times, len(commits))]
+
+
+def get_git_version():
+    p = subprocess.Popen(["git", "--version"], stdout=subprocess.PIPE)
+
+    return p.communicate()[0].strip()
+
+
+def check_thresholds(results, thresholds):
+    failures = []
+
+    for result in results:
+        key = "%s/%s" % (result["shape"], result["name"])
+        threshold = thresholds.get(key)
+
+        if threshold is not None and result["best"] > threshold:
+            failures.append({
+                "benchmark": key,
+                "best": result["best"],
+                "threshold": threshold,
+            })
+
+    return failures
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--shapes", default=",".join(synthetic.SHAPES),
+                      help="comma-separated repository shapes to run")
+    parser.add_option("--scale", type="float", default=1.0,
+                      help="multiplies the size of every repository")
+    parser.add_option("--repeat", type="int", default=3,
+                      help="the number of times to run each benchmark")
+    parser.add_option("--work-dir",
+                      default=os.path.join(tempfile.gettempdir(),
+                                           "gitty-bench"),
+                      help="where to keep the synthetic repositories")
+    parser.add_option("--output", help="write the results to this file")
+    parser.add_option("--thresholds",
+                      help="a JSON file of maximum times, in seconds")
+    options, args = parser.parse_args()
+
+    thresholds = None
+
+    if options.thresholds:
+        fp = open(options.thresholds, "r")
+
+        try:
+            thresholds = json.load(fp).get("%g" % options.scale)
+        finally:
+            fp.close()
+
+        if thresholds is None:
+            parser.error("%s has no thresholds for a scale of %g" %
+                         (options.thresholds, options.scale))
+
+    if not os.path.exists(options.work_dir):
+        os.makedirs(options.work_dir)
+
+    results = []
+
+    for shape in options.shapes.split(","):
+        path = get_repo(options.work_dir, shape, options.scale)
+        shape_results, commits = bench_history(shape, path, options.repeat)
+        results += shape_results
+        results += bench_refs(shape, path, options.repeat)
+        results += bench_details(shape, path, commits, options.repeat)
+        results += bench_render(shape, commits, options.repeat)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "git": get_git_version(),
+        "scale": options.scale,
+        "results": results,
+        "failures": [],
+    }
+
+    if thresholds is not None:
+        report["failures"] = check_thresholds(results, thresholds)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+
+    if options.output:
+        fp = open(options.output, "w")
+
+        try:
+            fp.write(output + "\n")
+        finally:
+            fp.close()
+    else:
+        print output
+
+    if report["failures"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
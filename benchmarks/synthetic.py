@@ -0,0 +1,232 @@
+"""Builds synthetic git repositories for benchmarking.
+
+Each shape stresses a different part of gitty:
+
+    linear       a long history on a single branch
+    octopus      frequent merges of many branches at once
+    crisscross   two branches repeatedly merging into each other
+    refs         thousands of branches and tags, loose and packed
+    giant_diff   a few commits with very large diffs
+
+Repositories are written with git fast-import, so even large ones only
+take a few seconds to build.
+
+Usage: synthetic.py shape path [size]
+"""
+
+import random
+import subprocess
+import sys
+
+
+SHAPES = ("linear", "octopus", "crisscross", "refs", "giant_diff")
+
+WORDS = ("fix", "add", "remove", "update", "refactor", "cache", "layout",
+         "graph", "commit", "branch", "merge", "render", "diff", "history",
+         "search", "tree", "model", "loader", "index", "reference")
+
+
+class HistoryWriter(object):
+    """Writes commits to a git fast-import stream."""
+    def __init__(self, fp, seed):
+        self.fp = fp
+        self.rand = random.Random(seed)
+        self.mark = 0
+        self.time = 1200000000
+
+    def commit(self, ref, parents=(), files=None, message=None):
+        """Writes a commit and returns its mark.
+
+        files maps paths to their new contents. By default, one file
+        out of a couple hundred is changed.
+        """
+        rand = self.rand
+        self.mark += 1
+        self.time += rand.randint(60, 7200)
+
+        if message is None:
+            message = " ".join([rand.choice(WORDS) for i in xrange(6)])
+
+        if files is None:
+            files = {
+                "src/file%03d.c" % rand.randrange(200):
+                    "%d %s\n" % (self.mark, message) * rand.randint(1, 20),
+            }
+
+        author = "Developer %d <dev%d@example.com>" % (rand.randrange(40),
+                                                        rand.randrange(40))
+        write = self.fp.write
+        write("commit %s\n" % ref)
+        write("mark :%d\n" % self.mark)
+        write("author %s %d +0000\n" % (author, self.time))
+        write("committer %s %d +0000\n" % (author, self.time))
+        write("data %d\n%s\n" % (len(message), message))
+
+        if parents:
+            write("from :%d\n" % parents[0])
+
+            for parent in parents[1:]:
+                write("merge :%d\n" % parent)
+
+        for path, contents in sorted(files.iteritems()):
+            write("M 644 inline %s\ndata %d\n%s\n" % (path, len(contents),
+                                                      contents))
+
+        write("\n")
+
+        return self.mark
+
+    def reset(self, ref, mark):
+        self.fp.write("reset %s\nfrom :%d\n\n" % (ref, mark))
+
+    def tag(self, name, mark):
+        self.time += 1
+        message = "Release %s" % name
+        write = self.fp.write
+        write("tag %s\nfrom :%d\n" % (name, mark))
+        write("tagger Releaser <release@example.com> %d +0000\n" % self.time)
+        write("data %d\n%s\n" % (len(message), message))
+
+
+def write_linear(writer, size):
+    mark = None
+
+    for i in xrange(size):
+        mark = writer.commit("refs/heads/master", mark and (mark,))
+
+
+def write_octopus(writer, size):
+    main = writer.commit("refs/heads/master")
+    count = 1
+
+    while count < size:
+        # Fork a bundle of topic branches, then merge them all at once.
+        tips = []
+
+        for branch in xrange(7):
+            tip = main
+
+            for i in xrange(3):
+                tip = writer.commit("refs/heads/topic%d" % branch, (tip,))
+                count += 1
+
+            tips.append(tip)
+
+        main = writer.commit("refs/heads/master", [main] + tips,
+                             message="Merge %d topics" % len(tips))
+        count += 1
+
+        for i in xrange(10):
+            main = writer.commit("refs/heads/master", (main,))
+            count += 1
+
+
+def write_crisscross(writer, size):
+    a = writer.commit("refs/heads/master")
+    b = writer.commit("refs/heads/other", (a,))
+    count = 2
+
+    while count < size:
+        a = writer.commit("refs/heads/master", (a,))
+        b = writer.commit("refs/heads/other", (b,))
+
+        # Each side merges the other, so every merge has two merge bases.
+        a, b = (writer.commit("refs/heads/master", (a, b),
+                              message="Merge other"),
+                writer.commit("refs/heads/other", (b, a),
+                              message="Merge master"))
+        count += 4
+
+
+def write_refs(writer, size):
+    rand = writer.rand
+    marks = []
+    mark = None
+
+    for i in xrange(size):
+        mark = writer.commit("refs/heads/master", mark and (mark,))
+        marks.append(mark)
+
+    # Branches and tags all over the history. Every other tag is
+    # annotated.
+    for i in xrange(max(size // 4, 1)):
+        writer.reset("refs/heads/feature/branch%05d" % i, rand.choice(marks))
+
+    for i in xrange(max(size // 8, 1)):
+        if i % 2:
+            writer.tag("v%d.%d" % (i // 100, i % 100), rand.choice(marks))
+        else:
+            writer.reset("refs/tags/build-%05d" % i, rand.choice(marks))
+
+
+def write_giant_diff(writer, size):
+    # size is the number of files changed at once.
+    files = dict([("data/file%05d.txt" % i, "line %d\n" % i * 50)
+                  for i in xrange(size)])
+    mark = writer.commit("refs/heads/master", files=files,
+                         message="Add data files")
+
+    files = dict([(path, contents.replace("line", "changed line"))
+                  for path, contents in files.iteritems()])
+    mark = writer.commit("refs/heads/master", (mark,), files=files,
+                         message="Change every data file")
+
+    big = "".join(["row %08d of a very large file\n" % i
+                   for i in xrange(size * 40)])
+    mark = writer.commit("refs/heads/master", (mark,),
+                         files={"big.txt": big},
+                         message="Add a large file")
+    writer.commit("refs/heads/master", (mark,),
+                  files={"big.txt": big.replace("row", "ROW")},
+                  message="Rewrite the large file")
+
+
+WRITERS = {
+    "linear": write_linear,
+    "octopus": write_octopus,
+    "crisscross": write_crisscross,
+    "refs": write_refs,
+    "giant_diff": write_giant_diff,
+}
+
+
+def make_repo(shape, path, size, seed=0):
+    """Creates a repository of the given shape at path."""
+    subprocess.check_call(["git", "init", "-q", path])
+
+    p = subprocess.Popen(["git", "fast-import", "--quiet"], cwd=path,
+                         stdin=subprocess.PIPE)
+    WRITERS[shape](HistoryWriter(p.stdin, seed), size)
+    p.stdin.close()
+
+    if p.wait() != 0:
+        raise RuntimeError("git fast-import failed for %s" % shape)
+
+    if shape == "refs":
+        # Pack most of the refs, and leave the rest loose.
+        subprocess.check_call(["git", "pack-refs", "--all"], cwd=path)
+        p = subprocess.Popen(["git", "update-ref", "--stdin"], cwd=path,
+                             stdin=subprocess.PIPE)
+        p.communicate("".join(["create refs/heads/loose/branch%05d "
+                               "refs/heads/master~%d\n" % (i, i % size)
+                               for i in xrange(max(size // 16, 1))]))
+
+    subprocess.check_call(["git", "checkout", "-q", "-f", "master"],
+                          cwd=path)
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] not in SHAPES:
+        sys.stderr.write(__doc__)
+        sys.exit(1)
+
+    if len(sys.argv) > 3:
+        size = int(sys.argv[3])
+    else:
+        size = 1000
+
+    make_repo(sys.argv[1], sys.argv[2], size)
+
+
+if __name__ == "__main__":
+    main()
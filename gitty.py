@@ -7,6 +7,9 @@ from Gitty.ui.app import GittyWindow
 
 
 if __name__ == "__main__":
+    # Commit details are loaded in worker threads.
+    gobject.threads_init()
+
     mainwin = GittyWindow()
     mainwin.show()
     mainwin.connect("destroy", lambda *w: gtk.main_quit())
@@ -0,0 +1,157 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from hashlib import sha1
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from Gitty.git.cache import GraphCache
+from Gitty.git.commits import Commit
+from Gitty.git.layout import LaneLayout
+
+
+# How often the layout state is recorded.
+CHECKPOINT_INTERVAL = 3
+
+
+def make_commit(name, parents):
+    return Commit.from_fields((sha1(name).digest(),
+                               tuple([sha1(parent).digest()
+                                      for parent in parents]),
+                               name, "A U Thor <author@example.com>",
+                               1000, "+0000",
+                               "C O Mitter <committer@example.com>",
+                               2000, "-0130"))
+
+
+def make_branch(name, parent, color):
+    """Returns a commit on parent whose lane has the given color."""
+    i = 0
+
+    while ord(sha1("%s%d" % (name, i)).digest()[0]) != color:
+        i += 1
+
+    return make_commit("%s%d" % (name, i), [parent])
+
+
+def lay_out(commits):
+    """Lays out commits, returning the layout state after each one."""
+    layout = LaneLayout()
+    states = []
+
+    for i, commit in enumerate(commits):
+        if i + 1 < len(commits):
+            layout.add(commit, commits[i + 1].sha1)
+        else:
+            layout.add(commit, None)
+
+        states.append(layout.get_state())
+
+    return states
+
+
+def get_checkpoints(states, count):
+    return dict([(i, states[i])
+                 for i in xrange(0, count, CHECKPOINT_INTERVAL)])
+
+
+def get_rows(commits):
+    return [(commit.get_fields(), commit.node, list(commit.in_lines),
+             list(commit.out_lines))
+            for commit in commits]
+
+
+class GraphCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = GraphCache(os.path.join(self.dir, "graph-cache"),
+                                Commit)
+
+        commits = [make_commit("c%d" % i, ["c%d" % (i - 1)])
+                   for i in xrange(20, 0, -1)]
+        commits.append(make_commit("c0", []))
+        commits.insert(3, make_commit("m", ["c17", "c12"]))
+        commits[0].parents = (commits[0].parents[0], sha1("m").digest())
+        self.commits = commits
+        self.tips = [commits[0].sha1]
+        self.checkpoints = get_checkpoints(lay_out(commits), len(commits))
+        self.cache.save(self.tips, commits, self.checkpoints)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assertLoaded(self, tips, commits, checkpoints):
+        loaded_tips, loaded, loaded_checkpoints, ordinals = self.cache.load()
+
+        self.assertEqual(loaded_tips, tips)
+        self.assertEqual(get_rows(loaded), get_rows(commits))
+        self.assertEqual(loaded_checkpoints, checkpoints)
+        self.assertEqual(ordinals, dict([(commit.sha1, i) for i, commit
+                                         in enumerate(commits)]))
+
+    def test_load(self):
+        self.assertLoaded(self.tips, self.commits, self.checkpoints)
+
+    def test_load_creates_commits_when_used(self):
+        commits = self.cache.load()[1]
+
+        self.assertEqual(commits.built.count(None), len(self.commits))
+        self.assertTrue(commits[5] is commits[5])
+        self.assertEqual(commits.get_sha1(7), self.commits[7].sha1)
+        self.assertEqual(commits.get_parents(3), self.commits[3].parents)
+        self.assertEqual(commits.built.count(None), len(self.commits) - 1)
+
+    def test_append(self):
+        tips = self.tips
+        commits = self.commits
+        checkpoints = self.checkpoints
+
+        # Each branch has the color of the lane it's put beside, so the
+        # layout goes back to the old one a few rows below where it joins.
+        for parent in ("c12", "c6"):
+            branch = make_branch("b", parent, commits[0].node[1])
+            new_commits = [branch] + commits
+            states = lay_out(new_commits)
+            skip = None
+
+            for i in sorted(checkpoints):
+                if checkpoints[i] == states[i + 1]:
+                    skip = i + 1
+                    break
+
+            self.assertTrue(1 < skip < len(commits))
+
+            # The checkpoints below the commits laid out again are kept
+            # from before.
+            count = skip + 1
+            top_checkpoints = get_checkpoints(states, count)
+            new_checkpoints = dict(top_checkpoints)
+
+            for i, state in checkpoints.iteritems():
+                if i >= skip:
+                    new_checkpoints[i + 1] = state
+
+            new_tips = sorted(tips + [branch.sha1])
+
+            self.assertTrue(self.cache.append(tips, new_tips,
+                                              new_commits[:count],
+                                              top_checkpoints, skip))
+            self.assertLoaded(new_tips, new_commits, new_checkpoints)
+
+            tips = new_tips
+            commits = new_commits
+            checkpoints = new_checkpoints
+
+    def test_append_to_other_history(self):
+        branch = make_commit("b", ["c12"])
+        lay_out([branch])
+
+        self.assertFalse(self.cache.append([branch.sha1], [branch.sha1],
+                                           [branch, self.commits[0]], {}, 1))
+        self.assertLoaded(self.tips, self.commits, self.checkpoints)
+
+
+if __name__ == "__main__":
+    unittest.main()
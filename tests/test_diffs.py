@@ -0,0 +1,53 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from Gitty.git.diffs import find_chunk_end
+
+
+class FindChunkEndTests(unittest.TestCase):
+    def split(self, text, size):
+        """Splits text into chunks the way SourceView loads it."""
+        chunks = []
+        start = 0
+
+        while start < len(text):
+            end = find_chunk_end(text, start, len(text), size)
+            self.assertTrue(end > start, "No progress at %d" % start)
+            chunks.append(text[start:end])
+            start = end
+
+        return chunks
+
+    def test_ends_after_newline(self):
+        text = "abc\ndef\nghi\n"
+        self.assertEqual(find_chunk_end(text, 0, len(text), 9), 8)
+
+    def test_whole_section_fits(self):
+        text = "abc\ndef"
+        self.assertEqual(find_chunk_end(text, 0, len(text), 100), len(text))
+
+    def test_multibyte_without_newlines(self):
+        text = u"\xe9\u4e2d\U0001f600x".encode("utf-8") * 500
+
+        for size in (1, 2, 3, 5, 64):
+            chunks = self.split(text, size)
+            self.assertEqual("".join(chunks), text)
+
+            for chunk in chunks:
+                # Each chunk must decode on its own.
+                chunk.decode("utf-8")
+
+    def test_chunk_smaller_than_character(self):
+        text = u"\U0001f600\U0001f600".encode("utf-8")
+        self.assertEqual(find_chunk_end(text, 0, len(text), 2), 4)
+
+    def test_start_inside_character(self):
+        text = u"\u4e2d\u4e2d".encode("utf-8")
+        self.assertEqual(find_chunk_end(text, 1, len(text), 1), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
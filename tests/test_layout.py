@@ -0,0 +1,114 @@
+import os
+import sys
+import unittest
+from hashlib import sha1
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from Gitty.git.commits import Commit
+from Gitty.git.layout import LaneLayout
+
+
+def make_commit(name, parents):
+    return Commit.from_fields((sha1(name).digest(),
+                               tuple([sha1(parent).digest()
+                                      for parent in parents]),
+                               name, "", 0, "+0000", "", 0, "+0000"))
+
+
+def make_crisscross(count):
+    """Returns a history of two branches that keep merging each other."""
+    commits = []
+
+    for i in xrange(count, 0, -1):
+        a, b = "a%d" % i, "b%d" % i
+        a_parent, b_parent = "a%d" % (i - 1), "b%d" % (i - 1)
+        commits.append(make_commit(a, [a_parent, b_parent]))
+        commits.append(make_commit(b, [b_parent, a_parent]))
+
+    commits.append(make_commit("a0", ["root"]))
+    commits.append(make_commit("b0", ["root"]))
+    commits.append(make_commit("root", []))
+
+    return commits
+
+
+def make_octopus(count):
+    """Returns a history of octopus merges of a few side branches."""
+    commits = []
+
+    for i in xrange(count, 0, -1):
+        sides = ["s%d-%d" % (i, j) for j in xrange(3)]
+        commits.append(make_commit("m%d" % i, ["m%d" % (i - 1)] + sides))
+
+        for side in sides:
+            commits.append(make_commit(side, ["m%d" % (i - 1)]))
+
+    commits.append(make_commit("m0", []))
+
+    return commits
+
+
+class LaneLayoutTests(unittest.TestCase):
+    def lay_out(self, commits):
+        layout = LaneLayout()
+
+        for i, commit in enumerate(commits):
+            if i + 1 < len(commits):
+                layout.add(commit, commits[i + 1].sha1)
+            else:
+                layout.add(commit, None)
+
+        return commits
+
+    def assertConnected(self, commits):
+        """Checks that every line leaving a row carries on in the next."""
+        for row in xrange(len(commits) - 1):
+            commit = commits[row]
+            next_commit = commits[row + 1]
+            starts = set([start for start, end, color
+                          in next_commit.out_lines])
+            starts.add(next_commit.node[0])
+
+            self.assertTrue(next_commit.in_lines is commit.out_lines)
+
+            for start, end, color in commit.out_lines:
+                self.assertTrue(end in starts,
+                                "Line to column %d stops at row %d" %
+                                (end, row + 1))
+
+    def test_linear(self):
+        commits = [make_commit("c%d" % i, ["c%d" % (i - 1)])
+                   for i in xrange(10, 0, -1)]
+        commits.append(make_commit("c0", []))
+        self.lay_out(commits)
+
+        for commit in commits:
+            self.assertEqual(commit.node[0], 0)
+
+        self.assertConnected(commits)
+        self.assertEqual(commits[-1].out_lines, [])
+
+    def test_crisscross(self):
+        commits = self.lay_out(make_crisscross(50))
+        self.assertConnected(commits)
+
+    def test_merge_into_existing_lane(self):
+        # c2's second parent already has a lane from c3, which has to
+        # carry on past c2 as well as the line from c2's node.
+        commits = self.lay_out([
+            make_commit("c3", ["x"]),
+            make_commit("c2", ["c1", "x"]),
+            make_commit("c1", ["x"]),
+            make_commit("x", []),
+        ])
+        self.assertConnected(commits)
+        self.assertTrue((0, 0, commits[0].node[1]) in commits[1].out_lines)
+
+    def test_octopus(self):
+        commits = self.lay_out(make_octopus(20))
+        self.assertConnected(commits)
+
+
+if __name__ == "__main__":
+    unittest.main()